@@ -1,11 +1,29 @@
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
 import streamlit as st
 from article_generator import (
     validate_api_key, set_api_key, 
-    formalize_chunk, formalize_with_context,
-    split_transcript, generate_questions,
+    formalize_chunks_parallel, stream_formalize_with_state, stream_routed, DocumentState,
+    generate_questions, Prefetcher, prepare_chunks,
     get_api_key_from_local_storage, save_api_key_to_local_storage,
-    get_api_key
+    get_api_key, get_result_cache,
+    create_job, load_job, list_jobs, delete_job, record_result, find_previous_job, prune_completed_jobs,
+    load_previous_results, get_scheduler, ModelRouter, PerformanceRecorder, chunk_scope,
+    get_job_queue, owner_for_api_key, output_ratio_scope, removed_fillers_scope
 )
+from article_generator.job_queue import CANCELLED, DONE, FAILED, QUEUED, RUNNING
+from article_generator.prefetch import PREFETCH_WORKERS
+
+# バックグラウンドで処理中のジョブの状態を更新する間隔（秒）
+QUEUE_POLL_INTERVAL = 2.0
+
+# 先読みの状態を更新する間隔（秒）
+PREFETCH_POLL_INTERVAL = 1.0
+
+QUEUE_STATUS_LABELS = {QUEUED: "待機中", RUNNING: "処理中", DONE: "完了", FAILED: "失敗", CANCELLED: "中止"}
 
 def main():
     st.set_page_config(page_title="文字起こし整文化ツール", page_icon="📝", layout="wide")
@@ -82,6 +100,66 @@ def main():
         }
         st.info(model_info[selected_model])
         
+        # チャンクの難易度に応じたモデルの切り替え
+        routing = None
+        if st.checkbox("チャンクの難易度に応じてモデルを切り替える",
+                       help="話者の交代やフィラーが少ない易しいチャンクを高速なモデルで処理し、難しいチャンクだけを上で選択したモデルで処理します"):
+            fast_model_options = {
+                "claude-3-5-haiku-latest": "Claude 3.5 Haiku",
+                "claude-3-haiku-latest": "Claude 3 Haiku"
+            }
+            fast_model = st.selectbox("易しいチャンクに使うモデル", options=list(fast_model_options.keys()),
+                                      format_func=lambda x: fast_model_options[x])
+            escalate = st.checkbox("結果が不完全に見える場合は選択したモデルで処理し直す", value=True)
+            routing = {"fast_model": fast_model, "escalate": escalate}
+        
+        # 送信前の正規化
+        normalize = st.checkbox("フィラーやどもりを取り除いてから送信する", value=True,
+                                help="「えー」「あの」などのフィラー、言い直し、重複した行を手元で取り除き、同じ話者の連続した発言をまとめます。送信するトークン数が減ります")
+        
+        # 文字起こしが入力された時点での先読み
+        prefetch_enabled = st.checkbox("入力した時点で処理を始める", value=False,
+                                       help="文字起こしを入力すると、ボタンを押す前にチャンクへの分割と料金の見積もり、疑問点の生成を始めます。背景情報が空の場合は、最初のチャンクの整文化も始めます（APIの料金がかかります）")
+        
+        # 処理モード選択
+        mode_options = {
+            "sequential": "逐次処理（文脈重視）",
+            "parallel": "並列処理（高速）"
+        }
+        processing_mode = st.radio(
+            "処理モード",
+            options=list(mode_options.keys()),
+            format_func=lambda x: mode_options[x],
+            help="逐次処理は話者一覧・用語集・ここまでの要約をまとめた文書の状態を引き継ぎながら、チャンクを順に処理します。並列処理は直前チャンクの原文と話者一覧を文脈として複数チャンクを同時に処理します。"
+        )
+        max_workers = 1
+        if processing_mode == "parallel":
+            max_workers = st.slider("同時実行数", min_value=2, max_value=16, value=4,
+                                    help="同時にAPIへ送信するチャンク数の上限です。最初からこの数まで同時に送信し、レート制限を受けた場合は自動的に減らします")
+        
+        # ワーカーが起動している場合は、ジョブをキューに投入してバックグラウンドで処理できる
+        use_queue = render_queue_settings()
+        
+        # 中断されたジョブの再開
+        st.markdown("---")
+        resume_job_id = render_resumable_jobs()
+        
+        # 結果キャッシュの状態
+        st.markdown("---")
+        st.subheader("結果キャッシュ")
+        cache_stats_container = st.empty()
+        render_cache_stats(cache_stats_container)
+        owner = get_current_owner()
+        if st.button("キャッシュを削除", help="このAPIキーで保存した整文化結果を削除します（ほかの利用者の結果は削除しません）",
+                     disabled=owner is None):
+            get_result_cache().clear(owner)
+            render_cache_stats(cache_stats_container)
+        
+        # リクエストスケジューラの状態
+        with st.expander("リクエストの状況"):
+            scheduler_metrics_container = st.empty()
+            render_scheduler_metrics(scheduler_metrics_container, selected_model)
+        
         st.markdown("---")
         st.markdown("このツールはLangChainとAnthropic Claudeを使用しています。")
     
@@ -90,6 +168,10 @@ def main():
     transcript = st.text_area("文字起こしテキスト", height=300, 
                     help="整文化したい文字起こしテキストを入力してください")
     
+    prefetcher = get_prefetcher()
+    if not prefetch_enabled or not transcript:
+        prefetcher.discard()
+    
     # 疑問点生成ボタン
     if st.button("文脈理解のための疑問点を生成"):
         if not get_api_key():
@@ -97,8 +179,12 @@ def main():
         else:
             try:
                 with st.spinner("疑問点を生成中..."):
-                    # 疑問点を生成
-                    questions = generate_questions(transcript, selected_model)
+                    # 先読みで生成を始めていれば、その結果を使う
+                    prefetched_questions = prefetcher.questions(transcript, selected_model) if prefetch_enabled else None
+                    if prefetched_questions is not None:
+                        questions = prefetched_questions.result()
+                    else:
+                        questions = generate_questions(transcript, selected_model)
                     st.success("疑問点の生成が完了しました！")
                     st.markdown(questions)
                 
@@ -109,6 +195,14 @@ def main():
     background = st.text_area("背景情報（任意）", height=100, 
                             help="文字起こしの理解に役立つ背景知識や補足情報を入力してください")
     
+    # 入力と設定が変わらなければ、バックグラウンドで分割・見積もり・疑問点の生成・最初のチャンクの整文化を始める
+    fast_model = routing["fast_model"] if routing else None
+    prefetch = None
+    if prefetch_enabled and transcript and get_api_key():
+        prefetch = prefetcher.schedule(transcript, selected_model, get_api_key(), background, processing_mode,
+                                       normalize, fast_model)
+    prefetch_status = st.empty()
+    
     # 整文化ボタン
     formalize_button = st.button("整文化する")
     
@@ -120,6 +214,16 @@ def main():
     
     
     # 整文化処理
+    job = None
+    queued_job_id = st.query_params.get("job")
+    if prefetch is not None:
+        with prefetch_status.container():
+            # 処理を始める実行では、一定間隔の再実行で処理を止めないように、状態を一度だけ表示する
+            if prefetch.is_finished or formalize_button or resume_job_id:
+                render_prefetch_status(prefetch)
+            else:
+                poll_prefetch(prefetch)
+    
     if formalize_button:
         if not transcript:
             st.error("文字起こしテキストを入力してください")
@@ -129,18 +233,86 @@ def main():
             st.error("APIキーが設定されていません。サイドバーでAPIキーを入力してください")
             return
         
+        # モデルの入出力の上限に合わせてチャンク分割の前処理を行い、ジョブとして保存
+        # モデルを切り替える場合は、どちらのモデルでも処理できる大きさにする
+        # 内容に基づいて分割し、文字起こしを少し編集して再実行しても、ほかのチャンクの境界が変わらないようにする
+        # 入力と設定が同じ先読みがあれば、その分割の結果を使い、先に整文化したチャンクは結果キャッシュから返す
+        prefetched = prefetcher.get(transcript, selected_model, background, processing_mode, normalize,
+                                    fast_model) if prefetch_enabled else None
+        if prefetched is not None:
+            chunks, normalized = prefetched.chunks, prefetched.normalized
+            prefetched.settle()
+        else:
+            prefetcher.discard()
+            models = [selected_model] + ([fast_model] if fast_model else [])
+            chunks, normalized = prepare_chunks(transcript, models, background, normalize)
+        if normalized is not None:
+            progress_container.caption(f"正規化により {normalized.original_tokens} → {normalized.tokens} トークン"
+                                       f"（{normalized.saved_ratio:.1%} 削減）")
+        settings = {
+            "owner": get_current_owner(),
+            "background": background,
+            "model_name": selected_model,
+            "mode": processing_mode,
+            "context_mode": "state",
+            "max_workers": max_workers,
+            "routing": routing,
+            "normalize": normalize,
+            # 正規化で取り除いたフィラーは、チャンクの難易度の判定で数える
+            "removed_filler_density": normalized.filler_density if normalized is not None else 0.0
+        }
+        # 同じ設定で完了した自分のジョブがあれば、変わっていないチャンクの結果を再利用する
+        previous_job = find_previous_job(settings)
+        if previous_job is not None:
+            settings["previous_job_id"] = previous_job.job_id
+        job = create_job(chunks, settings)
+    elif resume_job_id:
+        if not get_api_key():
+            st.error("APIキーが設定されていません。サイドバーでAPIキーを入力してください")
+            return
+        
+        job = load_job(resume_job_id)
+        if job.owner != get_current_owner():
+            # 一覧には自分のジョブしか表示しないが、念のためほかの利用者のジョブは再開させない
+            st.error(f"ジョブ {resume_job_id} は見つかりません")
+            return
+    
+    if job is not None and use_queue:
+        # ワーカーに処理させ、このページでは状態だけを表示する（URLにジョブIDを残し、開き直しても表示できるようにする）
+        api_key = get_api_key()
+        get_job_queue().submit(job, owner_for_api_key(api_key), api_key)
+        st.query_params["job"] = job.job_id
+        queued_job_id = job.job_id
+        job = None
+    elif job is not None:
+        st.query_params.pop("job", None)
+    
+    if job is None and queued_job_id:
+        render_queued_job(queued_job_id, result_container)
+    
+    if job is not None:
+        settings = job.settings
         try:
             
             with st.spinner("整文化処理中..."):
-                # チャンク分割の前処理
-                chunks = split_transcript(transcript)
-                total_chunks = len(chunks)
+                total_chunks = len(job.chunks)
                 
                 with progress_container:
                     st.write(f"テキストを {total_chunks} チャンクに分割しました。")
-                    st.write(f"使用モデル: {model_options[selected_model]}")
+                    if job.results:
+                        st.write(f"ジョブ {job.job_id} を再開します（処理済み: {len(job.results)} チャンク）")
+                    st.write(f"使用モデル: {model_options.get(settings['model_name'], settings['model_name'])}")
+                    if settings.get("routing"):
+                        st.write(f"易しいチャンクのモデル: {settings['routing']['fast_model']}")
+                    st.write(f"処理モード: {mode_options[settings['mode']]}")
                     progress_text = st.empty()
                     progress_bar = st.progress(0)
+                    # チャンクごとの待ち時間・処理時間・トークン数を、完了したチャンクから表示する
+                    with st.expander("チャンクごとの処理時間とトークン使用量"):
+                        performance_chart = st.empty()
+                        performance_table = st.empty()
+                    # ボタンを押すとスクリプトが再実行されて処理が止まる（完了したチャンクはジョブに保存済み）
+                    st.button("処理を中止", help="処理を中止します。完了したチャンクは保存され、後から再開できます。")
                 
                 # 進捗状況を更新するコールバック関数
                 def update_progress(current_chunk, total_chunks):
@@ -148,16 +320,62 @@ def main():
                     progress_text.write(f"チャンク {current_chunk}/{total_chunks} を処理中...")
                     progress_bar.progress(progress)
                 
+                # 生成中のテキストをチャンクごとに表示する領域
+                live_area = result_container.empty()
+                with live_area.container():
+                    st.markdown("## 整文化されたテキスト（生成中）")
+                    partial_download = st.empty()
+                    chunk_placeholders = [st.empty() for _ in job.chunks]
+                chunk_texts = dict(job.results)
+                last_rendered = {}
+                recorder = PerformanceRecorder()
+                
+                def update_chunk(index, text, done):
+                    # 表示の更新が多すぎると遅くなるため、生成中は一定間隔でだけ描画する
+                    now = time.monotonic()
+                    if not done and now - last_rendered.get(index, 0) < 0.1:
+                        return
+                    last_rendered[index] = now
+                    chunk_placeholders[index].markdown(text + ("" if done else " ▌"))
+                    if done:
+                        chunk_texts[index] = text
+                        render_partial_download(partial_download, chunk_texts)
+                        render_performance(performance_chart, performance_table, recorder)
+                
+                for index, text in chunk_texts.items():
+                    chunk_placeholders[index].markdown(text)
+                render_partial_download(partial_download, chunk_texts)
+                
                 # カスタムコールバック関数を使用して整文化を実行
-                formalized_text = process_with_progress(chunks, background, update_progress, selected_model)
+                router = ModelRouter(strong_model=settings["model_name"], **settings["routing"]) if settings.get("routing") else None
+                previous = load_previous_results(job)
+                if previous:
+                    with progress_container:
+                        st.write(f"前回の実行と同じチャンク: {len(previous)}/{total_chunks}（コンテキストも同じ場合は結果を再利用します）")
+                # 出力の倍率はジョブごとに記録し、ほかの利用者の文字起こしの影響を受けないようにする
+                with recorder.activate(job.job_id), output_ratio_scope(), removed_fillers_scope(settings.get("removed_filler_density", 0.0)):
+                    formalized_text = process_with_progress(job.chunks, settings["background"], update_progress, settings["model_name"],
+                                                            settings["mode"], settings["max_workers"], job, update_chunk, router,
+                                                            previous)
                 
                 # 進捗表示を完了に
                 progress_bar.progress(1.0)
                 progress_text.write("処理が完了しました！")
+                live_area.empty()
+                render_cache_stats(cache_stats_container)
+                render_scheduler_metrics(scheduler_metrics_container, settings["model_name"])
+            
+            # 完了したジョブは、文字起こしを編集して再実行するときに結果を再利用するため、所有者ごとに新しいものだけを残す
+            prune_completed_jobs(owner=settings.get("owner"))
             
             # 結果表示
             with result_container:
                 st.success("整文化が完了しました！")
+                if router is not None:
+                    with st.expander("モデルごとの処理結果"):
+                        st.table(router.report())
+                if recorder.records:
+                    render_performance_summary(recorder)
                 st.markdown("## 整文化されたテキスト")
                 st.markdown(formalized_text)
                 
@@ -172,21 +390,359 @@ def main():
         
         except Exception as e:
             st.error(f"エラーが発生しました: {str(e)}")
+            st.info(f"完了したチャンク（{len(job.results)}/{len(job.chunks)}）はジョブ {job.job_id} に保存されています。"
+                    "サイドバーの「ジョブを再開」から未処理のチャンクだけを再実行できます。")
+
+def get_current_owner():
+    """
+    現在のAPIキーから、ジョブの所有者の識別子を求めます。
+    
+    Returns:
+        所有者の識別子（APIキーが設定されていない場合はNone）
+    """
+    api_key = get_api_key()
+    return owner_for_api_key(api_key) if api_key else None
+
+def render_resumable_jobs():
+    """
+    現在のAPIキーで作成した、中断されたジョブの一覧を表示し、再開するジョブを選択させます。
+    
+    Returns:
+        再開ボタンが押された場合はそのジョブID、それ以外はNone
+    """
+    st.subheader("中断されたジョブ")
+    owner = get_current_owner()
+    if owner is None:
+        st.caption("APIキーを設定すると、中断したジョブを表示します")
+        return None
+    # ワーカーが処理中のジョブは、二重に処理しないように除く
+    active_job_ids = {entry.job_id for entry in get_job_queue().list_entries(owner=owner, active_only=True, limit=1000)}
+    jobs = [job for job in list_jobs(owner=owner) if job.job_id not in active_job_ids]
+    if not jobs:
+        st.caption("中断されたジョブはありません")
+        return None
+    
+    job_labels = {job.job_id: f"{job.job_id}（{job.completed_chunks}/{job.total_chunks} チャンク完了）" for job in jobs}
+    selected_job_id = st.selectbox("再開するジョブ", options=list(job_labels.keys()), format_func=lambda x: job_labels[x])
+    
+    col1, col2 = st.columns(2)
+    if col2.button("削除", help="選択したジョブのチェックポイントを削除します"):
+        delete_job(selected_job_id)
+        st.rerun()
+    if col1.button("ジョブを再開", help="未処理のチャンクだけをAPIに再送信します"):
+        return selected_job_id
+    return None
+
+def render_queue_settings():
+    """
+    ワーカーが起動している場合に、バックグラウンドで処理するかどうかの選択と、自分のジョブの一覧を表示します。
+    
+    Returns:
+        ジョブをキューに投入して処理する場合はTrue
+    """
+    queue = get_job_queue()
+    stats = queue.stats()
+    if not stats["workers"]:
+        return False
+    
+    use_queue = st.checkbox("バックグラウンドのワーカーで処理する", value=True,
+                            help="ブラウザを閉じたり画面を操作したりしても処理が続きます。このページのURLを開き直すと結果を確認できます。")
+    st.caption(f"ワーカー {stats['workers']} 台（待機中 {stats[QUEUED]} 件、処理中 {stats[RUNNING]} 件）")
+    api_key = get_api_key()
+    if api_key:
+        entries = queue.list_entries(owner=owner_for_api_key(api_key), limit=10)
+        if entries:
+            with st.expander("投入したジョブ"):
+                for entry in entries:
+                    st.markdown(f"[{entry.job_id}](?job={entry.job_id})　{QUEUE_STATUS_LABELS[entry.status]}（{entry.completed}/{entry.total} チャンク）")
+    return use_queue
+
+def render_queued_job(job_id, container):
+    """
+    キューに投入したジョブの状態を表示します。処理が終わるまでは一定間隔で表示を更新します。
+    ほかの利用者のジョブは、存在しないものとして扱います。
+    
+    Args:
+        job_id: ジョブID
+        container: 表示先のコンテナ
+    """
+    entry = get_job_queue().get(job_id)
+    if entry is not None and entry.owner != get_current_owner():
+        entry = None
+    with container:
+        if entry is None:
+            st.warning(f"ジョブ {job_id} は見つかりません")
+        elif entry.is_active:
+            poll_queued_job(job_id)
+        elif entry.status == DONE:
+            st.success(f"ジョブ {job_id} の整文化が完了しました！")
+            st.markdown("## 整文化されたテキスト")
+            st.markdown(entry.result)
+            st.download_button(label="整文化テキストをダウンロード", data=entry.result,
+                               file_name="formalized_transcript.md", mime="text/markdown")
+        elif entry.status == CANCELLED:
+            st.warning(f"ジョブ {job_id} は中止されました（完了: {entry.completed}/{entry.total} チャンク）。"
+                       "サイドバーの「ジョブを再開」から続きを処理できます。")
+        else:
+            st.error(f"ジョブ {job_id} の処理に失敗しました: {entry.error}")
+            st.info(f"完了したチャンク（{entry.completed}/{entry.total}）は保存されています。"
+                    "サイドバーの「ジョブを再開」から未処理のチャンクだけを再実行できます。")
+
+@st.fragment(run_every=QUEUE_POLL_INTERVAL)
+def poll_queued_job(job_id):
+    """
+    待機中・処理中のジョブの進捗と途中結果を表示します。この部分だけが一定間隔で再実行されます。
+    
+    Args:
+        job_id: ジョブID
+    """
+    queue = get_job_queue()
+    entry = queue.get(job_id)
+    if entry is None or not entry.is_active or entry.owner != get_current_owner():
+        # 終了したらページ全体を再実行し、結果の表示に切り替える（APIキーが変わった場合は表示しない）
+        st.rerun()
+    
+    if entry.status == QUEUED:
+        st.info(f"ジョブ {job_id} は順番を待っています（前に {queue.position(job_id) or 0} 件）")
+    else:
+        st.info(f"ジョブ {job_id} をバックグラウンドで処理中です")
+    st.progress(entry.completed / entry.total if entry.total else 0.0,
+                text=f"{entry.completed}/{entry.total} チャンク完了")
+    if entry.cancel_requested:
+        st.caption("中止を要求しました。処理中のチャンクが終わると中止します。")
+    elif st.button("処理を中止", key=f"cancel-{job_id}",
+                   help="完了したチャンクは保存され、後から再開できます。"):
+        queue.cancel(job_id)
+        st.rerun()
+    
+    try:
+        results = load_job(job_id).ordered_results()
+    except (OSError, ValueError, TypeError):
+        results = []
+    if results:
+        st.markdown("## 整文化されたテキスト（途中結果）")
+        st.markdown("\n\n".join(results))
+
+def get_prefetcher():
+    """
+    このセッションの先読みを管理する Prefetcher を取得します。
+    APIキーはセッションごとに異なるため、セッションステートに保存します。
+    
+    Returns:
+        Prefetcher
+    """
+    if "_prefetcher" not in st.session_state:
+        st.session_state["_prefetcher"] = Prefetcher(executor=get_prefetch_executor())
+    return st.session_state["_prefetcher"]
+
+@st.cache_resource
+def get_prefetch_executor():
+    """
+    先読みに使うスレッドプールを、すべてのセッションで共有して取得します。
+    セッションごとに作成すると、セッションが終わってもスレッドが残り続けるためです。
+    
+    Returns:
+        ThreadPoolExecutor
+    """
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def render_prefetch_status(prefetch):
+    """
+    先読みの状態（チャンク数と料金の見積もり、疑問点の生成、先に整文化したチャンク）を表示します。
+    
+    Args:
+        prefetch: 表示する先読み
+    """
+    if prefetch.prepared.cancelled():
+        return
+    if not prefetch.prepared.done():
+        st.caption("入力が確定したら、バックグラウンドで処理を始めます...")
+        return
+    if prefetch.error:
+        st.caption(f"先読みに失敗しました（整文化するときにやり直します）: {prefetch.error}")
+        return
+    
+    parts = [f"{len(prefetch.chunks)} チャンク", f"入力 約 {prefetch.input_tokens} トークン"]
+    if prefetch.estimated_cost is not None:
+        parts.append(f"概算料金 ${prefetch.estimated_cost:.4f}")
+    if prefetch.normalized is not None:
+        parts.append(f"正規化で {prefetch.normalized.saved_ratio:.1%} 削減")
+    if prefetch.questions is not None:
+        if not prefetch.questions.done():
+            parts.append("疑問点を生成中")
+        elif prefetch.questions.exception() is None:
+            parts.append("疑問点を生成済み")
+    if prefetch.planned_chunks:
+        parts.append(f"先に整文化したチャンク {prefetch.formalized_chunks}/{prefetch.planned_chunks}")
+    st.caption("、".join(parts))
+
+@st.fragment(run_every=PREFETCH_POLL_INTERVAL)
+def poll_prefetch(prefetch):
+    """
+    先読みの状態を表示します。先読みが終わるまで、この部分だけが一定間隔で再実行されます。
+    
+    Args:
+        prefetch: 表示する先読み
+    """
+    if prefetch.is_finished:
+        # 終わったらページ全体を再実行し、一定間隔の再実行をやめる
+        st.rerun()
+    render_prefetch_status(prefetch)
+
+def render_partial_download(container, chunk_texts):
+    """
+    完了したチャンクまでの途中結果をダウンロードするリンクを表示します。
+    ダウンロードボタンはクリックでスクリプトが再実行され処理が止まるため、データURIのリンクを使います。
+    
+    Args:
+        container: 表示先のStreamlitコンテナ
+        chunk_texts: チャンクの位置と整文化されたテキストの辞書
+    """
+    if not chunk_texts:
+        container.empty()
+        return
+    
+    partial_text = "\n\n----\n\n".join(chunk_texts[i] for i in sorted(chunk_texts))
+    encoded = base64.b64encode(partial_text.encode("utf-8")).decode("ascii")
+    container.markdown(
+        f'<a href="data:text/markdown;charset=utf-8;base64,{encoded}" download="formalized_transcript_partial.md">'
+        f'途中結果をダウンロード（{len(chunk_texts)} チャンク）</a>',
+        unsafe_allow_html=True
+    )
 
-def process_with_progress(chunks, background, progress_callback, model_name="claude-3-7-sonnet-latest"):
+def render_cache_stats(container):
+    """
+    現在のAPIキーの結果キャッシュのヒット数・ミス数と保存状況を表示します（ほかの利用者の分は含みません）。
+    
+    Args:
+        container: 表示先のStreamlitコンテナ
+    """
+    owner = get_current_owner()
+    if owner is None:
+        container.caption("APIキーを設定すると、キャッシュの状況が表示されます。")
+        return
+    stats = get_result_cache().stats(owner)
+    with container.container():
+        col1, col2 = st.columns(2)
+        col1.metric("ヒット", stats["hits"])
+        col2.metric("ミス", stats["misses"])
+        st.caption(f"保存件数: {stats['entries']} 件（{stats['size_bytes'] / (1024 * 1024):.1f} MB）")
+
+def render_scheduler_metrics(container, model_name):
+    """
+    現在のAPIキーとモデルのリクエストスケジューラの状態を表示します（ほかの利用者の使用量は含みません）。
+    
+    Args:
+        container: 表示先のStreamlitコンテナ
+        model_name: 表示するモデル名
+    """
+    metrics = get_scheduler(model_name).metrics()
+    with container.container():
+        col1, col2 = st.columns(2)
+        col1.metric("同時実行数の上限", metrics["concurrency_limit"])
+        col2.metric("リトライ", metrics["retries"])
+        st.caption(f"待機中: {metrics['queue_depth']} 件 / 実行中: {metrics['in_flight']} 件 / "
+                   f"スロットリング: {metrics['throttled']} 回 / 失敗: {metrics['failures']} 件")
+        st.caption(f"実効スループット: {metrics['requests_per_minute']} リクエスト/分、{metrics['tokens_per_minute']:.0f} トークン/分")
+        requests_limit = metrics["requests_per_minute_limit"]
+        tokens_limit = metrics["tokens_per_minute_limit"]
+        st.caption(f"送信の上限: {f'{requests_limit} リクエスト/分' if requests_limit is not None else 'リクエスト数は制限なし'}、"
+                   f"{f'{tokens_limit} トークン/分' if tokens_limit is not None else 'トークン数は制限なし'}")
+        st.caption(f"入力: {metrics['input_tokens']} トークン（キャッシュ読み込み {metrics['cache_read_tokens']} / "
+                   f"キャッシュ書き込み {metrics['cache_write_tokens']}） / 出力: {metrics['output_tokens']} トークン")
+
+def render_performance(chart_container, table_container, recorder):
+    """
+    チャンクごとの待ち時間・最初のトークンまでの時間・生成時間のグラフと、トークン使用量の表を表示します。
+    
+    Args:
+        chart_container: グラフの表示先のStreamlitコンテナ
+        table_container: 表の表示先のStreamlitコンテナ
+        recorder: モデルの呼び出しを記録したPerformanceRecorder
+    """
+    rows = recorder.chunk_rows()
+    if not rows:
+        return
+    
+    chart_rows = []
+    for row in rows:
+        wait = row["queue_wait_seconds"]
+        first_token = max(0.0, (row["time_to_first_token_seconds"] or wait) - wait)
+        chart_rows.append({
+            "チャンク": row["chunk_index"] + 1,
+            "待ち時間": wait,
+            "最初のトークンまで": first_token,
+            "生成": max(0.0, row["latency_seconds"] - wait - first_token),
+        })
+    chart_container.bar_chart(chart_rows, x="チャンク", y=["待ち時間", "最初のトークンまで", "生成"], y_label="秒")
+    table_container.dataframe(rows, hide_index=True)
+
+def render_performance_summary(recorder):
+    """
+    実行全体の処理時間・トークン使用量・概算料金と、呼び出しごとの記録のダウンロードボタンを表示します。
+    
+    Args:
+        recorder: モデルの呼び出しを記録したPerformanceRecorder
+    """
+    summary = recorder.summary()
+    with st.expander("処理時間とトークン使用量"):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("呼び出し", summary["calls"])
+        col2.metric("処理時間（中央値）", f"{summary['latency_p50_seconds']:.1f} 秒")
+        col3.metric("リトライ", summary["retries"])
+        col4.metric("概算料金", f"${summary['cost_usd']:.4f}" if summary["cost_usd"] is not None else "不明")
+        st.caption(f"入力: {summary['input_tokens']} トークン（キャッシュ読み込み {summary['cache_read_tokens']} / "
+                   f"キャッシュ書き込み {summary['cache_write_tokens']}） / 出力: {summary['output_tokens']} トークン / "
+                   f"待ち時間の合計: {summary['total_queue_wait_seconds']:.1f} 秒")
+        col1, col2 = st.columns(2)
+        col1.download_button("記録をCSVでダウンロード", data=recorder.to_csv(), file_name="performance.csv", mime="text/csv")
+        col2.download_button("記録をJSON Linesでダウンロード", data=recorder.to_jsonl(), file_name="performance.jsonl",
+                             mime="application/jsonl")
+
+def process_with_progress(chunks, background, progress_callback, model_name="claude-3-7-sonnet-latest",
+                          mode="sequential", max_workers=4, job=None, chunk_callback=None, router=None, previous=None):
     """
     進捗状況を表示しながらチャンクを処理します。
-    直前3つのチャンクの処理結果をコンテキストとして使用します。
+    逐次処理モードでは話者・用語・要約からなる文書の状態をコンテキストとして引き継ぎ、生成中のテキストを逐次受け取ります。
+    並列処理モードでは直前チャンクの原文と話者一覧をコンテキストとして、複数チャンクを同時に処理し、
+    処理中のチャンクごとに生成中のテキストを受け取ります。
+    routerを指定した場合は、チャンクの難易度に応じてモデルを切り替えます。
     
     Args:
         chunks: 処理するチャンクのリスト
         background: 背景情報
         progress_callback: 進捗状況を更新するコールバック関数
         model_name: 使用するモデル名
+        mode: 処理モード（"sequential" または "parallel"）
+        max_workers: 並列処理モードでの同時実行数
+        job: 結果を保存するジョブ（指定した場合は処理済みのチャンクを再利用し、完了ごとにチェックポイントを更新）
+        chunk_callback: チャンクの位置、生成済みのテキスト、完了したかどうかを受け取るコールバック関数（オプション）
+        router: チャンクの難易度に応じてモデルを選ぶModelRouter（オプション）
+        previous: 前回の実行の結果（チャンクとコンテキストが同じ場合は再利用する、オプション）
     
     Returns:
         整文化されたテキスト
     """
+    completed = dict(job.results) if job is not None else {}
+    state = DocumentState.from_dict(job.document_state) if job is not None else DocumentState()
+    
+    def update_state(new_state):
+        nonlocal state
+        state = new_state
+    
+    def save_result(index, result):
+        if job is not None:
+            record_result(job, index, result, document_state=state.to_dict())
+        if chunk_callback:
+            chunk_callback(index, result, True)
+    
+    if mode == "parallel":
+        partial_callback = (lambda index, text: chunk_callback(index, text, False)) if chunk_callback else None
+        processed_chunks = formalize_chunks_parallel(chunks, background, model_name, max_workers, progress_callback,
+                                                     completed, save_result, router=router, previous=previous,
+                                                     partial_callback=partial_callback)
+        return "\n\n----\n\n".join(processed_chunks)
+    
     # 処理結果を保存するリスト
     processed_chunks = []
     total_chunks = len(chunks)
@@ -195,25 +751,45 @@ def process_with_progress(chunks, background, progress_callback, model_name="cla
         # 進捗状況を更新
         progress_callback(i + 1, total_chunks)
         
-        if i == 0:
-            # 最初のチャンクは通常の方法で処理
-            result = formalize_chunk(chunk, background, model_name)
-            processed_chunks.append(result)
-        else:
-            # 直前3つのチャンクの処理結果を取得
-            context_window = 3
-            start_idx = max(0, i - context_window)
-            recent_results = processed_chunks[start_idx:i]
-            
-            # 直前のチャンクの処理結果を連結してコンテキストとして使用
-            context = "\n\n".join(recent_results)
-            
-            # コンテキストを考慮して処理
-            next_part = formalize_with_context(chunk, context, background, model_name)
-            processed_chunks.append(next_part)
+        if i in completed:
+            # 処理済みのチャンクは保存された結果を使う
+            processed_chunks.append(completed[i])
+            continue
+        
+        reusable = (previous or {}).get(i)
+        if reusable is not None and reusable.state_after is not None and reusable.state_before.has_same_entries(state):
+            # 前回と同じチャンクを同じ話者・用語で処理していれば、前回の結果と状態を引き継ぐ
+            update_state(reusable.state_after)
+            processed_chunks.append(reusable.result)
+            save_result(i, reusable.result)
+            continue
+        
+        # 生成されたテキストを受け取りながら処理し、更新された文書の状態を次のチャンクに引き継ぐ
+        # （高速なモデルの結果が不完全に見えて強いモデルで生成し直す場合も、このチャンクの処理前の状態から生成する）
+        chunk_state = state
+        partial_callback = (lambda text: chunk_callback(i, text, False)) if chunk_callback else None
+        with chunk_scope(i):
+            result = stream_routed(router, model_name, chunk,
+                                   lambda model: stream_formalize_with_state(chunk, chunk_state, background, model, update_state),
+                                   partial_callback).rstrip()
+        processed_chunks.append(result)
+        
+        save_result(i, result)
     
     # 全ての処理結果を連結
     return "\n\n----\n\n".join(processed_chunks)
 
+@st.cache_resource
+def preload_model_library():
+    """
+    整文化で使う langchain_anthropic を、プロセスごとに一度だけバックグラウンドで読み込みます。
+    最初の画面の表示を待たせず、最初の整文化を始めるときに読み込みを待たないようにします。
+    """
+    thread = threading.Thread(target=import_module, args=("langchain_anthropic",), daemon=True)
+    thread.start()
+    return thread
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    # 画面の描画を始める前に読み込みを始め、最初の整文化までに読み込みを終えておく
+    preload_model_library()
+    main()
\ No newline at end of file
@@ -1,7 +1,87 @@
-from .utils import validate_api_key, set_api_key, get_api_key_from_local_storage, save_api_key_to_local_storage, get_api_key
-from .article_formalizer import formalize_transcript, formalize_chunk, formalize_with_context, generate_questions
-from .transcript_splitter import split_transcript
+from importlib import import_module
+from typing import TYPE_CHECKING
 
-__all__ = ["validate_api_key", "set_api_key", "formalize_transcript", 
-           "formalize_chunk", "formalize_with_context", "split_transcript", "generate_questions",
-           "get_api_key_from_local_storage", "save_api_key_to_local_storage", "get_api_key"] 
\ No newline at end of file
+# 公開する名前と、それを定義しているモジュール
+# langchain や anthropic の読み込みには時間がかかるため、名前が最初に参照されたときにモジュールを読み込む
+_EXPORTS = {
+    ".utils": ["validate_api_key", "set_api_key", "get_api_key_from_local_storage", "save_api_key_to_local_storage", "get_api_key",
+               "use_api_key"],
+    ".article_formalizer": [
+        "formalize_transcript", "formalize_chunk", "formalize_with_context", "formalize_chunks_parallel", "stream_formalize_chunk",
+        "formalize_with_state", "stream_formalize_with_state",
+        "build_context_window", "generate_questions",
+        "aformalize_chunk", "aformalize_transcript", "agenerate_questions",
+        "run_job", "resume_job", "get_chunk_token_budget", "load_previous_results", "set_client_factory",
+        "get_output_budget", "split_for_output", "stream_routed",
+    ],
+    ".transcript_splitter": ["split_transcript", "iter_transcript_chunks", "iter_transcript_file_chunks", "extract_speakers",
+                             "normalize_transcript", "NormalizedTranscript"],
+    ".token_estimator": ["estimate_tokens", "compute_chunk_tokens", "get_model_limits", "OutputRatioTracker", "get_output_ratio_tracker",
+                         "output_ratio_scope"],
+    ".result_cache": ["ResultCache", "get_result_cache"],
+    ".rate_limiter": ["RequestScheduler", "get_scheduler", "configure_scheduler"],
+    ".document_state": ["DocumentState"],
+    ".model_router": ["ModelRouter", "score_chunk", "removed_fillers_scope"],
+    ".job_store": ["Job", "JobSummary", "create_job", "load_job", "record_result", "list_jobs", "delete_job", "find_previous_job", "prune_completed_jobs"],
+    ".batch_processor": ["formalize_transcripts_batch", "run_message_batch"],
+    ".live": ["follow_transcript"],
+    ".job_queue": ["JobQueue", "QueueEntry", "get_job_queue", "owner_for_api_key"],
+    ".worker": ["run_worker"],
+    ".prefetch": ["Prefetcher", "Prefetch", "prepare_chunks", "estimate_formalization"],
+    ".instrumentation": ["CallRecord", "PerformanceRecorder", "add_call_listener", "remove_call_listener", "chunk_scope"],
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+if TYPE_CHECKING:
+    from .utils import validate_api_key, set_api_key, get_api_key_from_local_storage, save_api_key_to_local_storage, get_api_key, use_api_key
+    from .article_formalizer import (
+        formalize_transcript, formalize_chunk, formalize_with_context, formalize_chunks_parallel, stream_formalize_chunk,
+        formalize_with_state, stream_formalize_with_state,
+        build_context_window, generate_questions,
+        aformalize_chunk, aformalize_transcript, agenerate_questions,
+        run_job, resume_job, get_chunk_token_budget, load_previous_results, set_client_factory,
+        get_output_budget, split_for_output, stream_routed
+    )
+    from .transcript_splitter import (
+        split_transcript, iter_transcript_chunks, iter_transcript_file_chunks, extract_speakers,
+        normalize_transcript, NormalizedTranscript
+    )
+    from .token_estimator import (
+        estimate_tokens, compute_chunk_tokens, get_model_limits, OutputRatioTracker, get_output_ratio_tracker, output_ratio_scope
+    )
+    from .result_cache import ResultCache, get_result_cache
+    from .rate_limiter import RequestScheduler, get_scheduler, configure_scheduler
+    from .document_state import DocumentState
+    from .model_router import ModelRouter, score_chunk, removed_fillers_scope
+    from .job_store import Job, JobSummary, create_job, load_job, record_result, list_jobs, delete_job, find_previous_job, prune_completed_jobs
+    from .batch_processor import formalize_transcripts_batch, run_message_batch
+    from .live import follow_transcript
+    from .job_queue import JobQueue, QueueEntry, get_job_queue, owner_for_api_key
+    from .worker import run_worker
+    from .prefetch import Prefetcher, Prefetch, prepare_chunks, estimate_formalization
+    from .instrumentation import CallRecord, PerformanceRecorder, add_call_listener, remove_call_listener, chunk_scope
+
+def __getattr__(name: str):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+__all__ = ["validate_api_key", "set_api_key", "formalize_transcript",
+           "formalize_chunk", "formalize_with_context", "formalize_chunks_parallel", "stream_formalize_chunk", "build_context_window",
+           "formalize_with_state", "stream_formalize_with_state", "DocumentState", "ModelRouter", "score_chunk", "removed_fillers_scope",
+           "split_transcript", "iter_transcript_chunks", "iter_transcript_file_chunks", "extract_speakers", "normalize_transcript", "NormalizedTranscript", "estimate_tokens", "compute_chunk_tokens", "get_model_limits", "get_chunk_token_budget", "generate_questions",
+           "aformalize_chunk", "aformalize_transcript", "agenerate_questions", "ResultCache", "get_result_cache",
+           "Job", "JobSummary", "create_job", "load_job", "record_result", "list_jobs", "delete_job", "run_job", "resume_job",
+           "find_previous_job", "prune_completed_jobs", "load_previous_results",
+           "RequestScheduler", "get_scheduler", "configure_scheduler", "set_client_factory", "formalize_transcripts_batch", "run_message_batch",
+           "follow_transcript", "CallRecord", "PerformanceRecorder", "add_call_listener", "remove_call_listener", "chunk_scope",
+           "JobQueue", "QueueEntry", "get_job_queue", "owner_for_api_key", "run_worker", "use_api_key",
+           "Prefetcher", "Prefetch", "prepare_chunks", "estimate_formalization",
+           "OutputRatioTracker", "get_output_ratio_tracker", "output_ratio_scope", "get_output_budget", "split_for_output", "stream_routed",
+           "get_api_key_from_local_storage", "save_api_key_to_local_storage", "get_api_key"]
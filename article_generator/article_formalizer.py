@@ -1,32 +1,177 @@
-from typing import List, Optional
-import streamlit as st
-from langchain_anthropic import ChatAnthropic
-from langchain.prompts import ChatPromptTemplate
-from .transcript_splitter import split_transcript
+import asyncio
+import contextvars
+import difflib
+import logging
+import math
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
+from .transcript_splitter import split_transcript, extract_speakers
+from .token_estimator import (
+    MIN_CHUNK_TOKENS, OUTPUT_SAFETY_MARGIN, OutputRatioTracker, estimate_tokens, truncate_to_last_tokens, compute_chunk_tokens,
+    get_model_limits, get_output_ratio_tracker, output_ratio_scope
+)
+from .result_cache import ResultCache, get_result_cache
+from .job_store import Job, create_job, delete_job, load_job, record_result
+from .document_state import STATE_END_TAG, STATE_START_TAG, DocumentState, split_document_state, strip_document_state
+from .model_router import ModelRouter, removed_fillers_scope
+from .instrumentation import CallTimer, chunk_scope, measure_call
+from .rate_limiter import RequestScheduler, get_scheduler
+from .utils import create_thread_pool, get_api_key, owner_for_api_key
 
-def create_prompt_template(with_context: bool = False) -> str:
+# langchain の読み込みには時間がかかるため、型注釈以外ではクライアントやメッセージを作成するときに読み込む
+if TYPE_CHECKING:
+    from langchain_anthropic import ChatAnthropic
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class PreviousResult(NamedTuple):
     """
-    プロンプトテンプレートを作成します。
-    
-    Args:
-        with_context: 前のチャンクのコンテキストを含めるかどうか
+    前回の実行で、同じ内容のチャンクに対して得られた結果です。
+    context（直前の結果や原文から作ったコンテキスト）や state_before（処理前の文書の状態）が
+    今回と同じ場合は、APIを呼び出さずに result をそのまま使えます。
+    """
+    result: str
+    context: Optional[str]
+    state_before: DocumentState
+    state_after: Optional[DocumentState]
+
+# プロンプトテンプレートのバージョン（テンプレートを変更したら更新し、古いキャッシュを無効にする）
+PROMPT_TEMPLATE_VERSION = "2"
+
+# 文脈として参照する直前のチャンク数と、コンテキストに使うトークン数の上限
+CONTEXT_WINDOW = 3
+MAX_CONTEXT_TOKENS = 6000
+
+# 逐次処理で次のチャンクに渡すコンテキストの既定値
+# "state" は話者・用語・要約だけの文書の状態、"previous" は直前のチャンクの処理結果そのもの
+CONTEXT_MODE = "state"
+
+# 整文化結果の後に出力させる、更新後の文書の状態に見込むトークン数
+STATE_OUTPUT_TOKENS = 800
+
+# 整文化のリクエストの種類（出力の上限をチャンクの大きさから決め、出力の倍率を記録する）
+FORMALIZE_KINDS = ("chunk", "context", "state")
+
+# 出力の上限は、見積もった出力トークン数にこの倍率を掛けて決める（見積もりを超えて途中で切れた場合は続きを生成させる）
+OUTPUT_BUDGET_MARGIN = 1.5
+
+# 出力の上限の最小値
+MIN_OUTPUT_BUDGET = 1024
+
+# 出力の上限に達して途中で切れた場合に、続きを生成させる回数の上限
+MAX_CONTINUATIONS = 3
+
+# 非同期APIで同時に実行するリクエスト数の既定値
+MAX_CONCURRENCY = 4
+
+# 保持するクライアントの数の上限（クライアントは利用者のAPIキーを持つため、共有のサーバーで増え続けないようにする）
+MAX_CACHED_CLIENTS = 16
+
+# 疑問点の生成で、文字起こしの推定トークン数がこれを超える場合はmap-reduceで処理する
+QUESTIONS_SINGLE_SHOT_TOKENS = 20000
+
+# map-reduceで疑問点を生成するときの、1チャンクの最大トークン数
+QUESTIONS_CHUNK_TOKENS = 8000
+
+# 疑問点の生成で使うシステムプロンプト（文字起こしはユーザーメッセージとして渡す）
+QUESTIONS_SYSTEM_PROMPT = """
+    <system_role>
+    あなたは文字起こしテキストを分析し、文脈理解のために必要な疑問点を抽出するプロフェッショナルです。
+    ユーザーが渡す文字起こしテキストを読み、文脈を理解する上で不明確な点や背景情報が必要な点について、
+    5〜10個程度の具体的な疑問を生成してください。
+    </system_role>
     
-    Returns:
-        プロンプトテンプレート
+    <processing_instructions>
+    - テキストの内容を深く理解するために必要な疑問点を抽出してください
+    - 専門用語や略語の意味に関する疑問を含めてください
+    - 話者の関係性や立場に関する疑問を含めてください
+    - 議論されているプロジェクトや事象の背景に関する疑問を含めてください
+    - 時系列や因果関係が不明確な部分に関する疑問を含めてください
+    - 具体的で明確な質問を作成してください
+    - 質問は箇条書きでマークダウン形式で出力してください
+    - 各質問の重要度や優先度に応じて並べ替えてください
+    </processing_instructions>
     """
-    base_template = """
+
+# 疑問点の候補をまとめるときに使うシステムプロンプト（map-reduceのreduceの段階）
+QUESTIONS_REDUCE_SYSTEM_PROMPT = """
     <system_role>
-    あなたは文字起こしテキストを整理して整文化をするプロフェッショナルです。
-    以下の文字起こしテキストを、背景情報も考慮しながら整理された会話の発言録に書き直してください。
+    あなたは文字起こしテキストを分析し、文脈理解のために必要な疑問点を抽出するプロフェッショナルです。
+    ユーザーが渡すのは、長い文字起こしテキストを分割した各部分から抽出した疑問点の候補です。
+    候補をまとめて、テキスト全体の文脈を理解するために重要な5〜10個程度の疑問に絞り込んでください。
     </system_role>
+    
+    <processing_instructions>
+    - 同じ内容や似た内容の疑問は1つにまとめてください
+    - テキスト全体の理解にとって重要な疑問を優先し、細かすぎる疑問は除いてください
+    - 他の部分を読めば答えがわかる疑問は除いてください
+    - 具体的で明確な質問にしてください
+    - 質問は箇条書きでマークダウン形式で出力してください
+    - 各質問の重要度や優先度に応じて並べ替えてください
+    </processing_instructions>
+    """
 
+# ユーザーメッセージのテンプレート（チャンクごとに変わる部分）
+TRANSCRIPT_TEMPLATE = """
     <input_transcript>
-    {chunk}
+    {text}
     </input_transcript>
-    
+    """
+
+PREVIOUS_CONTENT_TEMPLATE = """
+    <previous_content>
+    {previous_result}
+    </previous_content>
+    """
+
+CANDIDATE_QUESTIONS_TEMPLATE = """
+    <candidate_questions part="{part}">
+    {questions}
+    </candidate_questions>
+    """
+
+DOCUMENT_STATE_TEMPLATE = """
+    <document_state>
+    {state}
+    </document_state>
+    """
+
+BACKGROUND_TEMPLATE = """
     <background_info>
     {background}
     </background_info>
+    """
+
+# プロンプトキャッシュの指定（システムプロンプトと背景情報は全チャンクで共通のため、キャッシュから読み込ませる）
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# イベントループごとに保持する非同期用クライアント（非同期のHTTP接続はループをまたいで共有できないため）
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[Optional[str], str], ChatAnthropic]]" = weakref.WeakKeyDictionary()
+
+def create_system_prompt(with_context: bool = False, with_state: bool = False) -> str:
+    """
+    整文化のシステムプロンプトを作成します。
+    全チャンクで共通の指示だけを含め、チャンクやコンテキストはユーザーメッセージとして渡します。
+    
+    Args:
+        with_context: 前のチャンクのコンテキストを考慮する指示を含めるかどうか
+        with_state: 文書の状態を参照し、更新した状態を出力する指示を含めるかどうか（with_contextより優先）
+    
+    Returns:
+        システムプロンプト
+    """
+    base_prompt = """
+    <system_role>
+    あなたは文字起こしテキストを整理して整文化をするプロフェッショナルです。
+    ユーザーが渡す文字起こしテキストを、背景情報も考慮しながら整理された会話の発言録に書き直してください。
+    </system_role>
     
     <processing_instructions>
     - 話者の発言を明確に区別し、「話者A:」「話者B:」などのラベルを付けてください
@@ -42,12 +187,9 @@ def create_prompt_template(with_context: bool = False) -> str:
     </processing_instructions>
     """
     
-    context_template = """
-    <previous_content>
-    {previous_result}
-    </previous_content>
-    
+    context_prompt = """
     <additional_instructions>
+    - ユーザーメッセージの previous_content は前の部分の内容です
     - 前の部分との一貫性を保ってください
     - 同じ話者には同じラベルを使用してください
     - 話の流れが自然につながるようにしてください
@@ -55,23 +197,466 @@ def create_prompt_template(with_context: bool = False) -> str:
     </additional_instructions>
     """
     
+    state_prompt = """
+    <additional_instructions>
+    - ユーザーメッセージの document_state は、ここまでの部分から作成した話者・用語・要約の一覧です
+    - document_state の speakers にある話者には、同じラベルを使用してください
+    - document_state の glossary にある用語は、同じ表記を使用してください
+    - summary を参考にして、話の流れが自然につながるようにしてください
+    </additional_instructions>
+    
+    <output_format>
+    整文化したテキストの後に、次の形式で更新した文書の状態を出力してください。
+    <updated_document_state>
+    <speakers>
+    ラベル: 話者の説明（名前、役職、所属など）
+    </speakers>
+    <glossary>
+    用語や略語: 意味や統一する表記
+    </glossary>
+    <summary>
+    ここまでの内容全体の要約（1段落）
+    </summary>
+    </updated_document_state>
+    - speakers と glossary には、この部分で新しく出てきたものと説明が変わったものだけを1行に1つずつ書いてください
+    - summary は、document_state の要約にこの部分の内容を加えた1段落にしてください
+    </output_format>
+    """
+    
+    if with_state:
+        return base_prompt + state_prompt
     if with_context:
-        return base_template + context_template
+        return base_prompt + context_prompt
     else:
-        return base_template
+        return base_prompt
+
+# ChatAnthropicの代わりにクライアントを作成する関数（ベンチマークでローカルのモデルに差し替えるときに使う）
+_client_factory: Optional[Callable[[str, Optional[str]], "BaseChatModel"]] = None
+
+def set_client_factory(factory: Optional[Callable[[str, Optional[str]], "BaseChatModel"]]) -> None:
+    """
+    整文化や疑問点の生成に使うクライアントの作成方法を差し替えます。
+    
+    Args:
+        factory: モデル名とAPIキーを受け取ってLangChainのチャットモデルを返す関数（Noneの場合はChatAnthropicに戻す）
+    """
+    global _client_factory
+    _client_factory = factory
+
+@lru_cache(maxsize=MAX_CACHED_CLIENTS)
+def _create_client(api_key: Optional[str], model_name: str) -> "ChatAnthropic":
+    """
+    APIキーとモデル名の組ごとにChatAnthropicを作成し、HTTP接続を使い回します。
+    最近使った MAX_CACHED_CLIENTS 組だけを保持し、使われなくなったキーのクライアントは破棄します。
+    再試行はRequestSchedulerが行うため、クライアント側の再試行は無効にします。
+    出力はチャンクの大きさに合わせて長くなるため、モデルの最大出力トークン数まで許可します。
+    """
+    from langchain_anthropic import ChatAnthropic
+    return ChatAnthropic(model=model_name, anthropic_api_key=api_key, max_retries=0,
+                         max_tokens=get_model_limits(model_name)["max_output_tokens"])
 
-def get_anthropic_client(model_name: str = "claude-3-7-sonnet-latest") -> ChatAnthropic:
+def get_anthropic_client(model_name: str = "claude-3-7-sonnet-latest", api_key: Optional[str] = None) -> "ChatAnthropic":
     """
     Anthropicクライアントを取得します。
+    同じAPIキーとモデル名の組では、同じインスタンスを再利用します。
+    
+    Args:
+        model_name: 使用するAnthropicモデル名
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+    
+    Returns:
+        ChatAnthropicインスタンス
+    """
+    if api_key is None:
+        api_key = get_api_key()
+    if _client_factory is not None:
+        return _client_factory(model_name, api_key)
+    return _create_client(api_key, model_name)
+
+def get_async_anthropic_client(model_name: str = "claude-3-7-sonnet-latest", api_key: Optional[str] = None) -> "ChatAnthropic":
+    """
+    非同期処理用のAnthropicクライアントを取得します。
+    実行中のイベントループとAPIキー、モデル名の組ごとに同じインスタンスを再利用します。
     
     Args:
         model_name: 使用するAnthropicモデル名
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
     
     Returns:
         ChatAnthropicインスタンス
     """
-    api_key = st.session_state.get("anthropic_api_key")
-    return ChatAnthropic(model=model_name, anthropic_api_key=api_key)
+    if api_key is None:
+        api_key = get_api_key()
+    if _client_factory is not None:
+        return _client_factory(model_name, api_key)
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (api_key, model_name)
+    if key in clients:
+        # 最近使ったものとして末尾に移す
+        clients[key] = clients.pop(key)
+    else:
+        from langchain_anthropic import ChatAnthropic
+        clients[key] = ChatAnthropic(model=model_name, anthropic_api_key=api_key, max_retries=0,
+                                     max_tokens=get_model_limits(model_name)["max_output_tokens"])
+        # 同じループで多くのキーが使われた場合は、最も長く使われていないものから破棄する
+        while len(clients) > MAX_CACHED_CLIENTS:
+            clients.pop(next(iter(clients)))
+    return clients[key]
+
+def build_request(kind: str, inputs: dict) -> dict:
+    """
+    用途ごとのリクエストを、AnthropicのMessages APIの system と messages の形式で作成します。
+    システムプロンプトと背景情報はチャンクによらず同じなので、キャッシュ可能なブロックとして先頭に置きます。
+    
+    Args:
+        kind: プロンプトの種類（"chunk"、"context"、"state"、"questions"、"questions_reduce"のいずれか）
+        inputs: プロンプトに渡す入力（"chunk"・"context"・"state" は _chunk_inputs の戻り値、"questions" は transcript、
+                "questions_reduce" は疑問点の候補のリスト candidates）
+    
+    Returns:
+        "system"（コンテンツブロックのリスト）と "messages" を含む辞書
+    """
+    if kind == "questions":
+        system = [{"type": "text", "text": QUESTIONS_SYSTEM_PROMPT}]
+        user_text = TRANSCRIPT_TEMPLATE.format(text=inputs["transcript"])
+        return {"system": system, "messages": [{"role": "user", "content": user_text}]}
+    if kind == "questions_reduce":
+        system = [{"type": "text", "text": QUESTIONS_REDUCE_SYSTEM_PROMPT}]
+        user_text = "".join(CANDIDATE_QUESTIONS_TEMPLATE.format(part=i + 1, questions=questions)
+                            for i, questions in enumerate(inputs["candidates"]))
+        return {"system": system, "messages": [{"role": "user", "content": user_text}]}
+    
+    system = [{"type": "text", "text": create_system_prompt(with_context=(kind == "context"), with_state=(kind == "state"))}]
+    if inputs.get("background"):
+        system.append({"type": "text", "text": BACKGROUND_TEMPLATE.format(background=inputs["background"])})
+    # キャッシュの区切りは共通部分の最後のブロックに置く（背景情報がない場合は指示だけがキャッシュされる）
+    system[-1] = dict(system[-1], cache_control=CACHE_CONTROL)
+    
+    user_text = TRANSCRIPT_TEMPLATE.format(text=inputs["chunk"])
+    if kind == "context":
+        user_text = PREVIOUS_CONTENT_TEMPLATE.format(previous_result=inputs["previous_result"]) + user_text
+    elif kind == "state":
+        user_text = DOCUMENT_STATE_TEMPLATE.format(state=inputs["document_state"]) + user_text
+    return {"system": system, "messages": [{"role": "user", "content": user_text}]}
+
+def build_messages(kind: str, inputs: dict) -> List["BaseMessage"]:
+    """
+    build_request のリクエストを、ChatAnthropicに渡すメッセージのリストに変換します。
+    
+    Args:
+        kind: プロンプトの種類（"chunk"、"context"、"state"、"questions"、"questions_reduce"のいずれか）
+        inputs: プロンプトに渡す入力
+    
+    Returns:
+        システムメッセージとユーザーメッセージのリスト
+    """
+    from langchain_core.messages import HumanMessage, SystemMessage
+    request = build_request(kind, inputs)
+    return [SystemMessage(content=request["system"]),
+            *[HumanMessage(content=message["content"]) for message in request["messages"]]]
+
+def _estimate_request_tokens(messages: List["BaseMessage"]) -> int:
+    """
+    メッセージ全体の推定入力トークン数を求めます。
+    """
+    return sum(estimate_tokens(_message_text(message.content)) for message in messages)
+
+def _record_usage(scheduler: RequestScheduler, usage: Optional[dict], timer: Optional[CallTimer] = None) -> None:
+    """
+    1回の呼び出しのトークン使用量を表示し、呼び出したスケジューラの集計と呼び出しの記録に加えます。
+    入力トークン数にはキャッシュからの読み込みとキャッシュへの書き込みの分も含まれます。
+    """
+    if not usage:
+        return
+    details = usage.get("input_token_details") or {}
+    cache_read = details.get("cache_read", 0) or 0
+    cache_write = details.get("cache_creation", 0) or 0
+    logger.info(f"トークン使用量: 入力 {usage.get('input_tokens', 0)}（キャッシュ読み込み {cache_read} / "
+                f"キャッシュ書き込み {cache_write}）、出力 {usage.get('output_tokens', 0)}")
+    scheduler.record_usage(usage.get("input_tokens", 0), usage.get("output_tokens", 0), cache_read, cache_write)
+    if timer is not None:
+        timer.set_usage(usage.get("input_tokens", 0), usage.get("output_tokens", 0), cache_read, cache_write)
+
+def get_output_budget(kind: str, inputs: dict, model_name: str) -> int:
+    """
+    1回の呼び出しでリクエストする出力の上限を決めます。
+    整文化では、チャンクの推定トークン数にこれまでに記録した出力の倍率を掛けて見積もり、余裕を持たせます。
+    出力の大きさを見積もれない疑問点の生成では、モデルの最大出力トークン数を使います。
+    
+    Args:
+        kind: プロンプトの種類（build_request の kind）
+        inputs: プロンプトに渡す入力
+        model_name: 使用するAnthropicモデル名
+    
+    Returns:
+        max_tokens に指定するトークン数
+    """
+    max_output_tokens = get_model_limits(model_name)["max_output_tokens"]
+    if kind not in FORMALIZE_KINDS:
+        return max_output_tokens
+    reserved = STATE_OUTPUT_TOKENS if kind == "state" else 0
+    expected = estimate_tokens(inputs["chunk"]) * get_output_ratio_tracker(model_name).ratio + reserved
+    return max(MIN_OUTPUT_BUDGET, min(max_output_tokens, math.ceil(expected * OUTPUT_BUDGET_MARGIN)))
+
+def _continuation_messages(messages: List["BaseMessage"], output: str) -> List["BaseMessage"]:
+    """
+    途中で切れた出力の続きを生成させるため、これまでの出力をアシスタントの応答の書き出しとして加えます。
+    （書き出しの末尾の空白はAPIで受け付けられないため、呼び出し元で取り除いておきます）
+    """
+    from langchain_core.messages import AIMessage
+    return [*messages, AIMessage(content=output)]
+
+def _record_output_ratio(kind: str, inputs: dict, model_name: str, output: str) -> None:
+    """
+    整文化の出力が入力チャンクの何倍になったかを記録し、以降の出力の上限とチャンクの分割に使います。
+    """
+    if kind not in FORMALIZE_KINDS:
+        return
+    text = split_document_state(output)[0] if kind == "state" else output
+    get_output_ratio_tracker(model_name).record(estimate_tokens(inputs["chunk"]), estimate_tokens(text))
+
+def _warn_truncated(kind: str, model_name: str, continuation: int) -> None:
+    if continuation < MAX_CONTINUATIONS:
+        logger.info(f"出力の上限に達したため、続きを生成します（{kind}、{model_name}、{continuation + 1} 回目）")
+    else:
+        logger.warning(f"続きを {MAX_CONTINUATIONS} 回生成しても出力が終わりませんでした。途中までの出力を使います（{kind}、{model_name}）")
+
+def _invoke(kind: str, inputs: dict, model_name: str, api_key: Optional[str] = None):
+    """
+    メッセージを作成し、APIキーとモデルごとのスケジューラを通して同期的に呼び出します。
+    出力の上限に達して途中で切れた場合は、MAX_CONTINUATIONS 回まで続きを生成させて連結します。
+    """
+    messages = build_messages(kind, inputs)
+    client = get_anthropic_client(model_name, api_key)
+    scheduler = get_scheduler(model_name, api_key)
+    chunk_tokens = estimate_tokens(inputs["chunk"]) if kind in FORMALIZE_KINDS else None
+    max_tokens = get_output_budget(kind, inputs, model_name)
+    output = ""
+    for continuation in range(MAX_CONTINUATIONS + 1):
+        request = _continuation_messages(messages, output) if output else messages
+        with measure_call(kind, model_name) as timer:
+            timer.set_request(max_tokens, chunk_tokens, continuation)
+            result = scheduler.call(lambda: client.invoke(request, max_tokens=max_tokens),
+                                    _estimate_request_tokens(request), timer.scheduler_stats)
+            _record_usage(scheduler, result.usage_metadata, timer)
+            stop_reason = result.response_metadata.get("stop_reason")
+            timer.set_stop_reason(stop_reason)
+        output += _message_text(result.content)
+        if stop_reason != "max_tokens":
+            break
+        _warn_truncated(kind, model_name, continuation)
+        # 続きはモデルの最大出力トークン数まで生成させる
+        output = output.rstrip()
+        max_tokens = get_model_limits(model_name)["max_output_tokens"]
+    result.content = output
+    _record_output_ratio(kind, inputs, model_name, output)
+    return result
+
+def _stream(kind: str, inputs: dict, model_name: str, api_key: Optional[str] = None) -> Iterator[str]:
+    """
+    メッセージを作成し、APIキーとモデルごとのスケジューラを通してストリーミングで呼び出します。
+    受け取ったテキストの断片を順に返します。
+    出力の上限に達して途中で切れた場合は、MAX_CONTINUATIONS 回まで続きを生成させ、その断片も続けて返します。
+    返す断片を連結したテキストは、_invoke の結果と同じになります。
+    """
+    messages = build_messages(kind, inputs)
+    client = get_anthropic_client(model_name, api_key)
+    scheduler = get_scheduler(model_name, api_key)
+    chunk_tokens = estimate_tokens(inputs["chunk"]) if kind in FORMALIZE_KINDS else None
+    max_tokens = get_output_budget(kind, inputs, model_name)
+    from langchain_core.messages.ai import add_usage
+    pieces: List[str] = []
+    # まだ返していない末尾の空白（途中で切れた場合は _invoke と同じく取り除いてから続きを生成させるため）
+    held = ""
+    for continuation in range(MAX_CONTINUATIONS + 1):
+        output = "".join(pieces)
+        request = _continuation_messages(messages, output) if output else messages
+        usage = None
+        stop_reason = None
+        with measure_call(kind, model_name) as timer:
+            timer.set_request(max_tokens, chunk_tokens, continuation)
+            for message_chunk in scheduler.stream(lambda: client.stream(request, max_tokens=max_tokens),
+                                                  _estimate_request_tokens(request), timer.scheduler_stats):
+                if message_chunk.usage_metadata:
+                    usage = add_usage(usage, message_chunk.usage_metadata)
+                stop_reason = message_chunk.response_metadata.get("stop_reason") or stop_reason
+                text = _message_text(message_chunk.content)
+                if text:
+                    timer.first_token()
+                    pieces.append(text)
+                    visible = (held + text).rstrip()
+                    held = (held + text)[len(visible):]
+                    if visible:
+                        yield visible
+            _record_usage(scheduler, usage, timer)
+            timer.set_stop_reason(stop_reason)
+        if stop_reason != "max_tokens":
+            if held:
+                yield held
+            break
+        _warn_truncated(kind, model_name, continuation)
+        # 書き出しとして渡す出力と同じく、返していない末尾の空白は捨てる
+        held = ""
+        pieces = ["".join(pieces).rstrip()]
+        max_tokens = get_model_limits(model_name)["max_output_tokens"]
+    _record_output_ratio(kind, inputs, model_name, "".join(pieces))
+
+def _message_text(content) -> str:
+    """
+    メッセージの内容（文字列またはコンテンツブロックのリスト）からテキストを取り出します。
+    """
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+async def _ainvoke(kind: str, inputs: dict, model_name: str, api_key: Optional[str] = None,
+                   semaphore: Optional[asyncio.Semaphore] = None):
+    """
+    メッセージを作成し、APIキーとモデルごとのスケジューラを通して非同期に呼び出します。
+    出力の上限に達して途中で切れた場合は、MAX_CONTINUATIONS 回まで続きを生成させて連結します。
+    """
+    messages = build_messages(kind, inputs)
+    client = get_async_anthropic_client(model_name, api_key)
+    scheduler = get_scheduler(model_name, api_key)
+    chunk_tokens = estimate_tokens(inputs["chunk"]) if kind in FORMALIZE_KINDS else None
+    max_tokens = get_output_budget(kind, inputs, model_name)
+    output = ""
+    for continuation in range(MAX_CONTINUATIONS + 1):
+        request = _continuation_messages(messages, output) if output else messages
+        estimated_tokens = _estimate_request_tokens(request)
+        with measure_call(kind, model_name) as timer:
+            timer.set_request(max_tokens, chunk_tokens, continuation)
+            call = lambda: client.ainvoke(request, max_tokens=max_tokens)
+            if semaphore is None:
+                result = await scheduler.acall(call, estimated_tokens, timer.scheduler_stats)
+            else:
+                async with semaphore:
+                    result = await scheduler.acall(call, estimated_tokens, timer.scheduler_stats)
+            _record_usage(scheduler, result.usage_metadata, timer)
+            stop_reason = result.response_metadata.get("stop_reason")
+            timer.set_stop_reason(stop_reason)
+        output += _message_text(result.content)
+        if stop_reason != "max_tokens":
+            break
+        _warn_truncated(kind, model_name, continuation)
+        output = output.rstrip()
+        max_tokens = get_model_limits(model_name)["max_output_tokens"]
+    result.content = output
+    _record_output_ratio(kind, inputs, model_name, output)
+    return result
+
+def _chunk_inputs(chunk: str, background: Optional[str], previous_result: Optional[str] = None,
+                  state: Optional[DocumentState] = None) -> dict:
+    """
+    整文化プロンプトに渡す入力を作成します。
+    """
+    inputs = {"chunk": chunk, "background": background if background else ""}
+    if previous_result is not None:
+        inputs["previous_result"] = previous_result
+    if state is not None:
+        inputs["document_state"] = state.to_prompt()
+    return inputs
+
+def get_chunk_token_budget(model_name: str = "claude-3-7-sonnet-latest", background: Optional[str] = None,
+                           context_tokens: int = MAX_CONTEXT_TOKENS) -> int:
+    """
+    モデルの入出力の上限と、プロンプトテンプレート・背景情報・コンテキストの大きさから、
+    1チャンクに割り当てられる最大トークン数を求めます。
+    
+    Args:
+        model_name: 使用するAnthropicモデル名
+        background: 背景情報（オプション）
+        context_tokens: コンテキストに使うトークン数
+    
+    Returns:
+        split_transcript の max_tokens に渡すトークン数
+    """
+    system_tokens = max(estimate_tokens(create_system_prompt(with_context=True)),
+                        estimate_tokens(create_system_prompt(with_state=True)))
+    prompt_tokens = (system_tokens + estimate_tokens(background or "")
+                     + estimate_tokens(TRANSCRIPT_TEMPLATE) + estimate_tokens(PREVIOUS_CONTENT_TEMPLATE))
+    # どちらのコンテキストで処理しても収まるように、文書の状態の出力分を差し引いておく
+    return compute_chunk_tokens(model_name, prompt_tokens, context_tokens, reserved_output_tokens=STATE_OUTPUT_TOKENS)
+
+def _cache_owner(api_key: Optional[str] = None) -> Optional[str]:
+    """
+    キャッシュのエントリの所有者（APIキーの所有者の識別子）を求めます。
+    ほかの利用者の結果や統計が見えないように、キャッシュは所有者ごとに分けます。
+    """
+    api_key = api_key or get_api_key()
+    return owner_for_api_key(api_key) if api_key else None
+
+def _cache_key(model_name: str, chunk: str, background: Optional[str], previous_result: Optional[str] = None,
+               owner: Optional[str] = None) -> str:
+    """
+    整文化結果のキャッシュキーを作成します。
+    """
+    return ResultCache.make_key(model_name, PROMPT_TEMPLATE_VERSION, chunk, background if background else "", previous_result, owner)
+
+def _state_cache_key(model_name: str, chunk: str, background: Optional[str], state: DocumentState,
+                     owner: Optional[str] = None) -> str:
+    """
+    文書の状態を使った整文化結果のキャッシュキーを作成します。
+    キャッシュには、更新後の状態のブロックを含むモデルの出力全体を保存します。
+    """
+    return _cache_key(model_name, chunk, background, DOCUMENT_STATE_TEMPLATE.format(state=state.to_prompt()), owner)
+
+def split_for_output(chunk: str, model_name: str = "claude-3-7-sonnet-latest", reserved_output_tokens: int = 0,
+                     tracker: Optional[OutputRatioTracker] = None) -> List[str]:
+    """
+    これまでに記録した出力の倍率から、チャンクの整文化結果がモデルの出力の上限を超えると見込まれる場合に、チャンクを分割します。
+    分割した部分は同じチャンクの結果として順に整文化して連結するため、ジョブのチャンクの区切りは変わりません。
+    
+    Args:
+        chunk: 整文化する文字起こしチャンク
+        model_name: 使用するAnthropicモデル名
+        reserved_output_tokens: 整文化結果のほかに出力させるトークン数（文書の状態など）
+        tracker: 出力の倍率（省略時は get_output_ratio_tracker で取得し、run_job の中ではそのジョブの倍率を使う）
+    
+    Returns:
+        分割した部分のリスト（分割しない場合はチャンクだけのリスト）
+    """
+    ratio = (tracker or get_output_ratio_tracker(model_name)).ratio
+    limit = get_model_limits(model_name)["max_output_tokens"] * OUTPUT_SAFETY_MARGIN - reserved_output_tokens
+    chunk_tokens = estimate_tokens(chunk)
+    if chunk_tokens * ratio <= limit:
+        return [chunk]
+    parts = split_transcript(chunk, max(MIN_CHUNK_TOKENS, int(limit / ratio)))
+    if len(parts) > 1:
+        logger.info(f"出力がモデルの上限を超えると見込まれるため、チャンクを {len(parts)} つに分けて整文化します"
+                    f"（{chunk_tokens} トークン、出力の倍率 {ratio:.2f}）")
+    return parts if len(parts) > 1 else [chunk]
+
+def _formalize_parts(parts: List[str], background: Optional[str], model_name: str,
+                     previous_result: Optional[str] = None) -> str:
+    """
+    split_for_output で分けた部分を順に整文化して連結します。2つ目以降の部分は、直前の部分の結果をコンテキストにします。
+    """
+    results: List[str] = []
+    for part in parts:
+        context = results[-1] if results else previous_result
+        if context is None:
+            results.append(formalize_chunk(part, background, model_name))
+        else:
+            results.append(formalize_with_context(part, context, background, model_name))
+    return "\n".join(results)
+
+def _join_state_output(texts: List[str], state: DocumentState) -> str:
+    """
+    分けて整文化した部分の結果と最後の部分の後の文書の状態を、1回の呼び出しのモデルの出力と同じ形にまとめます。
+    """
+    return "\n".join(texts) + f"\n\n{STATE_START_TAG}\n{state.to_prompt()}\n{STATE_END_TAG}"
+
+def _apply_document_state(state: DocumentState, output: str) -> Tuple[str, DocumentState]:
+    """
+    モデルの出力を整文化されたテキストと更新後の状態に分け、状態を取り込みます。
+    状態のブロックがない場合は、元の状態をそのまま引き継ぎます。
+    """
+    text, update = split_document_state(output)
+    if update is None:
+        logger.warning("モデルの出力に更新後の文書の状態が含まれていません。直前の状態を引き継ぎます。")
+        return text, state
+    return text, state.merge(update)
 
 def formalize_chunk(chunk: str, background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest") -> str:
     """
@@ -85,18 +670,23 @@ def formalize_chunk(chunk: str, background: Optional[str] = None, model_name: st
     Returns:
         整文化されたテキスト
     """
-    # Anthropicモデルの初期化
-    llm = get_anthropic_client(model_name)
-    
-    # プロンプトテンプレートの作成
-    template = create_prompt_template(with_context=False)
-    prompt = ChatPromptTemplate.from_template(template)
+    # 同じ入力の結果がキャッシュにあれば再利用
+    cache = get_result_cache()
+    owner = _cache_owner()
+    key = _cache_key(model_name, chunk, background, owner=owner)
+    cached = cache.get(key, owner)
+    if cached is not None:
+        return cached
     
-    # 最新のLangChain APIを使用
-    chain = prompt | llm
-    result = chain.invoke({"chunk": chunk, "background": background if background else ""})
+    parts = split_for_output(chunk, model_name)
+    if len(parts) > 1:
+        result = _formalize_parts(parts, background, model_name)
+    else:
+        # 最新のLangChain APIを使用
+        result = _invoke("chunk", _chunk_inputs(chunk, background), model_name).content
     
-    return result.content
+    cache.set(key, result, owner)
+    return result
 
 def formalize_with_context(chunk: str, previous_result: str = "", background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest") -> str:
     """
@@ -111,114 +701,812 @@ def formalize_with_context(chunk: str, previous_result: str = "", background: Op
     Returns:
         整文化されたテキスト
     """
-    # Anthropicモデルの初期化
-    llm = get_anthropic_client(model_name)
+    # 同じ入力の結果がキャッシュにあれば再利用
+    cache = get_result_cache()
+    owner = _cache_owner()
+    key = _cache_key(model_name, chunk, background, previous_result, owner)
+    cached = cache.get(key, owner)
+    if cached is not None:
+        return cached
     
-    # プロンプトテンプレートの作成
-    template = create_prompt_template(with_context=True)
-    prompt = ChatPromptTemplate.from_template(template)
+    parts = split_for_output(chunk, model_name)
+    if len(parts) > 1:
+        result = _formalize_parts(parts, background, model_name, previous_result)
+    else:
+        # 最新のLangChain APIを使用
+        result = _invoke("context", _chunk_inputs(chunk, background, previous_result), model_name).content
     
-    # 最新のLangChain APIを使用
-    chain = prompt | llm
-    result = chain.invoke({
-        "chunk": chunk, 
-        "previous_result": previous_result, 
-        "background": background if background else ""
-    })
+    cache.set(key, result, owner)
+    return result
+
+def stream_formalize_chunk(chunk: str, background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest",
+                           previous_result: Optional[str] = None) -> Iterator[str]:
+    """
+    文字起こしチャンクを整文化し、生成されたテキストを届いた順に少しずつ返します。
+    previous_resultを指定した場合は、そのコンテキストを考慮して整文化します。
     
-    return result.content
+    Args:
+        chunk: 整文化する文字起こしチャンク
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+        previous_result: 前の部分のコンテキスト（オプション）
+    
+    Yields:
+        整文化されたテキストの断片
+    """
+    # 同じ入力の結果がキャッシュにあれば、まとめて返す
+    cache = get_result_cache()
+    owner = _cache_owner()
+    key = _cache_key(model_name, chunk, background, previous_result, owner)
+    cached = cache.get(key, owner)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = split_for_output(chunk, model_name)
+    if len(parts) > 1:
+        # 分けた部分を順に生成し、2つ目以降の部分は直前の部分の結果をコンテキストにする
+        results: List[str] = []
+        for part in parts:
+            if results:
+                yield "\n"
+            part_pieces = []
+            for text in stream_formalize_chunk(part, background, model_name, results[-1] if results else previous_result):
+                part_pieces.append(text)
+                yield text
+            results.append("".join(part_pieces))
+        cache.set(key, "\n".join(results), owner)
+        return
+    
+    kind = "chunk" if previous_result is None else "context"
+    pieces = []
+    for text in _stream(kind, _chunk_inputs(chunk, background, previous_result), model_name):
+        pieces.append(text)
+        yield text
+    
+    cache.set(key, "".join(pieces), owner)
+
+def formalize_with_state(chunk: str, state: Optional[DocumentState] = None, background: Optional[str] = None,
+                         model_name: str = "claude-3-7-sonnet-latest") -> Tuple[str, DocumentState]:
+    """
+    文書の状態（話者・用語・要約）を考慮して文字起こしチャンクを整文化し、状態を更新します。
+    直前の処理結果をそのまま渡す formalize_with_context よりプロンプトが小さく、
+    チャンクが進んでも話者ラベルや用語の表記が揃いやすくなります。
+    
+    Args:
+        chunk: 整文化する文字起こしチャンク
+        state: ここまでの文書の状態（省略時は空の状態）
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+    
+    Returns:
+        整文化されたテキストと、このチャンクを反映した文書の状態のタプル
+    """
+    state = state or DocumentState()
+    # 同じ入力の結果がキャッシュにあれば再利用
+    cache = get_result_cache()
+    owner = _cache_owner()
+    key = _state_cache_key(model_name, chunk, background, state, owner)
+    output = cache.get(key, owner)
+    if output is None:
+        parts = split_for_output(chunk, model_name, STATE_OUTPUT_TOKENS)
+        if len(parts) > 1:
+            # 分けた部分を順に整文化し、文書の状態を次の部分に引き継ぐ
+            texts = []
+            part_state = state
+            for part in parts:
+                text, part_state = formalize_with_state(part, part_state, background, model_name)
+                texts.append(text)
+            output = _join_state_output(texts, part_state)
+        else:
+            output = _invoke("state", _chunk_inputs(chunk, background, state=state), model_name).content
+        cache.set(key, output, owner)
+    return _apply_document_state(state, output)
+
+def stream_formalize_with_state(chunk: str, state: Optional[DocumentState] = None, background: Optional[str] = None,
+                                model_name: str = "claude-3-7-sonnet-latest",
+                                state_callback: Optional[Callable[[DocumentState], None]] = None) -> Iterator[str]:
+    """
+    文書の状態を考慮して文字起こしチャンクを整文化し、生成されたテキストを届いた順に少しずつ返します。
+    更新後の状態のブロックは返さず、生成の終了後に state_callback に渡します。
+    
+    Args:
+        chunk: 整文化する文字起こしチャンク
+        state: ここまでの文書の状態（省略時は空の状態）
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+        state_callback: このチャンクを反映した文書の状態を受け取るコールバック関数（オプション）
+    
+    Yields:
+        整文化されたテキストの断片
+    """
+    state = state or DocumentState()
+    # 同じ入力の結果がキャッシュにあれば、まとめて返す
+    cache = get_result_cache()
+    owner = _cache_owner()
+    key = _state_cache_key(model_name, chunk, background, state, owner)
+    output = cache.get(key, owner)
+    parts = split_for_output(chunk, model_name, STATE_OUTPUT_TOKENS) if output is None else [chunk]
+    if output is not None:
+        text, new_state = _apply_document_state(state, output)
+        yield text
+    elif len(parts) > 1:
+        # 分けた部分を順に生成し、文書の状態を次の部分に引き継ぐ
+        texts: List[str] = []
+        part_state = state
+        
+        def update_part_state(new_part_state: DocumentState) -> None:
+            nonlocal part_state
+            part_state = new_part_state
+        
+        for part in parts:
+            if texts:
+                yield "\n"
+            part_pieces = []
+            for text in stream_formalize_with_state(part, part_state, background, model_name, update_part_state):
+                part_pieces.append(text)
+                yield text
+            texts.append("".join(part_pieces))
+        output = _join_state_output(texts, part_state)
+        cache.set(key, output, owner)
+        _, new_state = _apply_document_state(state, output)
+    else:
+        pieces = []
+        
+        def collect() -> Iterator[str]:
+            for text in _stream("state", _chunk_inputs(chunk, background, state=state), model_name):
+                pieces.append(text)
+                yield text
+        
+        yield from strip_document_state(collect())
+        output = "".join(pieces)
+        cache.set(key, output, owner)
+        _, new_state = _apply_document_state(state, output)
+    
+    if state_callback:
+        state_callback(new_state)
+
+async def aformalize_chunk(chunk: str, background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest",
+                           previous_result: Optional[str] = None, api_key: Optional[str] = None,
+                           semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    """
+    文字起こしチャンクを非同期に整文化します。
+    previous_resultを指定した場合は、そのコンテキストを考慮して整文化します。
+    
+    Args:
+        chunk: 整文化する文字起こしチャンク
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+        previous_result: 前の部分のコンテキスト（オプション）
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+        semaphore: 同時実行数を制限するセマフォ（オプション）
+    
+    Returns:
+        整文化されたテキスト
+    """
+    # 同じ入力の結果がキャッシュにあれば再利用
+    cache = get_result_cache()
+    owner = _cache_owner(api_key)
+    key = _cache_key(model_name, chunk, background, previous_result, owner)
+    cached = cache.get(key, owner)
+    if cached is not None:
+        return cached
+    
+    parts = split_for_output(chunk, model_name)
+    if len(parts) > 1:
+        # 分けた部分を順に整文化し、2つ目以降の部分は直前の部分の結果をコンテキストにする
+        results: List[str] = []
+        for part in parts:
+            results.append(await aformalize_chunk(part, background, model_name, results[-1] if results else previous_result,
+                                                  api_key, semaphore))
+        result = "\n".join(results)
+    else:
+        kind = "chunk" if previous_result is None else "context"
+        result = (await _ainvoke(kind, _chunk_inputs(chunk, background, previous_result), model_name, api_key, semaphore)).content
+    
+    cache.set(key, result, owner)
+    return result
+
+async def aformalize_transcript(transcript: str, background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest",
+                                max_tokens: Optional[int] = None, overlap: int = 200, mode: str = "parallel",
+                                max_concurrency: int = MAX_CONCURRENCY, api_key: Optional[str] = None,
+                                semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    """
+    文字起こしテキスト全体を非同期に整文化します。
+    複数の文字起こしを同時に処理する場合は、共有のsemaphoreを渡すとプロセス全体の同時実行数を制限できます。
+    
+    Args:
+        transcript: 整文化する文字起こしテキスト全体
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+        max_tokens: 各チャンクの最大トークン数（省略時はモデルの入出力の上限から決定）
+        overlap: チャンク間のオーバーラップトークン数
+        mode: 処理モード（"parallel" は軽量なコンテキストで同時に処理、"sequential" は直前の結果を使って順に処理）
+        max_concurrency: semaphoreを省略した場合の同時実行数の上限
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+        semaphore: 同時実行数を制限するセマフォ（オプション）
+    
+    Returns:
+        整文化された完全なテキスト
+    """
+    if max_tokens is None:
+        max_tokens = get_chunk_token_budget(model_name, background)
+    chunks = split_transcript(transcript, max_tokens, overlap)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        # 指定した同時実行数を最初から使えるように、スケジューラの同時実行数の上限を引き上げる
+        get_scheduler(model_name, api_key).seed_concurrency(max_concurrency)
+    
+    async def process(index: int, context: Optional[str]) -> str:
+        with chunk_scope(index):
+            return await aformalize_chunk(chunks[index], background, model_name, context, api_key, semaphore)
+    
+    if mode == "sequential":
+        processed_chunks = []
+        for i in range(len(chunks)):
+            context = build_context_window(processed_chunks)[0] if processed_chunks else None
+            processed_chunks.append(await process(i, context))
+        return "\n".join(processed_chunks)
+    
+    speakers = extract_speakers(transcript)
+    processed_chunks = await asyncio.gather(*[
+        process(i, build_light_context(chunks, i, speakers) or None) for i in range(len(chunks))
+    ])
+    return "\n".join(processed_chunks)
 
-def formalize_transcript(transcript: str, background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest", max_tokens: int = 8000, overlap: int = 200) -> str:
+def formalize_transcript(transcript: str, background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest", max_tokens: Optional[int] = None, overlap: int = 200) -> str:
     """
     文字起こしテキスト全体を整文化します。transcript_splitterを使用してテキストを分割し、
     文脈を維持しながら処理します。
+    処理はジョブとしてチェックポイントに保存されるため、途中で失敗した場合は
+    ログに出力されたジョブIDを resume_job に渡して未処理のチャンクだけを再実行できます。
     
     Args:
         transcript: 整文化する文字起こしテキスト全体
         background: 背景情報（オプション）
         model_name: 使用するAnthropicモデル名
-        max_tokens: 各チャンクの最大トークン数
+        max_tokens: 各チャンクの最大トークン数（省略時はモデルの入出力の上限から決定）
         overlap: チャンク間のオーバーラップトークン数
     
     Returns:
         整文化された完全なテキスト
     """
     # transcript_splitterを使用してテキストを分割
+    if max_tokens is None:
+        max_tokens = get_chunk_token_budget(model_name, background)
     chunks = split_transcript(transcript, max_tokens, overlap)
-    print(f"テキストを {len(chunks)} チャンクに分割しました。")
+    logger.info(f"テキストを {len(chunks)} チャンクに分割しました。")
+    
+    job = create_job(chunks, {"background": background, "model_name": model_name, "mode": "sequential",
+                              "context_mode": CONTEXT_MODE})
+    logger.info(f"ジョブID: {job.job_id}")
+    
+    result = "\n".join(run_job(job))
+    delete_job(job.job_id)
+    return result
+
+def run_job(job: Job, progress_callback: Optional[Callable[[int, int], None]] = None,
+            executor: Optional[ThreadPoolExecutor] = None, router: Optional[ModelRouter] = None) -> List[str]:
+    """
+    ジョブの未処理のチャンクを整文化し、完了したチャンクごとにチェックポイントを更新します。
+    設定に "routing"（ModelRouterの引数の辞書）がある場合は、チャンクの難易度に応じてモデルを切り替えます。
+    出力の上限とチャンクの分割には、このジョブで記録した出力の倍率を使います（output_ratio_scope）。
+    難易度の判定では、設定の "removed_filler_density"（正規化で取り除いたフィラーの密度）を加えます。
+    
+    Args:
+        job: 実行するジョブ
+        progress_callback: 完了したチャンク数と総チャンク数を受け取るコールバック関数（オプション）
+        executor: 並列処理モードでチャンクの処理に使う共有のスレッドプール（省略時はジョブごとに作成）
+        router: 複数のジョブで共有するModelRouter（省略時は設定の "routing" から作成）
+    
+    Returns:
+        整文化されたテキストのリスト（チャンクと同じ順序）
+    """
+    settings = job.settings
+    background = settings.get("background")
+    model_name = settings.get("model_name", "claude-3-7-sonnet-latest")
+    owns_router = router is None and bool(settings.get("routing"))
+    if owns_router:
+        router = ModelRouter(strong_model=model_name, **settings["routing"])
+    previous = load_previous_results(job)
+    
+    def save(index: int, result: str) -> None:
+        record_result(job, index, result)
+    
+    # 出力の倍率はジョブごとに記録し、ほかのジョブや利用者の文字起こしの影響を受けないようにする
+    with output_ratio_scope(), removed_fillers_scope(settings.get("removed_filler_density", 0.0)):
+        if settings.get("mode") == "parallel":
+            formalize_chunks_parallel(job.chunks, background, model_name, settings.get("max_workers", 4),
+                                      progress_callback, completed=job.results, result_callback=save, executor=executor,
+                                      router=router, previous=previous)
+        else:
+            state = DocumentState.from_dict(job.document_state)
+        
+            def update_state(new_state: DocumentState) -> None:
+                nonlocal state
+                state = new_state
+        
+            def save_with_progress(index: int, result: str) -> None:
+                # 文書の状態も一緒に保存し、再開時に続きのチャンクへ引き継げるようにする
+                record_result(job, index, result, document_state=state.to_dict())
+                if progress_callback:
+                    progress_callback(len(job.results), len(job.chunks))
+        
+            formalize_chunks_with_context(job.chunks, background, model_name, completed=job.results,
+                                          result_callback=save_with_progress,
+                                          context_mode=settings.get("context_mode", CONTEXT_MODE),
+                                          state=state, state_callback=update_state, router=router, previous=previous)
+    
+    if owns_router:
+        logger.info(f"モデルごとの処理結果:\n{router.format_report()}")
+    return job.ordered_results()
+
+def match_previous_results(previous_job: Job, chunks: List[str]) -> Dict[int, PreviousResult]:
+    """
+    前回のジョブのチャンクと今回のチャンクを比較し、内容が同じチャンクの前回の結果を集めます。
+    チャンクの挿入や削除で位置がずれても、同じ内容のチャンクを対応付けます。
+    
+    Args:
+        previous_job: 前回のジョブ
+        chunks: 今回のチャンクのリスト
+    
+    Returns:
+        今回のチャンクの位置と、前回の結果の辞書
+    """
+    settings = previous_job.settings
+    old_chunks = previous_job.chunks
+    parallel = settings.get("mode") == "parallel"
+    context_mode = settings.get("context_mode", CONTEXT_MODE)
+    speakers = extract_speakers("\n".join(old_chunks)) if parallel else None
+    
+    matches = {}
+    matcher = difflib.SequenceMatcher(None, old_chunks, chunks, autojunk=False)
+    for block in matcher.get_matching_blocks():
+        for offset in range(block.size):
+            old, new = block.a + offset, block.b + offset
+            if old not in previous_job.results:
+                continue
+            if parallel:
+                context = build_light_context(old_chunks, old, speakers) or None
+            elif context_mode == "state" or old == 0:
+                context = None
+            else:
+                context = build_context_window([previous_job.results[i] for i in range(max(0, old - CONTEXT_WINDOW), old)])[0]
+            state_before = DocumentState.from_dict(previous_job.chunk_states.get(old - 1)) if old > 0 else DocumentState()
+            state_after = DocumentState.from_dict(previous_job.chunk_states[old]) if old in previous_job.chunk_states else None
+            matches[new] = PreviousResult(previous_job.results[old], context, state_before, state_after)
+    return matches
+
+def load_previous_results(job: Job) -> Dict[int, PreviousResult]:
+    """
+    ジョブの設定の "previous_job_id" が指す前回のジョブから、再利用できる可能性のある結果を読み込みます。
+    
+    Args:
+        job: これから実行するジョブ
+    
+    Returns:
+        チャンクの位置と前回の結果の辞書（前回のジョブがない場合は空の辞書）
+    """
+    previous_job_id = job.settings.get("previous_job_id")
+    if not previous_job_id:
+        return {}
+    try:
+        previous_job = load_job(previous_job_id)
+    except (OSError, ValueError, TypeError):
+        logger.warning(f"前回のジョブ {previous_job_id} を読み込めないため、すべてのチャンクを処理します")
+        return {}
+    previous = match_previous_results(previous_job, job.chunks)
+    logger.info(f"前回のジョブ {previous_job_id} と {len(previous)}/{len(job.chunks)} チャンクが一致しました")
+    return previous
+
+def resume_job(job_id: str, progress_callback: Optional[Callable[[int, int], None]] = None) -> str:
+    """
+    保存されたジョブを再開し、未処理のチャンクだけを整文化します。
+    
+    Args:
+        job_id: 再開するジョブのID
+        progress_callback: 進捗状況を更新するコールバック関数（並列処理モードのみ、オプション）
+    
+    Returns:
+        整文化された完全なテキスト
+    """
+    job = load_job(job_id)
+    logger.info(f"ジョブ {job_id} を再開します（未処理: {len(job.missing_indices)}/{len(job.chunks)} チャンク）")
+    
+    result = "\n".join(run_job(job, progress_callback))
+    delete_job(job_id)
+    return result
+
+def build_context_window(previous_results: List[str], context_window: int = CONTEXT_WINDOW,
+                         max_context_tokens: int = MAX_CONTEXT_TOKENS) -> Tuple[str, int]:
+    """
+    直前のチャンクの処理結果から、トークン数に上限のあるコンテキストを作成します。
+    新しい結果を優先し、上限を超える場合は古い結果の末尾側だけを残します。
+    
+    Args:
+        previous_results: これまでのチャンクの処理結果のリスト
+        context_window: 参照する直前のチャンク数
+        max_context_tokens: コンテキストの最大トークン数
+    
+    Returns:
+        コンテキスト文字列と、その推定トークン数のタプル
+    """
+    recent_results = previous_results[-context_window:] if context_window > 0 else []
+    
+    selected = []
+    remaining_tokens = max_context_tokens
+    for result in reversed(recent_results):
+        tokens = estimate_tokens(result)
+        if tokens > remaining_tokens:
+            # 上限に収まらない場合は末尾側だけを残して打ち切る
+            truncated = truncate_to_last_tokens(result, remaining_tokens)
+            if truncated:
+                selected.append(truncated)
+            break
+        selected.append(result)
+        remaining_tokens -= tokens
     
-    return formalize_chunks_with_context(chunks, background, model_name)
+    context = "\n\n".join(reversed(selected))
+    return context, estimate_tokens(context)
 
-def formalize_chunks_with_context(chunks: List[str], background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest") -> str:
+def formalize_chunks_with_context(chunks: List[str], background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest",
+                                  context_window: int = CONTEXT_WINDOW, max_context_tokens: int = MAX_CONTEXT_TOKENS,
+                                  completed: Optional[Dict[int, str]] = None,
+                                  result_callback: Optional[Callable[[int, str], None]] = None,
+                                  context_mode: str = CONTEXT_MODE, state: Optional[DocumentState] = None,
+                                  state_callback: Optional[Callable[[DocumentState], None]] = None,
+                                  router: Optional[ModelRouter] = None,
+                                  previous: Optional[Dict[int, PreviousResult]] = None) -> str:
     """
     複数の文字起こしチャンクを文脈を維持しながら整文化します。
+    "state" モードでは話者・用語・要約からなる文書の状態を、"previous" モードでは
+    直前の処理結果から作成した上限付きのコンテキストを各チャンクに渡すため、
+    チャンクあたりのプロンプトサイズはテキスト全体の長さに依存しません。
     
     Args:
         chunks: 整文化する文字起こしチャンクのリスト
         background: 背景情報（オプション）
         model_name: 使用するAnthropicモデル名
+        context_window: コンテキストとして参照する直前のチャンク数
+        max_context_tokens: コンテキストの最大トークン数
+        completed: 処理済みのチャンクの位置と結果の辞書（再開時、オプション）
+        result_callback: チャンクの位置と結果を受け取るコールバック関数（オプション）
+        context_mode: 次のチャンクに渡すコンテキスト（"state" または "previous"）
+        state: 処理済みのチャンクまでを反映した文書の状態（"state" モードでの再開時、オプション）
+        state_callback: チャンクごとに更新された文書の状態を受け取るコールバック関数（result_callbackより先に呼ばれる、オプション）
+        router: チャンクの難易度に応じてモデルを選ぶModelRouter（省略時はすべてmodel_nameで処理）
+        previous: 前回の実行の結果（match_previous_results の戻り値）。チャンクとコンテキストが同じ場合は再利用する（オプション）
     
     Returns:
         整文化された完全なテキスト
     """
-    accumulated_result = ""
+    completed = dict(completed or {})
+    previous = previous or {}
+    processed_chunks = []
+    
+    if context_mode == "state":
+        state = state or DocumentState()
+        for i, chunk in enumerate(chunks):
+            if i in completed:
+                processed_chunks.append(completed[i])
+                continue
+            
+            reusable = previous.get(i)
+            if reusable is not None and reusable.state_after is not None and reusable.state_before.has_same_entries(state):
+                # 前回と同じチャンクを同じ話者・用語で処理していれば、前回の結果と状態を引き継ぐ
+                logger.info(f"チャンク {i+1}/{len(chunks)} は前回の結果を再利用します")
+                result, state = reusable.result, reusable.state_after
+            else:
+                logger.info(f"チャンク {i+1}/{len(chunks)} を処理中...（文書の状態: {estimate_tokens(state.to_prompt())} トークン）")
+                with chunk_scope(i):
+                    result, state = _run_routed(router, model_name, chunk,
+                                                lambda model: formalize_with_state(chunk, state, background, model),
+                                                lambda output: output[0])
+            processed_chunks.append(result)
+            if state_callback:
+                state_callback(state)
+            if result_callback:
+                result_callback(i, result)
+        return "\n".join(processed_chunks)
     
     for i, chunk in enumerate(chunks):
-        print(f"チャンク {i+1}/{len(chunks)} を処理中...")
+        if i in completed:
+            # 処理済みのチャンクは保存された結果を使う
+            processed_chunks.append(completed[i])
+            continue
         
-        if i == 0:
+        context = build_context_window(processed_chunks, context_window, max_context_tokens)[0] if i > 0 else None
+        reusable = previous.get(i)
+        if reusable is not None and reusable.context == context:
+            # 前回と同じチャンクを同じコンテキストで処理していれば、前回の結果を使う
+            logger.info(f"チャンク {i+1}/{len(chunks)} は前回の結果を再利用します")
+            processed_chunks.append(reusable.result)
+        elif i == 0:
+            logger.info(f"チャンク {i+1}/{len(chunks)} を処理中...")
             # 最初のチャンクは通常の方法で処理
-            accumulated_result = formalize_chunk(chunk, background, model_name)
+            with chunk_scope(i):
+                processed_chunks.append(_run_routed(router, model_name, chunk,
+                                                    lambda model: formalize_chunk(chunk, background, model)))
+        else:
+            # 2つ目以降のチャンクは直前の結果から作成したコンテキストを考慮して処理
+            logger.info(f"チャンク {i+1}/{len(chunks)} を処理中...（コンテキスト: {estimate_tokens(context)} トークン）")
+            with chunk_scope(i):
+                processed_chunks.append(_run_routed(router, model_name, chunk,
+                                                    lambda model: formalize_with_context(chunk, context, background, model)))
+        
+        if result_callback:
+            result_callback(i, processed_chunks[-1])
+    
+    # 自然な接続のために単純に連結（改行を減らす）
+    return "\n".join(processed_chunks)
+
+def _run_routed(router: Optional[ModelRouter], model_name: str, chunk: str, call: Callable[[str], T],
+                text: Callable[[T], str] = lambda output: output) -> T:
+    """
+    ModelRouterが選んだモデルでチャンクを処理し、結果が不完全に見える場合は強いモデルで処理し直します。
+    routerがない場合は model_name で処理します。
+    
+    Args:
+        router: モデルを選ぶModelRouter（オプション）
+        model_name: routerがない場合に使うモデル名
+        chunk: 文字起こしチャンク
+        call: モデル名を受け取ってチャンクを処理する関数
+        text: callの戻り値から整文化されたテキストを取り出す関数
+    
+    Returns:
+        callの戻り値
+    """
+    if router is None:
+        return call(model_name)
+    
+    model = router.route(chunk)
+    started = time.monotonic()
+    output = call(model)
+    router.record(model, time.monotonic() - started)
+    if router.should_escalate(model, chunk, text(output)):
+        logger.info(f"{model} の結果が不完全な可能性があるため、{router.strong_model} で処理し直します")
+        started = time.monotonic()
+        output = call(router.strong_model)
+        router.record(router.strong_model, time.monotonic() - started, escalated=True)
+    return output
+
+def stream_routed(router: Optional[ModelRouter], model_name: str, chunk: str, stream: Callable[[str], Iterable[str]],
+                  partial_callback: Optional[Callable[[str], None]] = None) -> str:
+    """
+    ModelRouterが選んだモデルでチャンクをストリーミングで処理し、結果が不完全に見える場合は強いモデルで生成し直します。
+    生成し直す場合は、partial_callback に最初から生成し直したテキストを渡します。
+    
+    Args:
+        router: モデルを選ぶModelRouter（省略時は model_name で処理）
+        model_name: routerがない場合に使うモデル名
+        chunk: 文字起こしチャンク
+        stream: モデル名を受け取って、整文化されたテキストの断片を返す関数
+        partial_callback: 生成済みのテキストを受け取るコールバック関数（オプション）
+    
+    Returns:
+        整文化されたテキスト
+    """
+    def call(model: str) -> str:
+        result = ""
+        for text in stream(model):
+            result += text
+            if partial_callback:
+                partial_callback(result)
+        return result
+    
+    return _run_routed(router, model_name, chunk, call)
+
+def build_light_context(chunks: List[str], index: int, speakers: Optional[List[str]] = None) -> str:
+    """
+    並列処理用の軽量なコンテキストを作成します。
+    前のチャンクの処理結果ではなく、直前チャンクの原文と話者一覧だけを使うため、
+    各チャンクを互いに待たずに処理できます。
+    
+    Args:
+        chunks: 文字起こしチャンクのリスト
+        index: コンテキストを作成する対象チャンクの位置
+        speakers: 文字起こし全体の話者一覧（オプション）
+    
+    Returns:
+        コンテキスト文字列（コンテキストがない場合は空文字列）
+    """
+    parts = []
+    if speakers:
+        parts.append("登場する話者: " + "、".join(speakers))
+    if index > 0:
+        parts.append("直前の部分（整文化前の原文）:\n" + chunks[index - 1])
+    return "\n\n".join(parts)
+
+def formalize_chunks_parallel(chunks: List[str], background: Optional[str] = None, model_name: str = "claude-3-7-sonnet-latest",
+                              max_workers: int = 4, progress_callback: Optional[Callable[[int, int], None]] = None,
+                              completed: Optional[Dict[int, str]] = None,
+                              result_callback: Optional[Callable[[int, str], None]] = None,
+                              executor: Optional[ThreadPoolExecutor] = None,
+                              router: Optional[ModelRouter] = None,
+                              previous: Optional[Dict[int, PreviousResult]] = None,
+                              partial_callback: Optional[Callable[[int, str], None]] = None) -> List[str]:
+    """
+    複数の文字起こしチャンクを並列に整文化します。
+    各チャンクは軽量なコンテキスト（直前チャンクの原文と話者一覧）で処理し、
+    結果は入力と同じ順序で返します。
+    partial_callback を指定した場合は、処理中の各チャンクをストリーミングで生成し、生成済みのテキストを順に渡します。
+    
+    Args:
+        chunks: 整文化する文字起こしチャンクのリスト
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+        max_workers: 同時に実行するリクエスト数の上限
+        progress_callback: 完了したチャンク数と総チャンク数を受け取るコールバック関数（オプション）
+        completed: 処理済みのチャンクの位置と結果の辞書（再開時、オプション）
+        result_callback: チャンクの位置と結果を受け取るコールバック関数（オプション）
+        executor: 複数の文字起こしで共有するスレッドプール（省略時はmax_workersで作成し、終了時に破棄）
+        router: チャンクの難易度に応じてモデルを選ぶModelRouter（省略時はすべてmodel_nameで処理）
+        previous: 前回の実行の結果（match_previous_results の戻り値）。チャンクとコンテキストが同じ場合は再利用する（オプション）
+        partial_callback: チャンクの位置と生成中のテキストを受け取るコールバック関数（ワーカースレッドから呼ばれる、オプション）
+    
+    Returns:
+        整文化されたテキストのリスト（チャンクと同じ順序）
+    """
+    speakers = extract_speakers("\n".join(chunks))
+    results: List[Optional[str]] = [None] * len(chunks)
+    
+    # 処理済みのチャンクは保存された結果を使い、未処理のチャンクだけを送信する
+    for index, result in (completed or {}).items():
+        results[index] = result
+    reused = []
+    for index, reusable in (previous or {}).items():
+        # 前回と同じチャンクを同じコンテキストで処理していれば、前回の結果を使う
+        if results[index] is None and reusable.context == (build_light_context(chunks, index, speakers) or None):
+            results[index] = reusable.result
+            reused.append(index)
+    if reused:
+        logger.info(f"{len(reused)}/{len(chunks)} チャンクは前回の結果を再利用します")
+        if result_callback:
+            for index in reused:
+                result_callback(index, results[index])
+    pending = [i for i in range(len(chunks)) if results[i] is None]
+    # 指定した同時実行数を最初から使えるように、スケジューラの同時実行数の上限を引き上げる
+    for model in (router.models if router is not None else [model_name]):
+        get_scheduler(model).seed_concurrency(max_workers)
+    
+    def process(index: int) -> str:
+        context = build_light_context(chunks, index, speakers) or None
+        
+        def call(model: str) -> str:
+            if context is None:
+                return formalize_chunk(chunks[index], background, model)
+            return formalize_with_context(chunks[index], context, background, model)
+        
+        with chunk_scope(index):
+            if partial_callback is None:
+                return _run_routed(router, model_name, chunks[index], call)
+            # 結果のキャッシュは formalize_chunk・formalize_with_context と共通
+            return stream_routed(router, model_name, chunks[index],
+                                 lambda model: stream_formalize_chunk(chunks[index], background, model, context),
+                                 lambda text: partial_callback(index, text))
+    
+    # ワーカースレッドからもセッションステートを参照できるようにStreamlitのコンテキストを引き継ぐ
+    owns_executor = executor is None
+    if owns_executor:
+        executor = create_thread_pool(max(1, max_workers))
+    error = None
+    done = len(chunks) - len(pending)
+    futures = {}
+    try:
+        # 呼び出しの記録先（PerformanceRecorder）をワーカースレッドに引き継ぐため、チャンクごとにコンテキストを複製する
+        futures = {executor.submit(contextvars.copy_context().run, process, i): i for i in pending}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                if error is None:
+                    # 失敗時は未着手のチャンクを取り消し、実行中のチャンクの結果は最後まで受け取る
+                    error = e
+                    for pending_future in futures:
+                        pending_future.cancel()
+                continue
+            done += 1
+            if result_callback:
+                result_callback(index, results[index])
+            if progress_callback:
+                progress_callback(done, len(chunks))
+    finally:
+        if owns_executor:
+            executor.shutdown(wait=True, cancel_futures=True)
         else:
-            # 2つ目以降のチャンクは前の結果を考慮して処理
-            next_part = formalize_with_context(chunk, accumulated_result, background, model_name)
-            # 自然な接続のために単純に連結（改行を減らす）
-            accumulated_result = accumulated_result + "\n" + next_part
+            # 共有のスレッドプールは破棄せず、このテキストの未着手のチャンクだけを取り消す
+            for future in futures:
+                future.cancel()
     
-    return accumulated_result
+    if error is not None:
+        raise error
+    
+    return results
+
+def use_map_reduce_for_questions(transcript: str, model_name: str = "claude-3-7-sonnet-latest") -> bool:
+    """
+    疑問点の生成をmap-reduceで行うかどうかを、文字起こしの推定トークン数から判定します。
+    
+    Args:
+        transcript: 分析する文字起こしテキスト
+        model_name: 使用するAnthropicモデル名
+    
+    Returns:
+        map-reduceで処理する場合はTrue
+    """
+    limits = get_model_limits(model_name)
+    # 1回のプロンプトに収まらない場合は、しきい値にかかわらずmap-reduceにする
+    max_input_tokens = limits["context_window"] - limits["max_output_tokens"] - estimate_tokens(QUESTIONS_SYSTEM_PROMPT)
+    return estimate_tokens(transcript) > min(QUESTIONS_SINGLE_SHOT_TOKENS, max_input_tokens)
 
-def generate_questions(transcript: str, model_name: str = "claude-3-7-sonnet-latest") -> str:
+def generate_questions(transcript: str, model_name: str = "claude-3-7-sonnet-latest", mode: str = "auto",
+                       max_workers: int = MAX_CONCURRENCY) -> str:
     """
     文字起こしテキストを分析し、文脈理解のための疑問点を生成します。
+    長いテキストはチャンクに分割して各チャンクの疑問点の候補を並列に生成し（map）、
+    最後に1回の呼び出しで重複を除いて重要度順にまとめます（reduce）。
     
     Args:
         transcript: 分析する文字起こしテキスト
         model_name: 使用するAnthropicモデル名
+        mode: 処理方法（"auto" は推定トークン数から判定、"single" は1回で生成、"map_reduce" は分割して生成）
+        max_workers: map-reduceでチャンクを同時に処理する数の上限
     
     Returns:
         生成された疑問点のリスト（マークダウン形式）
     """
-    # Anthropicモデルの初期化
-    llm = get_anthropic_client(model_name)
+    if mode == "single" or (mode == "auto" and not use_map_reduce_for_questions(transcript, model_name)):
+        # 最新のLangChain APIを使用
+        result = _invoke("questions", {"transcript": transcript}, model_name)
+        return result.content
     
-    # プロンプトテンプレートの作成
-    template = """
-    <system_role>
-    あなたは文字起こしテキストを分析し、文脈理解のために必要な疑問点を抽出するプロフェッショナルです。
-    以下の文字起こしテキストを読み、文脈を理解する上で不明確な点や背景情報が必要な点について、
-    5〜10個程度の具体的な疑問を生成してください。
-    </system_role>
-
-    <input_transcript>
-    {transcript}
-    </input_transcript>
+    chunks = split_transcript(transcript, QUESTIONS_CHUNK_TOKENS)
+    logger.info(f"疑問点をmap-reduceで生成します（{len(chunks)} チャンク）")
+    if len(chunks) == 1:
+        return _invoke("questions", {"transcript": chunks[0]}, model_name).content
     
-    <processing_instructions>
-    - テキストの内容を深く理解するために必要な疑問点を抽出してください
-    - 専門用語や略語の意味に関する疑問を含めてください
-    - 話者の関係性や立場に関する疑問を含めてください
-    - 議論されているプロジェクトや事象の背景に関する疑問を含めてください
-    - 時系列や因果関係が不明確な部分に関する疑問を含めてください
-    - 具体的で明確な質問を作成してください
-    - 質問は箇条書きでマークダウン形式で出力してください
-    - 各質問の重要度や優先度に応じて並べ替えてください
-    </processing_instructions>
+    # ワーカースレッドからもセッションステートを参照できるようにStreamlitのコンテキストを引き継ぐ
+    # （use_api_key で指定されたAPIキーも引き継ぐため、チャンクごとにコンテキストを複製する）
+    with create_thread_pool(max(1, max_workers)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run,
+                                   lambda chunk=chunk: _invoke("questions", {"transcript": chunk}, model_name).content)
+                   for chunk in chunks]
+        candidates = [future.result() for future in futures]
+    
+    return _invoke("questions_reduce", {"candidates": candidates}, model_name).content
+
+async def agenerate_questions(transcript: str, model_name: str = "claude-3-7-sonnet-latest", api_key: Optional[str] = None,
+                              semaphore: Optional[asyncio.Semaphore] = None, mode: str = "auto") -> str:
     """
+    文字起こしテキストを分析し、文脈理解のための疑問点を非同期に生成します。
+    長いテキストは generate_questions と同じくmap-reduceで処理します。
+    
+    Args:
+        transcript: 分析する文字起こしテキスト
+        model_name: 使用するAnthropicモデル名
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+        semaphore: 同時実行数を制限するセマフォ（オプション）
+        mode: 処理方法（"auto"、"single"、"map_reduce"のいずれか）
     
-    prompt = ChatPromptTemplate.from_template(template)
+    Returns:
+        生成された疑問点のリスト（マークダウン形式）
+    """
+    if mode == "single" or (mode == "auto" and not use_map_reduce_for_questions(transcript, model_name)):
+        result = await _ainvoke("questions", {"transcript": transcript}, model_name, api_key, semaphore)
+        return result.content
     
-    # 最新のLangChain APIを使用
-    chain = prompt | llm
-    result = chain.invoke({"transcript": transcript})
+    chunks = split_transcript(transcript, QUESTIONS_CHUNK_TOKENS)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    results = await asyncio.gather(*[
+        _ainvoke("questions", {"transcript": chunk}, model_name, api_key, semaphore) for chunk in chunks
+    ])
+    candidates = [result.content for result in results]
+    if len(candidates) == 1:
+        return candidates[0]
     
+    result = await _ainvoke("questions_reduce", {"candidates": candidates}, model_name, api_key, semaphore)
     return result.content
@@ -0,0 +1,269 @@
+"""
+Message Batches APIを使って、複数の文字起こしをまとめてオフラインで整文化します。
+対話的な処理より応答は遅くなりますが、料金が割り引かれ、リクエストごとのレート制限を受けません。
+ローカルでは fakes.fake_server（リポジトリの開発用のパッケージ）を起動し、ANTHROPIC_BASE_URL にそのURLを指定すると実際のAPIを使わずに動作を確認できます。
+
+    results = formalize_transcripts_batch([transcript1, transcript2], [background1, background2])
+"""
+import logging
+import time
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .article_formalizer import (
+    MAX_CACHED_CLIENTS, MAX_CONTINUATIONS, build_request, build_context_window, build_light_context, get_chunk_token_budget, get_output_budget,
+    _cache_key, _cache_owner, _chunk_inputs, _record_output_ratio
+)
+from .transcript_splitter import split_transcript, extract_speakers
+from .token_estimator import get_model_limits, output_ratio_scope
+from .result_cache import get_result_cache
+from .job_store import Job, create_job, delete_job, record_result
+from .rate_limiter import get_scheduler
+from .utils import get_api_key
+
+if TYPE_CHECKING:
+    import anthropic
+
+logger = logging.getLogger(__name__)
+
+# バッチの処理状況を確認する間隔（秒）
+POLL_INTERVAL = 30.0
+
+# 1つのバッチに含めるリクエスト数の上限
+MAX_BATCH_REQUESTS = 10000
+
+# 失敗・期限切れになったリクエストを送り直す回数（最初の送信を含む）
+MAX_BATCH_ATTEMPTS = 3
+
+# 送り直しても結果が変わらないエラーの種類
+NON_RETRYABLE_ERROR_TYPES = {"invalid_request_error", "authentication_error", "permission_error", "not_found_error"}
+
+class BatchRequest(NamedTuple):
+    custom_id: str
+    job: Job
+    index: int
+    params: dict
+    cache_key: str
+
+@lru_cache(maxsize=MAX_CACHED_CLIENTS)
+def _create_batch_client(api_key: Optional[str]) -> "anthropic.Anthropic":
+    """
+    APIキーごとにAnthropicクライアントを作成し、最近使った MAX_CACHED_CLIENTS 個だけを保持します。
+    再試行はRequestSchedulerが行うため、クライアント側の再試行は無効にします。
+    """
+    import anthropic
+    return anthropic.Anthropic(api_key=api_key, max_retries=0)
+
+def get_batch_client(api_key: Optional[str] = None) -> "anthropic.Anthropic":
+    """
+    Message Batches API用のAnthropicクライアントを取得します。
+
+    Args:
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+
+    Returns:
+        anthropic.Anthropicインスタンス
+    """
+    if api_key is None:
+        api_key = get_api_key()
+    return _create_batch_client(api_key)
+
+def run_message_batch(requests: Dict[str, dict], model_name: str = "claude-3-7-sonnet-latest", api_key: Optional[str] = None,
+                      poll_interval: float = POLL_INTERVAL,
+                      result_callback: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
+    """
+    リクエストをメッセージバッチとして送信し、処理の終了を待って結果を受け取ります。
+    失敗・期限切れになったリクエストは、新しいバッチで送り直します。
+    出力の上限に達して途中で切れたリクエストは、それまでの出力を書き出しとして MAX_CONTINUATIONS 回まで続きを生成させます。
+
+    Args:
+        requests: custom_id と Messages API のパラメータの辞書
+        model_name: 使用するAnthropicモデル名（api_key とともに、送信の再試行とトークン使用量の集計に使うスケジューラを選ぶ）
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+        poll_interval: 処理状況を確認する間隔（秒）
+        result_callback: custom_id と生成されたテキストを受け取るコールバック関数（オプション）
+
+    Returns:
+        custom_id と生成されたテキストの辞書
+    """
+    client = get_batch_client(api_key)
+    scheduler = get_scheduler(model_name, api_key)
+    max_output_tokens = get_model_limits(model_name)["max_output_tokens"]
+    results: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    # 途中で切れたリクエストのそれまでの出力と、リクエストごとの失敗・続きの生成の回数
+    partials: Dict[str, str] = {}
+    attempts: Dict[str, int] = {}
+    continuations: Dict[str, int] = {}
+    pending = dict(requests)
+
+    while pending:
+        if attempts or continuations:
+            logger.info(f"{len(pending)} 件のリクエストを送り直します（失敗したリクエストと、出力の続きを生成するリクエスト）")
+
+        # 上限ごとに分けてすべてのバッチを送信してから、終了を待つ
+        custom_ids = list(pending)
+        batch_ids = []
+        for start in range(0, len(custom_ids), MAX_BATCH_REQUESTS):
+            batch_requests = [{"custom_id": custom_id, "params": pending[custom_id]}
+                              for custom_id in custom_ids[start:start + MAX_BATCH_REQUESTS]]
+            batch = scheduler.call(lambda: client.messages.batches.create(requests=batch_requests))
+            logger.info(f"メッセージバッチ {batch.id} を送信しました（{len(batch_requests)} 件）")
+            batch_ids.append(batch.id)
+
+        retry: Dict[str, dict] = {}
+        for batch_id in batch_ids:
+            _wait_for_batch(client, batch_id, poll_interval)
+            for entry in client.messages.batches.results(batch_id):
+                result = entry.result
+                custom_id = entry.custom_id
+                if result.type == "succeeded":
+                    message = result.message
+                    text = partials.pop(custom_id, "") + "".join(block.text for block in message.content if block.type == "text")
+                    errors.pop(custom_id, None)
+                    usage = message.usage
+                    cache_read = usage.cache_read_input_tokens or 0
+                    cache_write = usage.cache_creation_input_tokens or 0
+                    scheduler.record_usage(usage.input_tokens + cache_read + cache_write, usage.output_tokens,
+                                           cache_read, cache_write)
+                    if message.stop_reason == "max_tokens":
+                        if continuations.get(custom_id, 0) < MAX_CONTINUATIONS:
+                            # 書き出しの末尾の空白はAPIで受け付けられないため取り除く
+                            continuations[custom_id] = continuations.get(custom_id, 0) + 1
+                            partials[custom_id] = text.rstrip()
+                            retry[custom_id] = _continuation_params(requests[custom_id], partials[custom_id], max_output_tokens)
+                            logger.info(f"{custom_id} の出力が上限に達したため、続きを生成します（{continuations[custom_id]} 回目）")
+                            continue
+                        logger.warning(f"{custom_id} の続きを {MAX_CONTINUATIONS} 回生成しても出力が終わりませんでした。"
+                                       "途中までの出力を使います")
+                    results[custom_id] = text
+                    if result_callback:
+                        result_callback(custom_id, text)
+                    continue
+
+                error_type = result.error.error.type if result.type == "errored" else result.type
+                errors[custom_id] = error_type
+                attempts[custom_id] = attempts.get(custom_id, 0) + 1
+                if error_type not in NON_RETRYABLE_ERROR_TYPES and attempts[custom_id] < MAX_BATCH_ATTEMPTS:
+                    retry[custom_id] = pending[custom_id]
+        pending = retry
+
+    if errors:
+        summary = "、".join(f"{custom_id}: {error_type}" for custom_id, error_type in list(errors.items())[:5])
+        raise RuntimeError(f"メッセージバッチの {len(errors)} 件のリクエストが失敗しました（{summary}）")
+    return results
+
+def _continuation_params(params: dict, output: str, max_output_tokens: int) -> dict:
+    """
+    途中で切れた出力の続きを生成させるため、これまでの出力をアシスタントの応答の書き出しとして加えたパラメータを作成します。
+    続きはモデルの最大出力トークン数まで生成させます。
+    """
+    return {**params, "max_tokens": max_output_tokens,
+            "messages": [*params["messages"], {"role": "assistant", "content": output}]}
+
+def _wait_for_batch(client: "anthropic.Anthropic", batch_id: str, poll_interval: float):
+    """
+    バッチの処理が終了するまで待ちます。
+    """
+    while True:
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            return batch
+        counts = batch.request_counts
+        logger.info(f"メッセージバッチ {batch_id} を処理中...（処理中: {counts.processing} / 成功: {counts.succeeded} / "
+                    f"失敗: {counts.errored}）")
+        time.sleep(poll_interval)
+
+def _run_batch_pass(targets: List[Tuple[Job, int, Optional[str]]], model_name: str, api_key: Optional[str], poll_interval: float) -> None:
+    """
+    (ジョブ, チャンクの位置, コンテキスト) の組をまとめて1回のバッチ処理として整文化し、結果をジョブに記録します。
+    同じ入力の結果がキャッシュにある場合は送信しません。
+    """
+    cache = get_result_cache()
+    owner = _cache_owner(api_key)
+    requests: Dict[str, BatchRequest] = {}
+
+    for job, index, previous_result in targets:
+        background = job.settings.get("background")
+        chunk = job.chunks[index]
+        key = _cache_key(model_name, chunk, background, previous_result, owner)
+        cached = cache.get(key, owner)
+        if cached is not None:
+            record_result(job, index, cached)
+            continue
+
+        kind = "chunk" if previous_result is None else "context"
+        inputs = _chunk_inputs(chunk, background, previous_result)
+        params = {"model": model_name, "max_tokens": get_output_budget(kind, inputs, model_name), **build_request(kind, inputs)}
+        custom_id = f"{job.job_id[:32]}-{index}"
+        requests[custom_id] = BatchRequest(custom_id, job, index, params, key)
+
+    if not requests:
+        return
+
+    def save(custom_id: str, text: str) -> None:
+        request = requests[custom_id]
+        _record_output_ratio("chunk", {"chunk": request.job.chunks[request.index]}, model_name, text)
+        cache.set(request.cache_key, text, owner)
+        record_result(request.job, request.index, text)
+
+    run_message_batch({custom_id: request.params for custom_id, request in requests.items()},
+                      model_name, api_key, poll_interval, save)
+
+def formalize_transcripts_batch(transcripts: List[str], backgrounds: Optional[List[Optional[str]]] = None,
+                                model_name: str = "claude-3-7-sonnet-latest", max_tokens: Optional[int] = None,
+                                overlap: int = 200, mode: str = "sequential", api_key: Optional[str] = None,
+                                poll_interval: float = POLL_INTERVAL) -> List[str]:
+    """
+    複数の文字起こしテキストを、Message Batches APIを使ってまとめて整文化します。
+    "parallel" モードでは軽量なコンテキストを使い、すべてのチャンクを1回のバッチで処理します。
+    "sequential" モードでは formalize_transcript と同じく直前の結果をコンテキストにするため、
+    まず各文字起こしの最初のチャンクをまとめて送信し、その結果を使って次のチャンクを送信する、という処理を繰り返します。
+    処理は文字起こしごとにジョブとして保存されるため、途中で失敗した場合はログに出力されたジョブIDを resume_job に渡して続きを処理できます。
+
+    Args:
+        transcripts: 整文化する文字起こしテキストのリスト
+        backgrounds: 文字起こしごとの背景情報のリスト（オプション）
+        model_name: 使用するAnthropicモデル名
+        max_tokens: 各チャンクの最大トークン数（省略時はモデルの入出力の上限から決定）
+        overlap: チャンク間のオーバーラップトークン数
+        mode: 処理モード（"parallel" または "sequential"）
+        api_key: 使用するAPIキー（省略時は get_api_key で取得）
+        poll_interval: バッチの処理状況を確認する間隔（秒）
+
+    Returns:
+        整文化されたテキストのリスト（transcriptsと同じ順序）
+    """
+    if backgrounds is None:
+        backgrounds = [None] * len(transcripts)
+
+    jobs = []
+    for transcript, background in zip(transcripts, backgrounds):
+        chunk_tokens = max_tokens if max_tokens is not None else get_chunk_token_budget(model_name, background)
+        chunks = split_transcript(transcript, chunk_tokens, overlap)
+        # バッチでは直前の結果をコンテキストにするため、再開時も同じ方法で処理させる
+        job = create_job(chunks, {"background": background, "model_name": model_name, "mode": mode,
+                                  "context_mode": "previous"})
+        logger.info(f"ジョブID: {job.job_id}（{len(chunks)} チャンク）")
+        jobs.append(job)
+
+    # 出力の倍率はこのバッチ処理の中で記録し、ほかのジョブや利用者の文字起こしの影響を受けないようにする
+    with output_ratio_scope():
+        if mode == "parallel":
+            targets = []
+            for job in jobs:
+                speakers = extract_speakers("\n".join(job.chunks))
+                targets += [(job, i, build_light_context(job.chunks, i, speakers) or None) for i in job.missing_indices]
+            _run_batch_pass(targets, model_name, api_key, poll_interval)
+        else:
+            # i番目のチャンクのコンテキストには i-1 番目までの結果が必要なため、チャンクの位置ごとにバッチを分ける
+            for index in range(max((len(job.chunks) for job in jobs), default=0)):
+                targets = [(job, index, build_context_window([job.results[i] for i in range(index)])[0] if index > 0 else None)
+                           for job in jobs if index < len(job.chunks) and index not in job.results]
+                _run_batch_pass(targets, model_name, api_key, poll_interval)
+
+    results = []
+    for job in jobs:
+        results.append("\n".join(job.ordered_results()))
+        delete_job(job.job_id)
+    return results
@@ -0,0 +1,429 @@
+"""
+文字起こしファイルをまとめて整文化するコマンドラインツールです。
+Streamlitを使わずに実行できるため、cronやコンテナの中でも使えます。
+APIキーは環境変数 ANTHROPIC_API_KEY、または設定ファイル（~/.config/talk-to-article/config.json）から読み込みます。
+進捗とメトリクスは1行に1つのJSON（JSON Lines）として標準出力に出力し、ログは標準エラー出力に出力します。
+
+    talk-to-article transcripts/ "archive/**/*.txt" --output-dir articles --mode parallel --workers 8
+    talk-to-article --follow recording/live.txt --output-dir articles   # 録音中の文字起こしを追いかけて整文化
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+from .article_formalizer import run_job, get_chunk_token_budget, _cache_owner
+from .batch_processor import POLL_INTERVAL, formalize_transcripts_batch
+from .transcript_splitter import normalize_transcript, split_transcript
+from .result_cache import get_result_cache
+from .job_store import create_job, delete_job
+from .live import FLUSH_AFTER, FOLLOW_INTERVAL, IDLE_TIMEOUT, follow_transcript
+from .model_router import FAST_MODEL, ModelRouter
+from .instrumentation import PerformanceRecorder
+from .rate_limiter import get_scheduler
+from .utils import get_api_key
+
+# ディレクトリを指定した場合に文字起こしとして扱う拡張子
+TRANSCRIPT_EXTENSIONS = (".txt", ".md")
+
+logger = logging.getLogger(__name__)
+
+class ProgressReporter:
+    """
+    進捗のイベントをJSON Linesとして出力します。複数のスレッドから呼び出せます。
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        """
+        Args:
+            stream: 出力先（省略時は呼び出した時点の標準出力）
+        """
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event: str, **fields: Any) -> None:
+        """
+        イベントを1行のJSONとして出力します。
+
+        Args:
+            event: イベントの種類
+            **fields: イベントの内容
+        """
+        line = json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+def _pattern_root(pattern: str) -> str:
+    """
+    globのパターンのうち、ワイルドカードを含まない先頭のディレクトリを求めます（例：in/**/*.txt → in）。
+    """
+    root = pattern
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root if root != pattern else os.path.dirname(pattern)
+
+def find_transcripts(patterns: List[str]) -> Dict[str, str]:
+    """
+    ディレクトリまたはglobのパターンから、処理する文字起こしファイルを列挙します。
+    出力先では、各ファイルをパターンの起点（ディレクトリ、またはワイルドカードを含まない先頭のディレクトリ）からの
+    相対パスに置くため、別のディレクトリにある同じ名前のファイルも別々に書き出せます。
+
+    Args:
+        patterns: ファイル、ディレクトリ、またはglobのパターン（** で再帰）のリスト
+
+    Returns:
+        重複を除いたファイルパスと、パターンの起点からの相対パスの辞書
+    """
+    paths: Dict[str, str] = {}
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            root = pattern
+            matches = sorted(os.path.join(pattern, name) for name in os.listdir(pattern)
+                             if name.endswith(TRANSCRIPT_EXTENSIONS) and os.path.isfile(os.path.join(pattern, name)))
+        else:
+            root = _pattern_root(pattern)
+            matches = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+        for path in matches:
+            key = os.path.normcase(os.path.abspath(path))
+            if key not in seen:
+                seen.add(key)
+                paths[path] = os.path.relpath(path, root or os.curdir)
+    return paths
+
+def output_path_for(path: str, output_dir: str) -> str:
+    """
+    文字起こしファイルに対応する出力先のMarkdownファイルのパスを求めます。
+
+    Args:
+        path: 文字起こしファイルの、パターンの起点からの相対パス（find_transcripts の戻り値）
+        output_dir: 出力先ディレクトリ
+
+    Returns:
+        出力先のパス（拡張子を .md にしたもの）
+    """
+    return os.path.join(output_dir, os.path.splitext(path)[0] + ".md")
+
+def find_output_conflicts(outputs: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    出力先が同じになる文字起こしファイルを探します（同時に書き込むと、一方の結果が失われるため）。
+
+    Args:
+        outputs: 文字起こしファイルのパスと出力先のパスの辞書
+
+    Returns:
+        出力先のパスと、そこに書き出されるファイルのリストの辞書（重なりがない場合は空）
+    """
+    targets: Dict[str, List[str]] = {}
+    for path, output_path in outputs.items():
+        targets.setdefault(os.path.normcase(os.path.abspath(output_path)), []).append(path)
+    return {output_path: paths for output_path, paths in targets.items() if len(paths) > 1}
+
+def write_output(path: str, text: str) -> None:
+    """
+    途中で中断されても壊れたファイルが残らないように、一時ファイルに書いてから置き換えます。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def normalize_for_settings(transcript: str, settings: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    設定で無効にされていなければ、文字起こしを正規化します（normalize_transcript を参照）。
+
+    Returns:
+        正規化したテキストと、進捗に出力する削減量の辞書（正規化しない場合は元のテキストと空の辞書）
+    """
+    if not settings.get("normalize", True):
+        return transcript, {}
+    normalized = normalize_transcript(transcript)
+    return normalized.text, {"normalization": {"saved_chars": normalized.saved_chars, "saved_tokens": normalized.saved_tokens,
+                                               "saved_ratio": round(normalized.saved_ratio, 4), **normalized.removed,
+                                               "filler_density": round(normalized.filler_density, 3)}}
+
+def process_file(path: str, output_path: str, settings: Dict[str, Any], max_tokens: Optional[int], overlap: int,
+                 reporter: ProgressReporter, executor: Optional[ThreadPoolExecutor] = None,
+                 router: Optional[ModelRouter] = None, recorder: Optional[PerformanceRecorder] = None) -> None:
+    """
+    1つの文字起こしファイルを整文化し、Markdownとして書き出します。
+
+    Args:
+        path: 文字起こしファイルのパス
+        output_path: 出力先のパス
+        settings: ジョブの設定（background、model_name、mode、max_workers、routing、normalize）
+        max_tokens: 各チャンクの最大トークン数（Noneの場合はモデルの入出力の上限から決定）
+        overlap: チャンク間のオーバーラップトークン数
+        reporter: 進捗を出力するProgressReporter
+        executor: 並列処理モードで共有するスレッドプール
+        router: すべてのファイルで共有するModelRouter（モデルを切り替える場合）
+        recorder: モデルの呼び出しを記録するPerformanceRecorder（オプション）
+    """
+    started = time.monotonic()
+    recorder = recorder or PerformanceRecorder()
+    with open(path, encoding="utf-8") as f:
+        transcript = f.read()
+    transcript, normalization = normalize_for_settings(transcript, settings)
+    if max_tokens is None:
+        # モデルを切り替える場合は、どちらのモデルでも処理できる大きさにする
+        models = router.models if router is not None else [settings["model_name"]]
+        max_tokens = min(get_chunk_token_budget(model, settings["background"]) for model in models)
+    chunks = split_transcript(transcript, max_tokens, overlap)
+    # 正規化で取り除いたフィラーは、チャンクの難易度の判定で数える
+    filler_density = normalization.get("normalization", {}).get("filler_density", 0.0)
+    job = create_job(chunks, dict(settings, removed_filler_density=filler_density))
+    reporter.emit("file_started", file=path, chunks=len(chunks), job_id=job.job_id, **normalization)
+
+    def report(done: int, total: int) -> None:
+        reporter.emit("chunk_completed", file=path, completed=done, total=total)
+
+    try:
+        with recorder.activate(job.job_id):
+            results = run_job(job, report, executor, router)
+    except Exception:
+        # ジョブは残しておき、resume_job で続きを処理できるようにする
+        logger.exception(f"{path} の処理に失敗しました（ジョブID: {job.job_id}）")
+        raise
+    write_output(output_path, "\n".join(results))
+    delete_job(job.job_id)
+    reporter.emit("file_completed", file=path, output=output_path, chunks=len(chunks),
+                  seconds=round(time.monotonic() - started, 3))
+
+def process_files(outputs: Dict[str, str], settings: Dict[str, Any], max_tokens: Optional[int], overlap: int,
+                  workers: int, reporter: ProgressReporter, router: Optional[ModelRouter] = None,
+                  recorder: Optional[PerformanceRecorder] = None) -> Dict[str, int]:
+    """
+    複数の文字起こしファイルを同時に整文化します。
+    並列処理モードでは、すべてのファイルのチャンクを1つの共有スレッドプールで処理します。
+    outputs には、文字起こしファイルのパスと出力先のパスの辞書を指定します。
+
+    Returns:
+        成功・失敗したファイル数の辞書
+    """
+    counts = {"succeeded": 0, "failed": 0}
+    chunk_executor = ThreadPoolExecutor(max_workers=workers) if settings["mode"] == "parallel" else None
+    # ファイルごとの処理はチャンクの完了を待つだけなので、チャンクを処理するスレッドプールとは分ける
+    with ThreadPoolExecutor(max_workers=workers) as file_executor:
+        futures = {
+            file_executor.submit(process_file, path, output_path, settings, max_tokens, overlap,
+                                 reporter, chunk_executor, router, recorder): path
+            for path, output_path in outputs.items()
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                counts["succeeded"] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                reporter.emit("file_failed", file=futures[future], error=f"{type(e).__name__}: {e}")
+    if chunk_executor is not None:
+        chunk_executor.shutdown()
+    return counts
+
+def process_files_batch(outputs: Dict[str, str], settings: Dict[str, Any], max_tokens: Optional[int],
+                        overlap: int, poll_interval: float, reporter: ProgressReporter) -> Dict[str, int]:
+    """
+    複数の文字起こしファイルを、Message Batches APIを使ってまとめて整文化します。
+    outputs には、文字起こしファイルのパスと出力先のパスの辞書を指定します。
+
+    Returns:
+        成功・失敗したファイル数の辞書
+    """
+    paths = list(outputs)
+    transcripts = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            transcript, normalization = normalize_for_settings(f.read(), settings)
+        transcripts.append(transcript)
+        reporter.emit("file_started", file=path, **normalization)
+    try:
+        results = formalize_transcripts_batch(transcripts, [settings["background"]] * len(paths), settings["model_name"],
+                                              max_tokens, overlap, settings["mode"], poll_interval=poll_interval)
+    except Exception as e:
+        for path in paths:
+            reporter.emit("file_failed", file=path, error=f"{type(e).__name__}: {e}")
+        return {"succeeded": 0, "failed": len(paths)}
+
+    for path, text in zip(paths, results):
+        output_path = outputs[path]
+        write_output(output_path, text)
+        reporter.emit("file_completed", file=path, output=output_path)
+    return {"succeeded": len(paths), "failed": 0}
+
+def process_follow(path: str, output_path: str, settings: Dict[str, Any], max_tokens: Optional[int],
+                   args: argparse.Namespace, reporter: ProgressReporter,
+                   recorder: Optional[PerformanceRecorder] = None) -> Dict[str, int]:
+    """
+    書き込み中の文字起こしファイルを追いかけながら整文化し、チャンクごとに出力ファイルへ追記します。
+    Ctrl+Cで止めた場合も、たまっているテキストを処理してから終了します。
+
+    Returns:
+        成功・失敗したファイル数の辞書
+    """
+    started = time.monotonic()
+    stop_event = threading.Event()
+    reporter.emit("file_started", file=path, follow=True)
+
+    def report(index: int, result: str) -> None:
+        reporter.emit("chunk_completed", file=path, index=index, completed=index + 1)
+
+    result = {}
+
+    def follow() -> None:
+        try:
+            with (recorder or PerformanceRecorder()).activate():
+                result["text"] = follow_transcript(
+                    path, output_path, settings["background"], settings["model_name"], max_tokens,
+                    poll_interval=args.follow_interval, flush_after=args.flush_after, idle_timeout=args.idle_timeout,
+                    stop_event=stop_event, chunk_callback=report
+                )
+        except Exception as e:
+            logger.exception(f"{path} の処理に失敗しました")
+            result["error"] = e
+
+    # メインスレッドでCtrl+Cを受け取れるように、追いかける処理は別スレッドで実行する
+    thread = threading.Thread(target=follow, daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        logger.info("停止します。残りのテキストを処理しています...")
+        stop_event.set()
+        thread.join()
+
+    if "error" in result:
+        e = result["error"]
+        reporter.emit("file_failed", file=path, error=f"{type(e).__name__}: {e}")
+        return {"succeeded": 0, "failed": 1}
+    reporter.emit("file_completed", file=path, output=output_path, seconds=round(time.monotonic() - started, 3))
+    return {"succeeded": 1, "failed": 0}
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="talk-to-article", description="文字起こしファイルをまとめて整文化します")
+    parser.add_argument("inputs", nargs="+", help="文字起こしファイル、ディレクトリ、またはglobのパターン")
+    parser.add_argument("-o", "--output-dir", default="output", help="Markdownの出力先ディレクトリ")
+    parser.add_argument("--model", default="claude-3-7-sonnet-latest", help="使用するAnthropicモデル名")
+    parser.add_argument("--mode", default="parallel", choices=["parallel", "sequential"],
+                        help="処理モード（parallel: チャンクを同時に処理、sequential: 直前の結果を使って順に処理）")
+    parser.add_argument("--workers", type=int, default=4, help="同時に処理するファイル数とチャンク数の上限")
+    parser.add_argument("--background", default=None, help="すべてのファイルに共通の背景情報")
+    parser.add_argument("--background-file", default=None, help="背景情報を記述したファイル")
+    parser.add_argument("--max-tokens", type=int, default=None, help="各チャンクの最大トークン数（省略時はモデルから決定）")
+    parser.add_argument("--overlap", type=int, default=200, help="チャンク間のオーバーラップトークン数")
+    parser.add_argument("--no-normalize", action="store_true",
+                        help="フィラーやどもり、重複した行を取り除く前処理を行わずに、文字起こしをそのまま送信する")
+    parser.add_argument("--overwrite", action="store_true", help="出力先にファイルがある場合も処理し直す")
+    parser.add_argument("--route", action="store_true",
+                        help="チャンクの難易度に応じて、易しいチャンクを --fast-model で処理する（--batch とは併用できない）")
+    parser.add_argument("--fast-model", default=FAST_MODEL, help="--route で易しいチャンクに使うモデル名")
+    parser.add_argument("--no-escalate", action="store_true", help="--route で、不完全に見える結果を --model で処理し直さない")
+    parser.add_argument("--batch", action="store_true", help="Message Batches APIでまとめて処理する（料金が割り引かれるが時間がかかる）")
+    parser.add_argument("--follow", action="store_true",
+                        help="書き込み中の文字起こしファイルを1つ追いかけ、追記された部分から順に整文化する（--batch とは併用できない）")
+    parser.add_argument("--follow-interval", type=float, default=FOLLOW_INTERVAL, help="--follow で追記を確認する間隔（秒）")
+    parser.add_argument("--flush-after", type=float, default=FLUSH_AFTER,
+                        help="--follow で追記がこの秒数止まったら、たまっているテキストを整文化する")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="--follow で追記がこの秒数止まったら、残りを処理して終了する")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="バッチの処理状況を確認する間隔（秒）")
+    parser.add_argument("--metrics", default=None,
+                        help="モデルの呼び出しごとの待ち時間・処理時間・トークン数・料金を書き出すファイル（.csv はCSV、それ以外はJSON Lines）")
+    parser.add_argument("-v", "--verbose", action="store_true", help="詳細なログを標準エラー出力に出力する")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    コマンドラインツールのエントリーポイントです。
+
+    Returns:
+        終了コード（すべて成功した場合は0、失敗したファイルがある場合は1、実行できない場合は2）
+    """
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if not get_api_key():
+        print("APIキーが見つかりません。環境変数 ANTHROPIC_API_KEY または設定ファイルに設定してください。", file=sys.stderr)
+        return 2
+
+    background = args.background
+    if args.background_file:
+        with open(args.background_file, encoding="utf-8") as f:
+            background = f.read()
+
+    if args.route and args.batch:
+        print("--route と --batch は併用できません。", file=sys.stderr)
+        return 2
+    if args.follow and (args.batch or len(args.inputs) != 1):
+        print("--follow には文字起こしファイルを1つだけ指定してください（--batch とは併用できません）。", file=sys.stderr)
+        return 2
+
+    reporter = ProgressReporter()
+    recorder = PerformanceRecorder()
+    if args.follow:
+        # ファイルはまだ作られていなくてもよいため、パターンとして展開しない
+        path = args.inputs[0]
+        output_path = output_path_for(os.path.basename(path), args.output_dir)
+        reporter.emit("run_started", files=1, skipped=0, model=args.model, mode="follow", batch=False, workers=1)
+        started = time.monotonic()
+        settings = {"background": background, "model_name": args.model}
+        counts = process_follow(path, output_path, settings, args.max_tokens, args, reporter, recorder)
+        reporter.emit("run_completed", files=1, skipped=0, **counts, seconds=round(time.monotonic() - started, 3),
+                      scheduler=get_scheduler(args.model).metrics(), cache=get_result_cache().stats(_cache_owner()),
+                      performance=recorder.summary())
+        if args.metrics:
+            recorder.write(args.metrics)
+        return 1 if counts["failed"] else 0
+
+    outputs = {path: output_path_for(relative_path, args.output_dir)
+               for path, relative_path in find_transcripts(args.inputs).items()}
+    conflicts = find_output_conflicts(outputs)
+    if conflicts:
+        for output_path, paths in conflicts.items():
+            print(f"出力先 {output_path} が重なっています: {', '.join(paths)}", file=sys.stderr)
+        print("入力のパターンを分けて指定するか、ファイル名を変えてください。", file=sys.stderr)
+        return 2
+    paths = list(outputs)
+    pending = {}
+    for path, output_path in outputs.items():
+        if not args.overwrite and os.path.exists(output_path):
+            reporter.emit("file_skipped", file=path, reason="output_exists")
+        else:
+            pending[path] = output_path
+    reporter.emit("run_started", files=len(pending), skipped=len(paths) - len(pending), model=args.model,
+                  mode=args.mode, batch=args.batch, workers=args.workers)
+
+    started = time.monotonic()
+    settings = {"background": background, "model_name": args.model, "mode": args.mode, "max_workers": args.workers,
+                "normalize": not args.no_normalize}
+    router = None
+    if args.route:
+        settings["routing"] = {"fast_model": args.fast_model, "escalate": not args.no_escalate}
+        router = ModelRouter(strong_model=args.model, **settings["routing"])
+    if not pending:
+        counts = {"succeeded": 0, "failed": 0}
+    elif args.batch:
+        counts = process_files_batch(pending, settings, args.max_tokens, args.overlap, args.poll_interval, reporter)
+    else:
+        counts = process_files(pending, settings, args.max_tokens, args.overlap, max(1, args.workers), reporter,
+                               router, recorder)
+
+    reporter.emit("run_completed", files=len(pending), skipped=len(paths) - len(pending), **counts,
+                  seconds=round(time.monotonic() - started, 3),
+                  scheduler=get_scheduler(args.model).metrics(), cache=get_result_cache().stats(_cache_owner()),
+                  performance=recorder.summary(), **({"routing": router.report()} if router is not None else {}))
+    if args.metrics:
+        recorder.write(args.metrics)
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
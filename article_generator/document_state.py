@@ -0,0 +1,155 @@
+import re
+import unicodedata
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Optional, Tuple
+
+# 保持する話者と用語の上限（状態が大きくなりすぎないようにする）
+MAX_SPEAKERS = 30
+MAX_GLOSSARY_TERMS = 40
+
+# モデルが整文化結果の後に出力する、更新後の状態のブロック
+STATE_START_TAG = "<updated_document_state>"
+STATE_END_TAG = "</updated_document_state>"
+
+SECTION_PATTERN = re.compile(r'<(speakers|glossary|summary)>\s*(.*?)\s*</\1>', re.DOTALL)
+ENTRY_PATTERN = re.compile(r'^\s*(?:[-*・]\s*)?([^:：\n]{1,60}?)\s*[:：]\s*(.+?)\s*$', re.MULTILINE)
+
+def _entry_keys(entries: Dict[str, str]) -> FrozenSet[str]:
+    """話者ラベルや用語を、全角・半角、大文字・小文字、空白の違いを除いた形の集合にします。"""
+    return frozenset("".join(unicodedata.normalize("NFKC", key).casefold().split()) for key in entries)
+
+@dataclass
+class DocumentState:
+    """
+    逐次処理でチャンク間の一貫性を保つための、文書全体の要約された状態です。
+    直前のチャンクの整文化結果をそのまま渡す代わりに、話者ラベルの対応、
+    繰り返し出てくる用語や略語、ここまでの内容の要約だけを次のチャンクに渡します。
+    """
+    speakers: Dict[str, str] = field(default_factory=dict)
+    glossary: Dict[str, str] = field(default_factory=dict)
+    summary: str = ""
+
+    @property
+    def is_empty(self) -> bool:
+        """話者・用語・要約のいずれも持たないかどうか"""
+        return not (self.speakers or self.glossary or self.summary)
+
+    def to_prompt(self) -> str:
+        """
+        プロンプトに含めるための、簡潔なテキスト表現を作成します。
+
+        Returns:
+            話者・用語・要約のセクションからなるテキスト
+        """
+        speakers = "\n".join(f"{label}: {description}" for label, description in self.speakers.items())
+        glossary = "\n".join(f"{term}: {description}" for term, description in self.glossary.items())
+        return f"<speakers>\n{speakers}\n</speakers>\n<glossary>\n{glossary}\n</glossary>\n<summary>\n{self.summary}\n</summary>"
+
+    def merge(self, update: "DocumentState") -> "DocumentState":
+        """
+        モデルが出力した更新後の状態を取り込みます。
+        更新に含まれない話者や用語も残し、上限を超える場合は古いものから除きます。
+
+        Args:
+            update: 更新後の状態
+
+        Returns:
+            取り込んだ新しい状態
+        """
+        speakers = {**self.speakers, **update.speakers}
+        glossary = {**self.glossary, **update.glossary}
+        return DocumentState(
+            speakers=dict(list(speakers.items())[-MAX_SPEAKERS:]),
+            glossary=dict(list(glossary.items())[-MAX_GLOSSARY_TERMS:]),
+            summary=update.summary or self.summary,
+        )
+
+    def has_same_entries(self, other: "DocumentState") -> bool:
+        """
+        話者ラベルと用語の見出しが同じかどうかを判定します。
+        説明や要約は生成のたびに表現が変わるため比較せず、ラベルと見出しも表記の揺れを除いた形で比較します。
+        再実行時に、前回の結果をそのまま使えるかどうかの判定に使います。
+        """
+        return (_entry_keys(self.speakers) == _entry_keys(other.speakers)
+                and _entry_keys(self.glossary) == _entry_keys(other.glossary))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ジョブに保存するための辞書に変換します。"""
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "DocumentState":
+        """to_dict で保存した辞書から状態を復元します。"""
+        data = data or {}
+        return cls(speakers=dict(data.get("speakers", {})), glossary=dict(data.get("glossary", {})),
+                   summary=data.get("summary", ""))
+
+def parse_document_state(text: str) -> DocumentState:
+    """
+    状態のブロックの中身（speakers・glossary・summaryのセクション）を解析します。
+
+    Args:
+        text: 状態のブロックの中身
+
+    Returns:
+        解析した状態（セクションがない場合は空の状態）
+    """
+    state = DocumentState()
+    for name, body in SECTION_PATTERN.findall(text):
+        if name == "summary":
+            state.summary = " ".join(body.split())
+            continue
+        entries = {key.strip("*` "): value for key, value in ENTRY_PATTERN.findall(body)}
+        if name == "speakers":
+            state.speakers = entries
+        else:
+            state.glossary = entries
+    return state
+
+def split_document_state(output: str) -> Tuple[str, Optional[DocumentState]]:
+    """
+    モデルの出力を、整文化されたテキストと更新後の状態に分けます。
+
+    Args:
+        output: モデルの出力全体
+
+    Returns:
+        整文化されたテキストと、更新後の状態（ブロックがない場合はNone）のタプル
+    """
+    start = output.rfind(STATE_START_TAG)
+    if start < 0:
+        return output.strip(), None
+    end = output.find(STATE_END_TAG, start)
+    block = output[start + len(STATE_START_TAG):end if end >= 0 else len(output)]
+    return output[:start].rstrip(), parse_document_state(block)
+
+def strip_document_state(pieces: Iterable[str]) -> Iterator[str]:
+    """
+    ストリーミングで受け取るテキストの断片から、状態のブロック以降を取り除いて返します。
+    開始タグが断片の境目で分かれても途中まで返さないように、タグの長さ分だけ末尾を保留します。
+    状態のブロックを受け取れるように、入力は最後まで読み進めます。
+
+    Args:
+        pieces: モデルが出力したテキストの断片
+
+    Yields:
+        整文化されたテキストの断片
+    """
+    pending = ""
+    in_state = False
+    keep = len(STATE_START_TAG) - 1
+    for piece in pieces:
+        if in_state:
+            continue
+        pending += piece
+        start = pending.find(STATE_START_TAG)
+        if start >= 0:
+            in_state = True
+            if pending[:start].rstrip():
+                yield pending[:start].rstrip()
+            pending = ""
+        elif len(pending) > keep:
+            yield pending[:-keep]
+            pending = pending[-keep:]
+    if pending:
+        yield pending
@@ -0,0 +1,338 @@
+"""
+モデルの呼び出しごとの性能を記録します。
+呼び出しごとに、スケジューラでの待ち時間・最初のトークンまでの時間・全体の処理時間・
+トークン使用量（キャッシュを含む）・再試行回数・概算料金を CallRecord として記録し、
+PerformanceRecorder と add_call_listener で登録したコールバック関数に渡します。
+opentelemetry がインストールされている場合は、ジョブ・チャンク・呼び出しをスパンとしても記録します。
+"""
+import contextvars
+import csv
+import io
+import json
+import logging
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from .model_router import estimate_cost
+
+try:
+    from opentelemetry import trace
+    _tracer = trace.get_tracer("talk-to-article")
+except ImportError:
+    _tracer = None
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CallRecord:
+    """
+    1回のモデルの呼び出しの記録です。時間の単位は秒です。
+    最初のトークンまでの時間は、ストリーミングで呼び出した場合だけ記録します。
+    出力の上限に達して続きを生成させた場合は、続きの呼び出しごとに continuation を1つずつ増やして記録します。
+    """
+    kind: str
+    model: str
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    started_at: float = 0.0
+    queue_wait_seconds: float = 0.0
+    time_to_first_token_seconds: Optional[float] = None
+    latency_seconds: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    retries: int = 0
+    cost_usd: Optional[float] = None
+    error: Optional[str] = None
+    chunk_tokens: Optional[int] = None
+    max_output_tokens: Optional[int] = None
+    stop_reason: Optional[str] = None
+    continuation: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+@dataclass
+class _Scope:
+    recorder: Optional["PerformanceRecorder"] = None
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+
+# 現在の実行の記録先とチャンクの位置（スレッドプールへは contextvars.copy_context で引き継ぐ）
+_scope: contextvars.ContextVar[_Scope] = contextvars.ContextVar("talk_to_article_scope", default=_Scope())
+
+_listeners: List[Callable[[CallRecord], None]] = []
+_listeners_lock = threading.Lock()
+
+def add_call_listener(listener: Callable[[CallRecord], None]) -> None:
+    """
+    すべてのモデルの呼び出しの記録を受け取るコールバック関数を登録します。
+    コールバック関数は呼び出したスレッドから呼ばれます。
+
+    Args:
+        listener: CallRecordを受け取るコールバック関数
+    """
+    with _listeners_lock:
+        _listeners.append(listener)
+
+def remove_call_listener(listener: Callable[[CallRecord], None]) -> None:
+    """
+    add_call_listener で登録したコールバック関数を解除します。
+    """
+    with _listeners_lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+def _dispatch(record: CallRecord, recorder: Optional["PerformanceRecorder"]) -> None:
+    with _listeners_lock:
+        listeners = list(_listeners)
+    if recorder is not None:
+        listeners.insert(0, recorder.add)
+    for listener in listeners:
+        try:
+            listener(record)
+        except Exception:
+            # 記録の失敗で整文化を止めない
+            logger.exception("呼び出しの記録の処理に失敗しました")
+
+@contextmanager
+def _span(name: str, attributes: Dict[str, Any]) -> Iterator[Any]:
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as span:
+        yield span
+
+@contextmanager
+def chunk_scope(index: int) -> Iterator[None]:
+    """
+    この中で行われたモデルの呼び出しを、指定した位置のチャンクの処理として記録します。
+
+    Args:
+        index: チャンクの位置
+    """
+    scope = _scope.get()
+    token = _scope.set(_Scope(scope.recorder, scope.job_id, index))
+    try:
+        with _span("talk_to_article.chunk", {"talk_to_article.job_id": scope.job_id, "talk_to_article.chunk_index": index}):
+            yield
+    finally:
+        _scope.reset(token)
+
+class CallTimer:
+    """
+    measure_call の中で、最初のトークンの受信とトークン使用量を記録するためのオブジェクトです。
+    scheduler_stats は RequestScheduler の呼び出しに渡し、待ち時間と再試行回数を受け取ります。
+    """
+
+    def __init__(self, record: CallRecord):
+        self.record = record
+        self.scheduler_stats: Dict[str, Any] = {}
+        self._started = time.monotonic()
+
+    def first_token(self) -> None:
+        """最初のトークンを受け取った時点を記録します（2回目以降は無視します）。"""
+        if self.record.time_to_first_token_seconds is None:
+            self.record.time_to_first_token_seconds = round(time.monotonic() - self._started, 3)
+
+    def set_request(self, max_output_tokens: int, chunk_tokens: Optional[int] = None, continuation: int = 0) -> None:
+        """リクエストした出力の上限と、入力チャンクの推定トークン数を記録します。"""
+        self.record.max_output_tokens = max_output_tokens
+        self.record.chunk_tokens = chunk_tokens
+        self.record.continuation = continuation
+
+    def set_stop_reason(self, stop_reason: Optional[str]) -> None:
+        """生成が終了した理由（"end_turn"、"max_tokens" など）を記録します。"""
+        self.record.stop_reason = stop_reason
+
+    def set_usage(self, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> None:
+        """応答で報告されたトークン使用量を記録します。"""
+        self.record.input_tokens = input_tokens
+        self.record.output_tokens = output_tokens
+        self.record.cache_read_tokens = cache_read_tokens
+        self.record.cache_write_tokens = cache_write_tokens
+
+    def _finish(self) -> None:
+        record = self.record
+        record.latency_seconds = round(time.monotonic() - self._started, 3)
+        record.queue_wait_seconds = round(self.scheduler_stats.get("queue_wait_seconds", 0.0), 3)
+        record.retries = self.scheduler_stats.get("retries", 0)
+        cost = estimate_cost(record.model, record.input_tokens, record.output_tokens,
+                             record.cache_read_tokens, record.cache_write_tokens)
+        record.cost_usd = round(cost, 6) if cost is not None else None
+
+@contextmanager
+def measure_call(kind: str, model_name: str) -> Iterator[CallTimer]:
+    """
+    1回のモデルの呼び出しを計測し、終了時に記録します。例外が発生した場合も、エラーとして記録します。
+
+    Args:
+        kind: リクエストの種類（build_request の kind）
+        model_name: モデル名
+
+    Yields:
+        最初のトークンとトークン使用量を記録するCallTimer
+    """
+    scope = _scope.get()
+    timer = CallTimer(CallRecord(kind=kind, model=model_name, job_id=scope.job_id, chunk_index=scope.chunk_index,
+                                 started_at=round(time.time(), 3)))
+    with _span("talk_to_article.llm_call", {"gen_ai.system": "anthropic", "gen_ai.request.model": model_name,
+                                            "talk_to_article.kind": kind}) as span:
+        try:
+            yield timer
+        except Exception as e:
+            timer.record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            timer._finish()
+            if span is not None:
+                record = timer.record
+                span.set_attributes({
+                    "gen_ai.usage.input_tokens": record.input_tokens,
+                    "gen_ai.usage.output_tokens": record.output_tokens,
+                    "talk_to_article.queue_wait_seconds": record.queue_wait_seconds,
+                    "talk_to_article.retries": record.retries,
+                })
+            _dispatch(timer.record, scope.recorder)
+
+def _percentile(values: List[float], ratio: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(ratio * len(values)))], 3)
+
+class PerformanceRecorder:
+    """
+    1回の実行（1つ以上のジョブ）のモデルの呼び出しの記録を集めます。複数のスレッドから呼び出せます。
+    activate の中で行われた呼び出し（そこから起動したスレッドプールの処理を含む）だけを記録します。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records: List[CallRecord] = []
+
+    def add(self, record: CallRecord) -> None:
+        """記録を加えます。"""
+        with self._lock:
+            self._records.append(record)
+
+    @property
+    def records(self) -> List[CallRecord]:
+        """これまでの記録のリスト（呼び出しの開始順）"""
+        with self._lock:
+            return sorted(self._records, key=lambda record: record.started_at)
+
+    @contextmanager
+    def activate(self, job_id: Optional[str] = None) -> Iterator["PerformanceRecorder"]:
+        """
+        この中で行われたモデルの呼び出しを記録します。
+
+        Args:
+            job_id: 記録に付けるジョブID（オプション）
+        """
+        token = _scope.set(_Scope(self, job_id, None))
+        try:
+            with _span("talk_to_article.job", {"talk_to_article.job_id": job_id}):
+                yield self
+        finally:
+            _scope.reset(token)
+
+    def chunk_rows(self) -> List[Dict[str, Any]]:
+        """
+        チャンクごとに集計した記録を取得します。生成し直した場合は、両方の呼び出しを合計します。
+
+        Returns:
+            ジョブID・チャンクの位置・モデル・待ち時間・最初のトークンまでの時間・処理時間・
+            トークン使用量・再試行回数・概算料金・出力の上限で途中で切れた回数・入力チャンクに対する出力の倍率の辞書のリスト
+        """
+        rows: Dict[Any, Dict[str, Any]] = {}
+        for record in self.records:
+            if record.chunk_index is None:
+                continue
+            row = rows.setdefault((record.job_id, record.chunk_index), {
+                "job_id": record.job_id, "chunk_index": record.chunk_index, "models": [], "calls": 0,
+                "queue_wait_seconds": 0.0, "time_to_first_token_seconds": None, "latency_seconds": 0.0,
+                "input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0,
+                "retries": 0, "cost_usd": 0.0, "errors": 0, "truncated": 0, "chunk_tokens": {}, "output_ratio": None,
+            })
+            if record.model not in row["models"]:
+                row["models"].append(record.model)
+            if row["time_to_first_token_seconds"] is None:
+                row["time_to_first_token_seconds"] = record.time_to_first_token_seconds
+            row["calls"] += 1
+            row["errors"] += record.error is not None
+            row["truncated"] += record.stop_reason == "max_tokens"
+            if record.chunk_tokens and not record.continuation:
+                # 出力の上限を超えないように分割した部分はモデルごとに合計し、生成し直した分は数えない
+                row["chunk_tokens"][record.model] = row["chunk_tokens"].get(record.model, 0) + record.chunk_tokens
+            for name in ("queue_wait_seconds", "latency_seconds", "input_tokens", "output_tokens",
+                         "cache_read_tokens", "cache_write_tokens", "retries"):
+                row[name] += getattr(record, name)
+            row["cost_usd"] += record.cost_usd or 0.0
+        for row in rows.values():
+            row["models"] = ", ".join(row["models"])
+            row["queue_wait_seconds"] = round(row["queue_wait_seconds"], 3)
+            row["latency_seconds"] = round(row["latency_seconds"], 3)
+            row["cost_usd"] = round(row["cost_usd"], 6)
+            row["chunk_tokens"] = max(row["chunk_tokens"].values(), default=None)
+            if row["chunk_tokens"]:
+                row["output_ratio"] = round(row["output_tokens"] / row["chunk_tokens"], 3)
+        return sorted(rows.values(), key=lambda row: (row["job_id"] or "", row["chunk_index"]))
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        すべての呼び出しの合計と、処理時間・待ち時間・最初のトークンまでの時間の分布を取得します。
+
+        Returns:
+            集計の辞書
+        """
+        records = self.records
+        latencies = [record.latency_seconds for record in records]
+        waits = [record.queue_wait_seconds for record in records]
+        first_tokens = [record.time_to_first_token_seconds for record in records
+                        if record.time_to_first_token_seconds is not None]
+        costs = [record.cost_usd for record in records if record.cost_usd is not None]
+        return {
+            "calls": len(records),
+            "errors": sum(1 for record in records if record.error is not None),
+            "truncated": sum(1 for record in records if record.stop_reason == "max_tokens"),
+            "retries": sum(record.retries for record in records),
+            "input_tokens": sum(record.input_tokens for record in records),
+            "output_tokens": sum(record.output_tokens for record in records),
+            "cache_read_tokens": sum(record.cache_read_tokens for record in records),
+            "cache_write_tokens": sum(record.cache_write_tokens for record in records),
+            "cost_usd": round(sum(costs), 4) if costs else None,
+            "total_queue_wait_seconds": round(sum(waits), 3),
+            "latency_p50_seconds": round(statistics.median(latencies), 3) if latencies else None,
+            "latency_p95_seconds": _percentile(latencies, 0.95),
+            "time_to_first_token_p50_seconds": round(statistics.median(first_tokens), 3) if first_tokens else None,
+        }
+
+    def to_jsonl(self) -> str:
+        """記録を1行に1つのJSON（JSON Lines）にします。"""
+        return "".join(json.dumps(record.to_dict(), ensure_ascii=False) + "\n" for record in self.records)
+
+    def to_csv(self) -> str:
+        """記録をCSVにします。"""
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=[f.name for f in fields(CallRecord)])
+        writer.writeheader()
+        for record in self.records:
+            writer.writerow(record.to_dict())
+        return output.getvalue()
+
+    def write(self, path: str) -> None:
+        """
+        記録をファイルに書き出します。拡張子が .csv の場合はCSV、それ以外はJSON Linesで書き出します。
+
+        Args:
+            path: 出力先のパス
+        """
+        text = self.to_csv() if path.lower().endswith(".csv") else self.to_jsonl()
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
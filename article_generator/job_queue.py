@@ -0,0 +1,442 @@
+"""
+整文化ジョブを投入し、別プロセスのワーカー（worker.py）に処理させるためのキューです。
+キューはデータディレクトリのSQLiteに保存するため、同じマシンの複数のプロセスから共有できます。
+チャンクや途中結果は job_store のジョブに保存し、キューには状態・進捗・最終結果だけを保存します。
+
+    queue = get_job_queue()
+    queue.submit(job, owner=owner_for_api_key(api_key), api_key=api_key)
+    entry = queue.get(job.job_id)   # entry.status、entry.completed / entry.total、entry.result
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from .job_store import Job
+from .result_cache import DATA_DIR, create_private_file
+from .utils import owner_for_api_key
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+# ワーカーが生存を知らせる間隔と、応答がないワーカーのジョブをキューに戻すまでの秒数
+HEARTBEAT_INTERVAL = 5.0
+STALE_AFTER = 60.0
+
+# ワーカーが停止したときにジョブを処理し直す回数の上限（最初の実行を含む）
+MAX_ATTEMPTS = 3
+
+# 終了したジョブをキューに残しておく秒数
+RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+@dataclass
+class QueueEntry:
+    """
+    キューに投入されたジョブの状態です。
+    """
+    job_id: str
+    owner: str
+    status: str
+    submitted_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    worker_id: Optional[str] = None
+    heartbeat_at: Optional[float] = None
+    attempts: int = 0
+    completed: int = 0
+    total: int = 0
+    cancel_requested: bool = False
+    error: Optional[str] = None
+    result: Optional[str] = None
+    # 処理に使うAPIキー（claim で取り出したときだけ設定する）
+    api_key: Optional[str] = field(default=None, repr=False)
+
+    @property
+    def is_active(self) -> bool:
+        """待機中または処理中かどうか"""
+        return self.status in ACTIVE_STATUSES
+
+class JobQueue:
+    """
+    SQLiteに保存するジョブのキューです。複数のスレッドとプロセスから呼び出せます。
+    ワーカーは所有者ごとの処理中のジョブが少ないものから順に取り出すため、
+    1人が多くのジョブを投入しても、ほかの人のジョブが後回しになり続けることはありません。
+    ジョブを処理するために投入時のAPIキーを保存し、ジョブが終了したら削除します。
+    データベースのファイルは、所有者だけが読み書きできる権限で作成します。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+            path: SQLiteファイルのパス（省略時はデータディレクトリ内）
+        """
+        self.path = path or os.path.join(DATA_DIR, "job_queue.sqlite3")
+        self._lock = threading.Lock()
+
+        # 処理中のジョブのAPIキーを保存するため、ほかのユーザーから読めない権限で作成する
+        create_private_file(self.path)
+        # 複数の文をまとめて実行する場合は BEGIN IMMEDIATE で明示的にトランザクションを始める
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 終了したジョブから削除したAPIキーが、ファイルの空き領域に残らないようにする
+        self._conn.execute("PRAGMA secure_delete=ON")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL, api_key TEXT, "
+            "submitted_at REAL NOT NULL, started_at REAL, finished_at REAL, worker_id TEXT, heartbeat_at REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, completed INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, "
+            "cancel_requested INTEGER NOT NULL DEFAULT 0, error TEXT, result TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "worker_id TEXT PRIMARY KEY, host TEXT NOT NULL, pid INTEGER NOT NULL, "
+            "started_at REAL NOT NULL, heartbeat_at REAL NOT NULL, job_id TEXT)"
+        )
+
+    @staticmethod
+    def _entry(row: sqlite3.Row, with_api_key: bool = False) -> QueueEntry:
+        data = {key: row[key] for key in row.keys() if with_api_key or key != "api_key"}
+        data["cancel_requested"] = bool(data["cancel_requested"])
+        return QueueEntry(**data)
+
+    def submit(self, job: Job, owner: str, api_key: Optional[str] = None) -> QueueEntry:
+        """
+        ジョブをキューに投入します。同じジョブが終了している場合は、未処理のチャンクを処理し直すために投入し直します。
+
+        Args:
+            job: 投入するジョブ（job_store で保存済みのもの）
+            owner: ジョブの所有者の識別子（owner_for_api_key の戻り値など）
+            api_key: ジョブの処理に使うAPIキー（省略時はワーカーの get_api_key で探す）
+
+        Returns:
+            投入されたジョブの状態
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (job_id, owner, status, api_key, submitted_at, completed, total) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (job_id) DO UPDATE SET owner = excluded.owner, status = excluded.status, "
+                    "api_key = excluded.api_key, submitted_at = excluded.submitted_at, started_at = NULL, finished_at = NULL, "
+                    "worker_id = NULL, heartbeat_at = NULL, attempts = 0, completed = excluded.completed, "
+                    "cancel_requested = 0, error = NULL, result = NULL "
+                    "WHERE jobs.status NOT IN (?, ?)",
+                    (job.job_id, owner, QUEUED, api_key, now, len(job.results), len(job.chunks), QUEUED, RUNNING)
+                )
+                row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self._entry(row)
+
+    def claim(self, worker_id: str) -> Optional[QueueEntry]:
+        """
+        次に処理するジョブを取り出し、処理中にします。
+        処理中のジョブが少ない所有者のジョブを優先し、同じ場合は投入が早いものから取り出します。
+
+        Args:
+            worker_id: ジョブを処理するワーカーのID
+
+        Returns:
+            取り出したジョブの状態（処理に使うAPIキーを含む）。待機中のジョブがない場合はNone
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs AS queued WHERE status = ? ORDER BY "
+                    "(SELECT COUNT(*) FROM jobs AS running WHERE running.owner = queued.owner AND running.status = ?), "
+                    "submitted_at LIMIT 1",
+                    (QUEUED, RUNNING)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, worker_id = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 "
+                        "WHERE job_id = ?",
+                        (RUNNING, worker_id, now, now, row["job_id"])
+                    )
+                    self._conn.execute("UPDATE workers SET job_id = ?, heartbeat_at = ? WHERE worker_id = ?",
+                                       (row["job_id"], now, worker_id))
+                    row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (row["job_id"],)).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self._entry(row, with_api_key=True) if row is not None else None
+
+    def heartbeat(self, job_id: str, worker_id: str, completed: Optional[int] = None) -> bool:
+        """
+        処理中のジョブの生存と進捗を記録します。
+
+        Args:
+            job_id: 処理中のジョブID
+            worker_id: ジョブを処理しているワーカーのID
+            completed: 完了したチャンク数（Noneの場合は更新しない）
+
+        Returns:
+            処理を続けてよい場合はTrue（中止が要求されたか、ほかのワーカーに引き継がれた場合はFalse）
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET heartbeat_at = ?, completed = COALESCE(?, completed) WHERE job_id = ? AND worker_id = ? AND status = ?",
+                (now, completed, job_id, worker_id, RUNNING)
+            )
+            self._conn.execute("UPDATE workers SET heartbeat_at = ? WHERE worker_id = ?", (now, worker_id))
+            row = self._conn.execute("SELECT status, worker_id, cancel_requested FROM jobs WHERE job_id = ?",
+                                     (job_id,)).fetchone()
+        return row is not None and row["status"] == RUNNING and row["worker_id"] == worker_id and not row["cancel_requested"]
+
+    def finish(self, job_id: str, worker_id: str, status: str, result: Optional[str] = None,
+               error: Optional[str] = None, completed: Optional[int] = None) -> None:
+        """
+        処理中のジョブを終了し、APIキーを削除します。
+
+        Args:
+            job_id: ジョブID
+            worker_id: ジョブを処理していたワーカーのID
+            status: 終了後の状態（DONE、FAILED、CANCELLED のいずれか）
+            result: 整文化されたテキスト（完了した場合）
+            error: エラーの内容（失敗した場合）
+            completed: 完了したチャンク数
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ?, api_key = NULL, "
+                    "completed = COALESCE(?, completed) WHERE job_id = ? AND worker_id = ? AND status = ?",
+                    (status, now, result, error, completed, job_id, worker_id, RUNNING)
+                )
+                self._conn.execute("UPDATE workers SET job_id = NULL, heartbeat_at = ? WHERE worker_id = ?", (now, worker_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release(self, job_id: str, worker_id: str, completed: Optional[int] = None) -> str:
+        """
+        処理中のジョブを、ワーカーが停止するためにキューに戻します（中止が要求されていた場合は中止にします）。
+        戻したジョブは処理した回数に数えません。
+
+        Args:
+            job_id: ジョブID
+            worker_id: ジョブを処理していたワーカーのID
+            completed: 完了したチャンク数
+
+        Returns:
+            戻した後の状態（QUEUED または CANCELLED）
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = CASE WHEN cancel_requested THEN ? ELSE ? END, "
+                    "finished_at = CASE WHEN cancel_requested THEN ? END, "
+                    "api_key = CASE WHEN cancel_requested THEN NULL ELSE api_key END, "
+                    "worker_id = NULL, attempts = MAX(attempts - 1, 0), completed = COALESCE(?, completed) "
+                    "WHERE job_id = ? AND worker_id = ? AND status = ?",
+                    (CANCELLED, QUEUED, now, completed, job_id, worker_id, RUNNING)
+                )
+                self._conn.execute("UPDATE workers SET job_id = NULL, heartbeat_at = ? WHERE worker_id = ?", (now, worker_id))
+                row = self._conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row["status"] if row is not None else CANCELLED
+
+    def cancel(self, job_id: str) -> None:
+        """
+        ジョブの中止を要求します。待機中のジョブはすぐに中止し、処理中のジョブはワーカーが次のチャンクの完了時に中止します。
+        完了したチャンクはジョブに保存されたままなので、投入し直すと続きから処理します。
+
+        Args:
+            job_id: ジョブID
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("UPDATE jobs SET status = ?, finished_at = ?, api_key = NULL WHERE job_id = ? AND status = ?",
+                                   (CANCELLED, time.time(), job_id, QUEUED))
+                self._conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = ?", (job_id, RUNNING))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, job_id: str) -> Optional[QueueEntry]:
+        """
+        ジョブの状態を取得します。
+
+        Args:
+            job_id: ジョブID
+
+        Returns:
+            ジョブの状態（キューにない場合はNone）
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def position(self, job_id: str) -> Optional[int]:
+        """
+        待機中のジョブの前に待っているジョブの数を取得します（投入順で数えるため、目安です）。
+
+        Args:
+            job_id: ジョブID
+
+        Returns:
+            前に待っているジョブの数（待機中でない場合はNone）
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM jobs AS other WHERE other.status = ? AND other.submitted_at < jobs.submitted_at) "
+                "FROM jobs WHERE job_id = ? AND status = ?",
+                (QUEUED, job_id, QUEUED)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def list_entries(self, owner: Optional[str] = None, active_only: bool = False, limit: int = 50) -> List[QueueEntry]:
+        """
+        ジョブの状態を新しい順に取得します。
+
+        Args:
+            owner: この所有者のジョブだけを取得する（オプション）
+            active_only: 待機中と処理中のジョブだけを取得するかどうか
+            limit: 取得する最大件数
+
+        Returns:
+            ジョブの状態のリスト
+        """
+        conditions, params = [], []
+        if owner is not None:
+            conditions.append("owner = ?")
+            params.append(owner)
+        if active_only:
+            conditions.append(f"status IN ({', '.join('?' for _ in ACTIVE_STATUSES)})")
+            params.extend(ACTIVE_STATUSES)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT * FROM jobs {where} ORDER BY submitted_at DESC LIMIT ?",
+                                      (*params, limit)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def register_worker(self, worker_id: str) -> None:
+        """
+        ワーカーを登録します。
+
+        Args:
+            worker_id: ワーカーのID
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO workers (worker_id, host, pid, started_at, heartbeat_at, job_id) VALUES (?, ?, ?, ?, ?, NULL)",
+                (worker_id, socket.gethostname(), os.getpid(), now, now)
+            )
+
+    def unregister_worker(self, worker_id: str) -> None:
+        """
+        ワーカーの登録を解除します。
+
+        Args:
+            worker_id: ワーカーのID
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def worker_heartbeat(self, worker_id: str) -> None:
+        """
+        待機中のワーカーの生存を記録します。
+
+        Args:
+            worker_id: ワーカーのID
+        """
+        with self._lock:
+            self._conn.execute("UPDATE workers SET heartbeat_at = ? WHERE worker_id = ?", (time.time(), worker_id))
+
+    def active_workers(self) -> int:
+        """
+        応答のあるワーカーの数を取得します。
+
+        Returns:
+            直近 STALE_AFTER 秒以内に応答したワーカーの数
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat_at >= ?",
+                                      (time.time() - STALE_AFTER,)).fetchone()[0]
+
+    def recover_stale(self, stale_after: float = STALE_AFTER, max_attempts: int = MAX_ATTEMPTS) -> List[str]:
+        """
+        応答がなくなったワーカーのジョブをキューに戻し、古い終了したジョブと停止したワーカーの登録を削除します。
+        処理し直した回数が max_attempts に達したジョブは失敗にします。
+
+        Args:
+            stale_after: 応答がないとみなすまでの秒数
+            max_attempts: 処理する回数の上限
+
+        Returns:
+            キューに戻したジョブIDのリスト
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                stale = [row["job_id"] for row in self._conn.execute(
+                    "SELECT job_id FROM jobs WHERE status = ? AND heartbeat_at < ? AND attempts < ? AND cancel_requested = 0",
+                    (RUNNING, now - stale_after, max_attempts)
+                )]
+                self._conn.executemany("UPDATE jobs SET status = ?, worker_id = NULL WHERE job_id = ?",
+                                       [(QUEUED, job_id) for job_id in stale])
+                self._conn.execute(
+                    "UPDATE jobs SET status = CASE WHEN cancel_requested THEN ? ELSE ? END, finished_at = ?, api_key = NULL, "
+                    "error = CASE WHEN cancel_requested THEN NULL ELSE ? END WHERE status = ? AND heartbeat_at < ?",
+                    (CANCELLED, FAILED, now, "ワーカーが応答しなくなりました", RUNNING, now - stale_after)
+                )
+                self._conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - RETENTION_SECONDS,))
+                self._conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (now - stale_after,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return stale
+
+    def stats(self) -> Dict[str, int]:
+        """
+        状態ごとのジョブ数と、応答のあるワーカーの数を取得します。
+
+        Returns:
+            状態ごとのジョブ数と "workers" の辞書
+        """
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        stats = {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+        stats["workers"] = self.active_workers()
+        return stats
+
+@lru_cache(maxsize=None)
+def get_job_queue() -> JobQueue:
+    """
+    プロセス全体で共有するジョブのキューを取得します。
+
+    Returns:
+        JobQueueインスタンス
+    """
+    return JobQueue()
@@ -0,0 +1,301 @@
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from .result_cache import DATA_DIR, PRIVATE_FILE_MODE, make_private_dir
+
+# ジョブのチェックポイントを保存するディレクトリ
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+
+# 再実行で結果を再利用するために残しておく、所有者ごとの完了したジョブの数
+MAX_COMPLETED_JOBS = 5
+
+# ジョブごとに保存するファイルの拡張子
+# チャンクの結果は1行に1つずつ追記し、一覧の表示には結果やチャンクを含まない概要だけを読む
+JOB_SUFFIX = ".json"
+RESULTS_SUFFIX = ".results.jsonl"
+SUMMARY_SUFFIX = ".summary.json"
+
+_lock = threading.Lock()
+
+@dataclass
+class Job:
+    """
+    チェックポイントとして保存される整文化ジョブです。
+    チャンク、設定、完了したチャンクの結果と、逐次処理で引き継ぐ文書の状態を保持します。
+    複数の利用者で共有する場合は、設定の "owner" に所有者の識別子（owner_for_api_key の戻り値）を保存します。
+    chunk_states には、各チャンクを処理した直後の文書の状態を保持します（再実行時に結果を再利用できるか判定するため）。
+    """
+    job_id: str
+    chunks: List[str]
+    settings: Dict[str, Any]
+    results: Dict[int, str] = field(default_factory=dict)
+    document_state: Dict[str, Any] = field(default_factory=dict)
+    chunk_states: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def owner(self) -> Optional[str]:
+        """ジョブの所有者の識別子（設定されていない場合はNone）"""
+        return self.settings.get("owner")
+
+    @property
+    def missing_indices(self) -> List[int]:
+        """未処理のチャンクの位置のリスト"""
+        return [i for i in range(len(self.chunks)) if i not in self.results]
+
+    @property
+    def is_complete(self) -> bool:
+        """すべてのチャンクが処理済みかどうか"""
+        return len(self.results) >= len(self.chunks)
+
+    def ordered_results(self) -> List[str]:
+        """
+        完了したチャンクの結果をチャンクの順序で取得します。
+
+        Returns:
+            処理結果のリスト（未処理のチャンクは含まない）
+        """
+        return [self.results[i] for i in sorted(self.results)]
+
+@dataclass
+class JobSummary:
+    """
+    ジョブの一覧に表示するための、チャンクや結果を含まない概要です。
+    一覧を表示するたびにすべてのジョブのチャンクと結果を読み込まないように、ジョブとは別のファイルに保存します。
+    """
+    job_id: str
+    settings: Dict[str, Any]
+    total_chunks: int
+    completed_chunks: int
+    created_at: float
+    updated_at: float
+
+    @property
+    def owner(self) -> Optional[str]:
+        """ジョブの所有者の識別子（設定されていない場合はNone）"""
+        return self.settings.get("owner")
+
+    @property
+    def is_complete(self) -> bool:
+        """すべてのチャンクが処理済みかどうか"""
+        return self.completed_chunks >= self.total_chunks
+
+def _job_path(job_id: str, jobs_dir: Optional[str] = None, suffix: str = JOB_SUFFIX) -> str:
+    return os.path.join(jobs_dir or JOBS_DIR, f"{job_id}{suffix}")
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    """書き込み途中で失敗しても既存のファイルが壊れないように、一時ファイルに書いてから置き換えます。"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # 文字起こしを含むため、所有者だけが読み書きできる権限で作成する
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, PRIVATE_FILE_MODE), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _summarize(job: Job) -> JobSummary:
+    return JobSummary(job_id=job.job_id, settings=job.settings, total_chunks=len(job.chunks),
+                      completed_chunks=len(job.results), created_at=job.created_at, updated_at=job.updated_at)
+
+def save_job(job: Job, jobs_dir: Optional[str] = None) -> None:
+    """
+    ジョブをチェックポイントとして保存します。書き込み途中で失敗しても既存のファイルは壊れません。
+    追記されたチャンクの結果もジョブのファイルにまとめ、結果のファイルは削除します。
+
+    Args:
+        job: 保存するジョブ
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+    """
+    path = _job_path(job.job_id, jobs_dir)
+    make_private_dir(os.path.dirname(path))
+    with _lock:
+        job.updated_at = time.time()
+        data = asdict(job)
+        # JSONのキーは文字列になるため、読み込み時に整数へ戻す
+        data["results"] = {str(i): result for i, result in job.results.items()}
+        data["chunk_states"] = {str(i): state for i, state in job.chunk_states.items()}
+        _write_json(path, data)
+        # まとめた後で削除するため、途中で失敗しても同じ結果が2回読み込まれるだけで済む
+        try:
+            os.remove(_job_path(job.job_id, jobs_dir, RESULTS_SUFFIX))
+        except FileNotFoundError:
+            pass
+        _write_json(_job_path(job.job_id, jobs_dir, SUMMARY_SUFFIX), asdict(_summarize(job)))
+
+def create_job(chunks: List[str], settings: Dict[str, Any], jobs_dir: Optional[str] = None) -> Job:
+    """
+    新しいジョブを作成して保存します。
+
+    Args:
+        chunks: 整文化するチャンクのリスト
+        settings: 背景情報やモデル名などの処理設定
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+
+    Returns:
+        作成されたジョブ
+    """
+    job = Job(job_id=time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8], chunks=list(chunks), settings=dict(settings))
+    save_job(job, jobs_dir)
+    return job
+
+def load_job(job_id: str, jobs_dir: Optional[str] = None) -> Job:
+    """
+    保存されたジョブを読み込みます。
+
+    Args:
+        job_id: ジョブID
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+
+    Returns:
+        読み込まれたジョブ
+
+    Raises:
+        FileNotFoundError: ジョブが存在しない場合
+    """
+    with open(_job_path(job_id, jobs_dir), encoding="utf-8") as f:
+        data = json.load(f)
+    data["results"] = {int(i): result for i, result in data.get("results", {}).items()}
+    data["chunk_states"] = {int(i): state for i, state in data.get("chunk_states", {}).items()}
+    job = Job(**data)
+    # ジョブのファイルを保存した後に追記されたチャンクの結果を反映する
+    try:
+        with open(_job_path(job_id, jobs_dir, RESULTS_SUFFIX), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 追記の途中で中断された行は無視する（そのチャンクは再開時に処理し直す）
+                    continue
+                job.results[entry["index"]] = entry["result"]
+                if entry.get("document_state") is not None:
+                    job.document_state = entry["document_state"]
+                    job.chunk_states[entry["index"]] = entry["document_state"]
+    except FileNotFoundError:
+        pass
+    return job
+
+def record_result(job: Job, index: int, result: str, jobs_dir: Optional[str] = None,
+                  document_state: Optional[Dict[str, Any]] = None) -> None:
+    """
+    チャンクの処理結果をジョブに記録し、チェックポイントを更新します。
+    ジョブ全体を書き直さずに結果のファイルへ1行追記するため、チャンク数が多くても記録にかかる時間は増えません。
+
+    Args:
+        job: 対象のジョブ
+        index: チャンクの位置
+        result: 整文化されたテキスト
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+        document_state: このチャンクまでを反映した文書の状態（DocumentState.to_dict の戻り値、オプション）
+    """
+    job.results[index] = result
+    if document_state is not None:
+        job.document_state = document_state
+        job.chunk_states[index] = document_state
+    path = _job_path(job.job_id, jobs_dir, RESULTS_SUFFIX)
+    line = json.dumps({"index": index, "result": result, "document_state": document_state}, ensure_ascii=False) + "\n"
+    with _lock:
+        job.updated_at = time.time()
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, PRIVATE_FILE_MODE), "w", encoding="utf-8") as f:
+            f.write(line)
+        _write_json(_job_path(job.job_id, jobs_dir, SUMMARY_SUFFIX), asdict(_summarize(job)))
+
+def _load_summary(job_id: str, jobs_dir: str) -> JobSummary:
+    try:
+        with open(_job_path(job_id, jobs_dir, SUMMARY_SUFFIX), encoding="utf-8") as f:
+            return JobSummary(**json.load(f))
+    except FileNotFoundError:
+        # 概要のない以前のジョブは、一度だけ読み込んで概要を作成する
+        summary = _summarize(load_job(job_id, jobs_dir))
+        with _lock:
+            _write_json(_job_path(job_id, jobs_dir, SUMMARY_SUFFIX), asdict(summary))
+        return summary
+
+def list_jobs(include_complete: bool = False, jobs_dir: Optional[str] = None, owner: Optional[str] = None) -> List[JobSummary]:
+    """
+    保存されたジョブの概要を新しい順に取得します。チャンクや結果は読み込まないため、ジョブが大きくても時間はかかりません。
+
+    Args:
+        include_complete: 完了済みのジョブも含めるかどうか
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+        owner: この所有者のジョブだけを取得する（オプション）
+
+    Returns:
+        ジョブの概要のリスト（ジョブ全体は load_job で読み込む）
+    """
+    directory = jobs_dir or JOBS_DIR
+    if not os.path.isdir(directory):
+        return []
+
+    jobs = []
+    for name in os.listdir(directory):
+        if not name.endswith(JOB_SUFFIX) or name.endswith(SUMMARY_SUFFIX):
+            continue
+        try:
+            job = _load_summary(name[:-len(JOB_SUFFIX)], directory)
+        except (OSError, ValueError, TypeError):
+            # 壊れたファイルや書き込み途中のファイルは無視する
+            continue
+        if owner is not None and job.owner != owner:
+            continue
+        if include_complete or not job.is_complete:
+            jobs.append(job)
+    return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+def find_previous_job(settings: Dict[str, Any], keys: Tuple[str, ...] = ("background", "model_name", "mode", "context_mode"),
+                      jobs_dir: Optional[str] = None) -> Optional[Job]:
+    """
+    同じ設定で完了した最新のジョブを探します。文字起こしを編集して再実行するときに、変わっていないチャンクの結果を再利用するために使います。
+    ほかの利用者の結果を使わないように、所有者（設定の "owner"）が同じジョブだけを探します。
+
+    Args:
+        settings: これから実行するジョブの設定
+        keys: 一致を確認する設定の項目
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+
+    Returns:
+        完了したジョブ（見つからない場合はNone）
+    """
+    for summary in list_jobs(include_complete=True, jobs_dir=jobs_dir):
+        if (summary.is_complete and summary.owner == settings.get("owner")
+                and all(summary.settings.get(key) == settings.get(key) for key in keys)):
+            try:
+                return load_job(summary.job_id, jobs_dir)
+            except (OSError, ValueError, TypeError):
+                continue
+    return None
+
+def prune_completed_jobs(keep: int = MAX_COMPLETED_JOBS, jobs_dir: Optional[str] = None, owner: Optional[str] = None) -> None:
+    """
+    完了したジョブのうち、所有者ごとに新しいものを keep 件だけ残して削除します。
+    ほかの利用者がジョブを実行しても、自分の再実行で再利用する結果は削除されません。
+
+    Args:
+        keep: 所有者ごとに残す完了したジョブの数
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+        owner: この所有者のジョブだけを整理する（省略時はすべての所有者）
+    """
+    kept: Dict[Optional[str], int] = {}
+    for job in list_jobs(include_complete=True, jobs_dir=jobs_dir, owner=owner):
+        if not job.is_complete:
+            continue
+        kept[job.owner] = kept.get(job.owner, 0) + 1
+        if kept[job.owner] > keep:
+            delete_job(job.job_id, jobs_dir)
+
+def delete_job(job_id: str, jobs_dir: Optional[str] = None) -> None:
+    """
+    ジョブのチェックポイントを削除します。
+
+    Args:
+        job_id: ジョブID
+        jobs_dir: 保存先ディレクトリ（省略時は既定のディレクトリ）
+    """
+    for suffix in (SUMMARY_SUFFIX, RESULTS_SUFFIX, JOB_SUFFIX):
+        try:
+            os.remove(_job_path(job_id, jobs_dir, suffix))
+        except FileNotFoundError:
+            pass
\ No newline at end of file
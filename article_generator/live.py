@@ -0,0 +1,253 @@
+"""
+録音中の会議の文字起こしファイルを追いかけながら、追記された部分を順に整文化します。
+音声認識エンジンが追記するファイルを一定間隔で読み、十分な量のテキストがたまるか、
+タイムスタンプが一定時間進んだ時点でチャンクを確定させ、直前までの文脈を使ってすぐに整文化して出力に追記します。
+会議が終わってファイルが更新されなくなると、残りのテキストを処理して終了します。
+
+    talk-to-article --follow meeting.txt --output-dir articles
+"""
+import codecs
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from .article_formalizer import (
+    CONTEXT_MODE, build_context_window, formalize_chunk, formalize_with_context, formalize_with_state,
+    get_chunk_token_budget
+)
+from .document_state import DocumentState
+from .instrumentation import chunk_scope
+from .token_estimator import estimate_tokens, output_ratio_scope
+from .transcript_splitter import TIMESTAMP_PATTERN, split_transcript, timestamp_to_seconds
+
+logger = logging.getLogger(__name__)
+
+# 追記を確認する間隔（秒）
+FOLLOW_INTERVAL = 1.0
+
+# 1チャンクのトークン数の目安（小さいほど、話してから整文化されるまでの遅れが短くなる）
+LIVE_CHUNK_TOKENS = 1500
+
+# タイムスタンプや追記の停止でチャンクを確定させるときの、最小のトークン数
+MIN_LIVE_CHUNK_TOKENS = 200
+
+# チャンクの先頭からタイムスタンプがこの秒数だけ進んだら、トークン数が少なくてもチャンクを確定させる
+MAX_CHUNK_SECONDS = 120
+
+# 追記がこの秒数止まったら、たまっているテキストを確定させる（発言の合間）
+FLUSH_AFTER = 30.0
+
+# 追記がこの秒数止まったら、会議が終わったとみなして終了する
+IDLE_TIMEOUT = 300.0
+
+# 改行のないまま長くなった行は、文の区切りで途中まで読み進める
+MAX_PARTIAL_LINE_CHARS = 4000
+
+class TranscriptTail:
+    """
+    ファイルに追記されたテキストを、前回の読み込み位置から行単位で読み込みます。
+    マルチバイト文字の途中で読み込みが区切られても、文字が壊れないように復号します。
+    """
+
+    def __init__(self, path: str, encoding: str = "utf-8"):
+        self.path = path
+        self.offset = 0
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self._partial = ""
+
+    def read_lines(self) -> str:
+        """
+        前回から追記された、改行で終わる行を読み込みます。
+
+        Returns:
+            追記された完全な行（追記がない場合は空文字列）
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return ""
+        if size < self.offset:
+            # ファイルが切り詰められた場合は、処理済みの部分を繰り返さないように末尾から読み直す
+            logger.warning(f"{self.path} が短くなりました。以降の追記だけを処理します。")
+            self.offset = size
+            return ""
+        if size == self.offset:
+            return ""
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+
+        text = self._partial + self._decoder.decode(data)
+        cut = text.rfind("\n") + 1
+        if cut == 0 and len(text) > MAX_PARTIAL_LINE_CHARS:
+            cut = max(text.rfind("。"), text.rfind(". ")) + 1
+        self._partial = text[cut:]
+        return text[:cut]
+
+    def read_rest(self) -> str:
+        """
+        改行で終わっていない最後の行も含めて、残りのテキストをすべて読み込みます。
+
+        Returns:
+            残りのテキスト
+        """
+        text = self.read_lines() + self._partial + self._decoder.decode(b"", final=True)
+        self._partial = ""
+        return text
+
+class LiveChunker:
+    """
+    追記されたテキストをためておき、チャンクとして確定できた部分から返します。
+    """
+
+    def __init__(self, chunk_tokens: int = LIVE_CHUNK_TOKENS, min_tokens: int = MIN_LIVE_CHUNK_TOKENS,
+                 max_chunk_seconds: int = MAX_CHUNK_SECONDS):
+        self.chunk_tokens = chunk_tokens
+        self.min_tokens = min(min_tokens, chunk_tokens)
+        self.max_chunk_seconds = max_chunk_seconds
+        self._lines: List[str] = []
+        self._tokens = 0
+
+    @property
+    def pending_tokens(self) -> int:
+        """まだチャンクとして確定していないテキストの推定トークン数"""
+        return self._tokens
+
+    def add(self, text: str) -> List[str]:
+        """
+        追記されたテキストを加え、確定したチャンクを返します。
+        トークン数が目安に達したか、タイムスタンプが一定時間進んだ時点でチャンクを確定させます。
+
+        Args:
+            text: 追記された行
+
+        Returns:
+            確定したチャンクのリスト
+        """
+        chunks = []
+        for line in text.splitlines(keepends=True):
+            tokens = estimate_tokens(line)
+            if self._lines and self._tokens + tokens > self.chunk_tokens:
+                chunks += self._take()
+            self._lines.append(line)
+            self._tokens += tokens
+        if self._tokens >= self.min_tokens and self._timestamp_span() >= self.max_chunk_seconds:
+            chunks += self._take()
+        return chunks
+
+    def flush(self, final: bool = False) -> List[str]:
+        """
+        ためているテキストをチャンクとして確定させます。
+
+        Args:
+            final: Trueの場合は最小のトークン数に満たなくても確定させる（ファイルの終わり）
+
+        Returns:
+            確定したチャンクのリスト
+        """
+        if self._tokens == 0 or (not final and self._tokens < self.min_tokens):
+            return []
+        return self._take()
+
+    def _timestamp_span(self) -> int:
+        timestamps = [timestamp_to_seconds(match.group(0))
+                      for line in (self._lines[0], self._lines[-1]) for match in TIMESTAMP_PATTERN.finditer(line)]
+        return timestamps[-1] - timestamps[0] if len(timestamps) >= 2 else 0
+
+    def _take(self) -> List[str]:
+        text = "".join(self._lines).strip()
+        self._lines, self._tokens = [], 0
+        if not text:
+            return []
+        # 1行だけで目安を超える場合は、文の区切りなどで分割する
+        return split_transcript(text, self.chunk_tokens)
+
+def follow_transcript(path: str, output_path: str, background: Optional[str] = None,
+                      model_name: str = "claude-3-7-sonnet-latest", chunk_tokens: Optional[int] = None,
+                      context_mode: str = CONTEXT_MODE, poll_interval: float = FOLLOW_INTERVAL,
+                      flush_after: float = FLUSH_AFTER, idle_timeout: float = IDLE_TIMEOUT,
+                      stop_event: Optional[threading.Event] = None,
+                      chunk_callback: Optional[Callable[[int, str], None]] = None) -> str:
+    """
+    追記されていく文字起こしファイルを追いかけながら整文化し、結果を出力ファイルに順に追記します。
+    各チャンクは、"state" モードでは文書の状態、"previous" モードでは直前の処理結果をコンテキストにして処理します。
+
+    Args:
+        path: 文字起こしファイルのパス（まだ存在しなくてもよい）
+        output_path: 整文化したテキストを追記するファイルのパス（最初に空にする）
+        background: 背景情報（オプション）
+        model_name: 使用するAnthropicモデル名
+        chunk_tokens: 1チャンクのトークン数の目安（省略時はモデルの上限と LIVE_CHUNK_TOKENS の小さいほう）
+        context_mode: 次のチャンクに渡すコンテキスト（"state" または "previous"）
+        poll_interval: 追記を確認する間隔（秒）
+        flush_after: 追記がこの秒数止まったら、たまっているテキストを確定させる
+        idle_timeout: 追記がこの秒数止まったら終了する
+        stop_event: セットされたら残りを処理して終了するイベント（オプション）
+        chunk_callback: チャンクの位置と整文化されたテキストを受け取るコールバック関数（オプション）
+
+    Returns:
+        整文化された完全なテキスト
+    """
+    if chunk_tokens is None:
+        chunk_tokens = min(LIVE_CHUNK_TOKENS, get_chunk_token_budget(model_name, background))
+    tail = TranscriptTail(path)
+    chunker = LiveChunker(chunk_tokens)
+    state = DocumentState()
+    results: List[str] = []
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8"):
+        pass
+
+    def process(chunk: str) -> None:
+        nonlocal state
+        index = len(results)
+        logger.info(f"チャンク {index + 1} を処理中...（{estimate_tokens(chunk)} トークン）")
+        with chunk_scope(index):
+            if context_mode == "state":
+                result, state = formalize_with_state(chunk, state, background, model_name)
+            elif results:
+                result = formalize_with_context(chunk, build_context_window(results)[0], background, model_name)
+            else:
+                result = formalize_chunk(chunk, background, model_name)
+        results.append(result)
+        with open(output_path, "a", encoding="utf-8") as f:
+            f.write(result + "\n")
+        if chunk_callback:
+            chunk_callback(index, result)
+
+    # 出力の倍率はこの文字起こしの中で記録し、ほかの文字起こしの影響を受けないようにする
+    with output_ratio_scope():
+        last_growth = time.monotonic()
+        while True:
+            text = tail.read_lines()
+            now = time.monotonic()
+            if text:
+                last_growth = now
+                chunks = chunker.add(text)
+            elif now - last_growth >= flush_after:
+                chunks = chunker.flush()
+            else:
+                chunks = []
+            for chunk in chunks:
+                process(chunk)
+
+            if stop_event is not None and stop_event.is_set():
+                break
+            # 処理中に追記された分は次の読み込みで受け取るため、追記がなかったときだけ終了を判定する
+            if not text and now - last_growth >= idle_timeout:
+                logger.info(f"{idle_timeout:.0f} 秒間追記がないため、終了します")
+                break
+            if stop_event is not None:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+
+        chunks = chunker.add(tail.read_rest()) + chunker.flush(final=True)
+        for chunk in chunks:
+            process(chunk)
+    return "\n".join(results)
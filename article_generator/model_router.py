@@ -0,0 +1,280 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from .rate_limiter import get_scheduler
+from .token_estimator import estimate_tokens
+from .transcript_splitter import FILLER_PATTERN, SPEAKER_PATTERN, TIMESTAMP_PATTERN, extract_speakers, timestamp_to_seconds
+
+# 難しいチャンクを処理するモデルと、易しいチャンクを処理する高速なモデルの既定値
+STRONG_MODEL = "claude-3-7-sonnet-latest"
+FAST_MODEL = "claude-3-5-haiku-latest"
+
+# 難易度のスコアがこの値以上のチャンクは強いモデルで処理する
+DIFFICULTY_THRESHOLD = 0.4
+
+# 難易度のスコアに使う特徴量の重み（合計が1になるようにする）
+DIFFICULTY_WEIGHTS = {
+    "speaker_switches": 0.35,
+    "speakers": 0.15,
+    "fillers": 0.25,
+    "short_turns": 0.15,
+    "timestamp_gaps": 0.1,
+}
+
+# 各特徴量がこの値に達したら最も難しいとみなす
+SPEAKER_SWITCHES_SATURATION = 6.0   # 1000トークンあたりの話者の交代数
+SPEAKERS_SATURATION = 5             # 話者の数
+FILLERS_SATURATION = 15.0           # 1000トークンあたりのフィラーの数
+TIMESTAMP_GAP_SATURATION = 60       # 秒
+
+# 短い発言（相づちや割り込み）とみなす1発言あたりの推定トークン数
+SHORT_TURN_TOKENS = 15
+
+# 出力の推定トークン数が入力に対してこの範囲を外れる場合は、強いモデルで処理し直す
+MIN_OUTPUT_RATIO = 0.4
+MAX_OUTPUT_RATIO = 2.5
+
+# 入力の話者のうち、出力に現れる話者がこの割合を下回る場合は、強いモデルで処理し直す
+MIN_SPEAKER_COVERAGE = 0.5
+
+# モデルごとの料金（100万トークンあたりのUSD、入力・出力）
+MODEL_PRICES: Dict[str, Dict[str, float]] = {
+    "claude-3-7-sonnet-latest": {"input": 3.0, "output": 15.0},
+    "claude-3-5-sonnet-latest": {"input": 3.0, "output": 15.0},
+    "claude-3-5-haiku-latest": {"input": 0.8, "output": 4.0},
+    "claude-3-opus-latest": {"input": 15.0, "output": 75.0},
+    "claude-3-haiku-latest": {"input": 0.25, "output": 1.25},
+}
+
+# プロンプトキャッシュの読み込み・書き込みの料金（入力の料金に対する倍率）
+CACHE_READ_PRICE_RATIO = 0.1
+CACHE_WRITE_PRICE_RATIO = 1.25
+
+# 送信前の正規化で取り除いたフィラーの密度（1000トークンあたり）。チャンクのフィラーの密度に加える
+_removed_filler_density: "contextvars.ContextVar[float]" = contextvars.ContextVar("talk_to_article_removed_filler_density",
+                                                                                  default=0.0)
+
+@contextmanager
+def removed_fillers_scope(density: float) -> Iterator[None]:
+    """
+    この中の難易度の判定では、送信前の正規化で取り除いたフィラーもチャンクに残っているものとして数えます。
+    正規化した文字起こしのチャンクからはフィラーが消えているため、そのままでは難しいチャンクも易しいと判定されます。
+
+    Args:
+        density: 取り除いたフィラーの密度（NormalizedTranscript.filler_density）
+    """
+    token = _removed_filler_density.set(density)
+    try:
+        yield
+    finally:
+        _removed_filler_density.reset(token)
+
+def chunk_features(chunk: str) -> Dict[str, float]:
+    """
+    チャンクの難易度の判定に使う特徴量を、APIを呼び出さずに求めます。
+
+    Args:
+        chunk: 文字起こしチャンク
+
+    Returns:
+        話者の交代数・話者数・フィラーの密度（removed_fillers_scope の中では正規化で取り除いた分を含む）・
+        短い発言の割合・タイムスタンプの最大の間隔の辞書
+    """
+    tokens = max(1, estimate_tokens(chunk))
+    labels = [match.group(1).strip() for match in SPEAKER_PATTERN.finditer(chunk)]
+    switches = sum(1 for previous, current in zip(labels, labels[1:]) if previous != current)
+
+    turns = [turn for turn in SPEAKER_PATTERN.split(chunk)[2::2] if turn.strip()]
+    short_turns = sum(1 for turn in turns if estimate_tokens(turn) <= SHORT_TURN_TOKENS)
+
+    timestamps = [timestamp_to_seconds(timestamp) for timestamp in TIMESTAMP_PATTERN.findall(chunk)]
+    gaps = [current - previous for previous, current in zip(timestamps, timestamps[1:]) if current >= previous]
+
+    return {
+        "speaker_switches": switches * 1000 / tokens,
+        "speakers": len(set(labels)),
+        "fillers": len(FILLER_PATTERN.findall(chunk)) * 1000 / tokens + _removed_filler_density.get(),
+        "short_turns": short_turns / len(turns) if turns else 0.0,
+        "timestamp_gaps": max(gaps, default=0),
+    }
+
+def score_chunk(chunk: str) -> float:
+    """
+    チャンクの難易度を0から1のスコアで求めます。
+    話者の交代が多い、フィラーや相づちが多い、タイムスタンプが飛んでいる（聞き取れなかった区間がある）
+    チャンクほど、スコアが高くなります。
+
+    Args:
+        chunk: 文字起こしチャンク
+
+    Returns:
+        難易度のスコア（0が最も易しく、1が最も難しい）
+    """
+    features = chunk_features(chunk)
+    normalized = {
+        "speaker_switches": features["speaker_switches"] / SPEAKER_SWITCHES_SATURATION,
+        "speakers": max(0, features["speakers"] - 1) / (SPEAKERS_SATURATION - 1),
+        "fillers": features["fillers"] / FILLERS_SATURATION,
+        "short_turns": features["short_turns"],
+        "timestamp_gaps": features["timestamp_gaps"] / TIMESTAMP_GAP_SATURATION,
+    }
+    return round(sum(weight * min(1.0, normalized[name]) for name, weight in DIFFICULTY_WEIGHTS.items()), 3)
+
+def looks_suspicious(chunk: str, output: str) -> bool:
+    """
+    整文化結果が不完全な可能性があるかどうかを判定します。
+    出力が入力に比べて短すぎる・長すぎる場合や、入力の話者の多くが出力に現れない場合に該当します。
+
+    Args:
+        chunk: 文字起こしチャンク
+        output: 整文化されたテキスト
+
+    Returns:
+        強いモデルで処理し直すべき場合はTrue
+    """
+    input_tokens = estimate_tokens(chunk)
+    output_tokens = estimate_tokens(output)
+    if input_tokens and not MIN_OUTPUT_RATIO <= output_tokens / input_tokens <= MAX_OUTPUT_RATIO:
+        return True
+
+    speakers = extract_speakers(chunk)
+    if speakers:
+        covered = sum(1 for speaker in speakers if speaker in output)
+        if covered / len(speakers) < MIN_SPEAKER_COVERAGE:
+            return True
+    return False
+
+def estimate_cost(model_name: str, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0,
+                  cache_write_tokens: int = 0) -> Optional[float]:
+    """
+    トークン使用量から料金を概算します。
+
+    Args:
+        model_name: モデル名
+        input_tokens: 入力トークン数（キャッシュの読み込み・書き込みの分を含む）
+        output_tokens: 出力トークン数
+        cache_read_tokens: キャッシュから読み込んだ入力トークン数
+        cache_write_tokens: キャッシュに書き込んだ入力トークン数
+
+    Returns:
+        料金（USD）。料金が不明なモデルの場合はNone
+    """
+    prices = MODEL_PRICES.get(model_name)
+    if prices is None:
+        return None
+    uncached = input_tokens - cache_read_tokens - cache_write_tokens
+    input_cost = (uncached + cache_read_tokens * CACHE_READ_PRICE_RATIO + cache_write_tokens * CACHE_WRITE_PRICE_RATIO) * prices["input"]
+    return (input_cost + output_tokens * prices["output"]) / 1_000_000
+
+class ModelRouter:
+    """
+    チャンクの難易度に応じて、整文化に使うモデルを選びます。
+    易しいチャンクは高速なモデルで、難しいチャンクは強いモデルで処理し、
+    高速なモデルの結果が不完全に見える場合は強いモデルで処理し直します。
+    モデルごとの処理数・処理時間・トークン使用量を集計し、実行の最後に報告します。
+    """
+
+    def __init__(self, strong_model: str = STRONG_MODEL, fast_model: str = FAST_MODEL,
+                 threshold: float = DIFFICULTY_THRESHOLD, escalate: bool = True):
+        """
+        Args:
+            strong_model: 難しいチャンクと処理し直しに使うモデル
+            fast_model: 易しいチャンクに使う高速なモデル
+            threshold: 強いモデルで処理する難易度のスコアのしきい値
+            escalate: 高速なモデルの結果が不完全に見える場合に、強いモデルで処理し直すかどうか
+        """
+        self.strong_model = strong_model
+        self.fast_model = fast_model
+        self.threshold = threshold
+        self.escalate = escalate
+        self._lock = threading.Lock()
+        self._stats = {model: {"chunks": 0, "escalations": 0, "seconds": 0.0} for model in self.models}
+        # 実行中に使ったトークン数を求めるため、開始時点のスケジューラの集計を記録する
+        self._baseline = {model: get_scheduler(model).metrics() for model in self.models}
+
+    @property
+    def models(self) -> List[str]:
+        """使用するモデルのリスト（重複なし）"""
+        return list(dict.fromkeys([self.fast_model, self.strong_model]))
+
+    def route(self, chunk: str) -> str:
+        """
+        チャンクを処理するモデルを選びます。
+
+        Args:
+            chunk: 文字起こしチャンク
+
+        Returns:
+            モデル名
+        """
+        return self.strong_model if score_chunk(chunk) >= self.threshold else self.fast_model
+
+    def should_escalate(self, model_name: str, chunk: str, output: str) -> bool:
+        """
+        結果を強いモデルで処理し直すべきかどうかを判定します。
+
+        Args:
+            model_name: 結果を生成したモデル
+            chunk: 文字起こしチャンク
+            output: 整文化されたテキスト
+
+        Returns:
+            処理し直すべき場合はTrue
+        """
+        return self.escalate and model_name != self.strong_model and looks_suspicious(chunk, output)
+
+    def record(self, model_name: str, seconds: float, escalated: bool = False) -> None:
+        """
+        1チャンクの処理結果を集計に加えます。
+
+        Args:
+            model_name: 処理したモデル
+            seconds: 処理にかかった時間（秒）
+            escalated: 処理し直しによる呼び出しかどうか
+        """
+        with self._lock:
+            stats = self._stats.setdefault(model_name, {"chunks": 0, "escalations": 0, "seconds": 0.0})
+            stats["chunks"] += 1
+            stats["seconds"] += seconds
+            if escalated:
+                stats["escalations"] += 1
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """
+        モデルごとの処理数・処理し直しの数・平均処理時間・トークン使用量・概算料金を取得します。
+        トークン使用量は、このルーターの作成以降に、現在のAPIキー（get_api_key）のスケジューラが集計した分です。
+
+        Returns:
+            モデル名と集計の辞書
+        """
+        report = {}
+        with self._lock:
+            stats = {model: dict(values) for model, values in self._stats.items()}
+        for model, values in stats.items():
+            metrics = get_scheduler(model).metrics()
+            baseline = self._baseline.get(model, {})
+            usage = {name: metrics[name] - baseline.get(name, 0)
+                     for name in ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")}
+            cost = estimate_cost(model, **usage)
+            report[model] = {
+                "chunks": values["chunks"],
+                "escalations": values["escalations"],
+                "average_seconds": round(values["seconds"] / values["chunks"], 3) if values["chunks"] else 0.0,
+                **usage,
+                "cost_usd": round(cost, 4) if cost is not None else None,
+            }
+        return report
+
+    def format_report(self) -> str:
+        """
+        report の内容をログや画面に表示するための文字列にします。
+        """
+        lines = []
+        for model, values in self.report().items():
+            cost = f"${values['cost_usd']:.4f}" if values["cost_usd"] is not None else "不明"
+            lines.append(f"{model}: {values['chunks']} チャンク（うち処理し直し {values['escalations']}）、"
+                         f"平均 {values['average_seconds']:.2f} 秒、入力 {values['input_tokens']} / 出力 {values['output_tokens']} トークン、"
+                         f"料金 {cost}")
+        return "\n".join(lines)
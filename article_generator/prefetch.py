@@ -0,0 +1,325 @@
+"""
+文字起こしが入力された時点で、ボタンが押される前にバックグラウンドで処理を始める先読みです。
+入力が一定時間変わらなければ、チャンクへの分割と料金の見積もり、疑問点の生成を始め、
+背景情報がなければ最初のいくつかのチャンクも整文化して結果キャッシュに保存します。
+ボタンが押されたときに入力と設定が同じであれば、分割の結果と生成された疑問点をそのまま使い、
+整文化は結果キャッシュから返るため、最初の出力までの待ち時間がほとんどなくなります。
+入力や設定が変わった場合は、先読みを打ち切って結果を捨てます（キャッシュに保存された結果は、同じ入力のときだけ使われます）。
+"""
+import contextvars
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from .article_formalizer import (
+    STATE_OUTPUT_TOKENS, build_light_context, create_system_prompt, formalize_chunk, formalize_with_context,
+    formalize_with_state, generate_questions, get_chunk_token_budget
+)
+from .document_state import DocumentState
+from .instrumentation import chunk_scope
+from .model_router import estimate_cost
+from .token_estimator import estimate_tokens, output_ratio_scope
+from .transcript_splitter import NormalizedTranscript, extract_speakers, normalize_transcript, split_transcript
+from .utils import use_api_key
+
+logger = logging.getLogger(__name__)
+
+# 入力がこの秒数変わらなければ、先読みを始める
+DEBOUNCE_SECONDS = 1.5
+
+# 背景情報がない場合に、先に整文化しておくチャンクの数
+PREFETCH_CHUNKS = 2
+
+# 先読みに使うスレッドの数（分割・疑問点の生成・整文化）
+PREFETCH_WORKERS = 4
+
+def prepare_chunks(transcript: str, models: List[str], background: Optional[str] = None,
+                   normalize: bool = True) -> Tuple[List[str], Optional[NormalizedTranscript]]:
+    """
+    整文化の前処理として、文字起こしを正規化し、どのモデルでも処理できる大きさのチャンクに分割します。
+    先読みとボタンが押されたときの処理で同じチャンクになるように、どちらもこの関数で分割します。
+
+    Args:
+        transcript: 文字起こしテキスト
+        models: 使用するモデル名のリスト（モデルを切り替える場合は複数）
+        background: 背景情報（オプション）
+        normalize: フィラーやどもりを取り除いてから分割するかどうか
+
+    Returns:
+        チャンクのリストと、正規化の結果（正規化しない場合はNone）のタプル
+    """
+    normalized = normalize_transcript(transcript) if normalize else None
+    text = normalized.text if normalized is not None else transcript
+    # 内容に基づいて分割し、文字起こしを少し編集して再実行しても、ほかのチャンクの境界が変わらないようにする
+    chunks = split_transcript(text, min(get_chunk_token_budget(model, background) for model in models), content_defined=True)
+    return chunks, normalized
+
+def estimate_formalization(chunks: List[str], model_name: str, background: Optional[str] = None) -> Tuple[int, int, Optional[float]]:
+    """
+    チャンクを整文化するときの入出力のトークン数と料金を概算します。
+    出力は入力のチャンクと同じくらいの長さに、文書の状態の更新分を加えたものとして見積もります。
+
+    Returns:
+        入力トークン数、出力トークン数、料金（USD、料金が不明なモデルの場合はNone）のタプル
+    """
+    prompt_tokens = estimate_tokens(create_system_prompt(with_state=True)) + estimate_tokens(background or "")
+    chunk_tokens = [estimate_tokens(chunk) for chunk in chunks]
+    input_tokens = sum(chunk_tokens) + prompt_tokens * len(chunks)
+    output_tokens = sum(chunk_tokens) + STATE_OUTPUT_TOKENS * len(chunks)
+    return input_tokens, output_tokens, estimate_cost(model_name, input_tokens, output_tokens)
+
+def _digest(*parts: object) -> str:
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+@dataclass
+class Prefetch:
+    """
+    1つの入力に対する先読みの状態です。
+    """
+    key: str
+    transcript: str
+    model_name: str
+    chunks: List[str] = field(default_factory=list)
+    normalized: Optional[NormalizedTranscript] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    estimated_cost: Optional[float] = None
+    # 先に整文化を終えたチャンクの数
+    formalized_chunks: int = 0
+    # 先に整文化する予定のチャンクの数
+    planned_chunks: int = 0
+    error: Optional[str] = None
+    prepared: Future = field(default_factory=Future, repr=False)
+    questions: Optional[Future] = field(default=None, repr=False)
+    formalized: Optional[Future] = field(default=None, repr=False)
+    # 待ち時間を待たずに始める（ボタンが押された場合、打ち切る場合）
+    start: threading.Event = field(default_factory=threading.Event, repr=False)
+    # 先読みを打ち切る（入力や設定が変わった場合、ボタンが押された場合）
+    stop: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def cancel(self) -> None:
+        """先読みを打ち切ります。待ち時間中であれば、すぐに終わらせます。"""
+        self.stop.set()
+        self.start.set()
+
+    @property
+    def is_finished(self) -> bool:
+        """分割・疑問点の生成・整文化の先読みがすべて終わったかどうか"""
+        futures = [self.prepared, self.questions, self.formalized]
+        return all(future is None or future.done() for future in futures)
+
+    def settle(self, timeout: Optional[float] = None) -> None:
+        """
+        これ以上のチャンクの先読みを打ち切り、処理中のチャンクが終わるまで待ちます。
+        処理中のチャンクはボタンが押された後の処理でも同じ呼び出しになるため、待ってから結果キャッシュを使います。
+        """
+        self.stop.set()
+        if self.formalized is not None:
+            try:
+                self.formalized.result(timeout)
+            except Exception:
+                # 先読みの失敗は無視し、ボタンが押された後の処理でやり直す
+                pass
+
+class Prefetcher:
+    """
+    入力が変わるたびに先読みを予約し、最新の入力に対する先読みだけを残します。
+    Streamlitのセッションごとに1つ作成します（APIキーはセッションごとに異なるため）。
+    セッションごとにスレッドが増えないように、スレッドプールは executor でセッション間で共有できます。
+    """
+
+    def __init__(self, debounce_seconds: float = DEBOUNCE_SECONDS, prefetch_chunks: int = PREFETCH_CHUNKS,
+                 max_workers: int = PREFETCH_WORKERS, executor: Optional[ThreadPoolExecutor] = None):
+        """
+        Args:
+            debounce_seconds: 入力がこの秒数変わらなければ先読みを始める
+            prefetch_chunks: 背景情報がない場合に、先に整文化しておくチャンクの数
+            max_workers: 先読みに使うスレッドの数（executor を指定しない場合）
+            executor: 複数のPrefetcherで共有するスレッドプール（省略時は max_workers で作成し、close で破棄）
+        """
+        self.debounce_seconds = debounce_seconds
+        self.prefetch_chunks = prefetch_chunks
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._current: Optional[Prefetch] = None
+        # 背景情報や処理モードだけが変わった場合も、同じ文字起こしの疑問点は生成し直さない
+        self._questions: Optional[Tuple[str, Future]] = None
+
+    @staticmethod
+    def make_key(transcript: str, model_name: str, models: List[str], background: Optional[str], mode: str,
+                 normalize: bool) -> str:
+        """入力と設定から先読みのキーを作成します。"""
+        return _digest(transcript, model_name, tuple(models), background or "", mode, normalize)
+
+    def schedule(self, transcript: str, model_name: str, api_key: Optional[str], background: Optional[str] = None,
+                 mode: str = "sequential", normalize: bool = True, fast_model: Optional[str] = None) -> Prefetch:
+        """
+        入力に対する先読みを予約します。同じ入力と設定で予約済みの場合は、それを返します。
+        入力が変わった場合は、前の先読みを打ち切ります。
+
+        Args:
+            transcript: 文字起こしテキスト
+            model_name: 使用するモデル名
+            api_key: 先読みに使うAPIキー
+            background: 背景情報（ある場合は整文化を先読みしない）
+            mode: 処理モード（"sequential" または "parallel"）
+            normalize: フィラーやどもりを取り除いてから分割するかどうか
+            fast_model: チャンクの難易度に応じてモデルを切り替える場合の、易しいチャンクのモデル（整文化を先読みしない）
+
+        Returns:
+            予約した先読み
+        """
+        models = [model_name] + ([fast_model] if fast_model else [])
+        key = self.make_key(transcript, model_name, models, background, mode, normalize)
+        with self._lock:
+            if self._current is not None and self._current.key == key:
+                return self._current
+            if self._current is not None:
+                self._current.cancel()
+            prefetch = Prefetch(key=key, transcript=transcript, model_name=model_name)
+            self._current = prefetch
+        # どのモデルで処理されるかが決まっていない場合は、結果キャッシュが使われないため整文化は先読みしない
+        formalize = not background and not fast_model
+        self._executor.submit(self._run, prefetch, models, background, mode, normalize, formalize, api_key)
+        return prefetch
+
+    def get(self, transcript: str, model_name: str, background: Optional[str] = None, mode: str = "sequential",
+            normalize: bool = True, fast_model: Optional[str] = None) -> Optional[Prefetch]:
+        """
+        入力と設定が同じ先読みを返します。待ち時間中であればすぐに始めさせ、分割が終わるまで待ちます。
+
+        Returns:
+            先読み（入力や設定が異なる場合、先読みが失敗した場合はNone）
+        """
+        models = [model_name] + ([fast_model] if fast_model else [])
+        key = self.make_key(transcript, model_name, models, background, mode, normalize)
+        with self._lock:
+            prefetch = self._current
+        if prefetch is None or prefetch.key != key:
+            return None
+        prefetch.start.set()
+        try:
+            prefetch.prepared.result()
+        except Exception:
+            return None
+        return prefetch
+
+    def questions(self, transcript: str, model_name: str) -> Optional[Future]:
+        """
+        文字起こしとモデルが同じ疑問点の生成を返します（先読みしていない場合はNone）。
+        """
+        with self._lock:
+            entry = self._questions
+            prefetch = self._current
+        if prefetch is not None and prefetch.transcript == transcript and prefetch.model_name == model_name:
+            prefetch.start.set()
+            try:
+                prefetch.prepared.result()
+            except Exception:
+                pass
+            with self._lock:
+                entry = self._questions
+        if entry is None or entry[0] != _digest(transcript, model_name):
+            return None
+        future = entry[1]
+        # 失敗した先読みは使わず、ボタンが押された後の処理で生成し直す
+        if future.done() and future.exception() is not None:
+            return None
+        return future
+
+    def discard(self) -> None:
+        """先読みを打ち切り、結果を捨てます。"""
+        with self._lock:
+            if self._current is not None:
+                self._current.cancel()
+            self._current = None
+
+    def close(self) -> None:
+        """先読みを打ち切り、このPrefetcherが作成したスレッドプールを破棄します（共有のスレッドプールは破棄しません）。"""
+        self.discard()
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, prefetch: Prefetch, models: List[str], background: Optional[str], mode: str, normalize: bool,
+             formalize: bool, api_key: Optional[str]) -> None:
+        # 入力が変わらないまま待ち時間が過ぎるか、ボタンが押されるまで待つ
+        prefetch.start.wait(self.debounce_seconds)
+        if prefetch.stop.is_set():
+            prefetch.prepared.cancel()
+            return
+        prefetch.prepared.set_running_or_notify_cancel()
+        try:
+            prefetch.chunks, prefetch.normalized = prepare_chunks(prefetch.transcript, models, background, normalize)
+            prefetch.input_tokens, prefetch.output_tokens, prefetch.estimated_cost = estimate_formalization(
+                prefetch.chunks, prefetch.model_name, background)
+        except Exception as e:
+            logger.exception("先読みでの分割に失敗しました")
+            prefetch.error = f"{type(e).__name__}: {e}"
+            prefetch.prepared.set_exception(e)
+            return
+
+        questions_key = _digest(prefetch.transcript, prefetch.model_name)
+        with self._lock:
+            if self._questions is None or self._questions[0] != questions_key:
+                self._questions = (questions_key, self._executor.submit(
+                    self._with_api_key, api_key, generate_questions, prefetch.transcript, prefetch.model_name))
+            prefetch.questions = self._questions[1]
+            if formalize and self.prefetch_chunks > 0:
+                prefetch.planned_chunks = min(self.prefetch_chunks, len(prefetch.chunks))
+                prefetch.formalized = self._executor.submit(self._with_api_key, api_key, self._formalize, prefetch, mode,
+                                                            background)
+        prefetch.prepared.set_result(prefetch)
+        logger.info(f"先読み: {len(prefetch.chunks)} チャンク、入力 {prefetch.input_tokens} トークン")
+
+    @staticmethod
+    def _with_api_key(api_key: Optional[str], func, *args):
+        # 先読みのスレッドにはStreamlitのコンテキストがないため、予約したときのAPIキーを使う
+        with use_api_key(api_key):
+            return func(*args)
+
+    def _formalize(self, prefetch: Prefetch, mode: str, background: Optional[str]) -> None:
+        """
+        最初のチャンクから順に、ボタンが押された後の処理と同じ呼び出しで整文化し、結果キャッシュに保存します。
+        打ち切られた場合は、処理中のチャンクが終わった時点でやめます。
+        出力の倍率は、ほかの利用者の文字起こしの影響を受けないように、この先読みの中で記録します。
+        """
+        with output_ratio_scope():
+            self._formalize_chunks(prefetch, mode, background)
+
+    @staticmethod
+    def _formalize_chunks(prefetch: Prefetch, mode: str, background: Optional[str]) -> None:
+        chunks = prefetch.chunks
+        if mode == "parallel":
+            # 並列処理モードでは、各チャンクのコンテキストがほかのチャンクの結果によらないため、同時に処理する
+            speakers = extract_speakers("\n".join(chunks))
+            
+            def process(index: int) -> None:
+                if prefetch.stop.is_set():
+                    return
+                context = build_light_context(chunks, index, speakers)
+                with chunk_scope(index):
+                    if context:
+                        formalize_with_context(chunks[index], context, background, prefetch.model_name)
+                    else:
+                        formalize_chunk(chunks[index], background, prefetch.model_name)
+                prefetch.formalized_chunks += 1
+            
+            # APIキーをワーカースレッドに引き継ぐため、チャンクごとにコンテキストを複製する
+            with ThreadPoolExecutor(max_workers=max(1, prefetch.planned_chunks)) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, process, index)
+                           for index in range(prefetch.planned_chunks)]
+            for future in futures:
+                future.result()
+            return
+
+        state = DocumentState()
+        for index in range(prefetch.planned_chunks):
+            if prefetch.stop.is_set():
+                return
+            with chunk_scope(index):
+                _, state = formalize_with_state(chunks[index], state, background, prefetch.model_name)
+            prefetch.formalized_chunks += 1
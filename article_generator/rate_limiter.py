@@ -0,0 +1,532 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Mapping, Optional, Tuple, TypeVar
+
+from .utils import get_api_key, owner_for_api_key
+
+T = TypeVar("T")
+
+def _env_limit(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+# 1分あたりのリクエスト数と入力トークン数の上限（環境変数、またはAPIキーとモデルの組ごとに configure_scheduler で変更できる）
+# 既定では制限せず、レート制限（429）の応答のヘッダーで上限を知らされたら、その値まで下げる
+REQUESTS_PER_MINUTE = _env_limit("TALK_TO_ARTICLE_RPM")
+TOKENS_PER_MINUTE = _env_limit("TALK_TO_ARTICLE_TPM")
+
+# アカウントの上限を知らせる応答ヘッダー（入力トークンの上限がない場合は合計のトークンの上限を使う）
+REQUESTS_LIMIT_HEADER = "anthropic-ratelimit-requests-limit"
+TOKENS_LIMIT_HEADERS = ("anthropic-ratelimit-input-tokens-limit", "anthropic-ratelimit-tokens-limit")
+
+# 同時実行数の初期値と範囲（利用者が並列数を指定した場合は、seed_concurrency でその数まで引き上げる）
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+
+# リトライの回数と待機時間（秒）
+MAX_RETRIES = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+# 再試行するHTTPステータス（429: レート制限、529: 過負荷、5xx: 一時的なサーバーエラー）
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+THROTTLE_STATUS_CODES = {429, 529}
+
+# 空き待ちの間隔（秒）
+POLL_INTERVAL = 0.05
+
+# スロットリングを受けてからこの秒数の間は、seed_concurrency で同時実行数を引き上げない
+SEED_COOLDOWN = 60.0
+
+# 保持するスケジューラの数の上限（APIキーとモデル名の組ごと）。超えたら、処理中でないものを古い順に破棄する
+MAX_SCHEDULERS = 256
+
+class RequestScheduler:
+    """
+    モデルへのリクエストを仲介するスケジューラです。
+    1分あたりのリクエスト数とトークン数を追跡して送信を待たせ、
+    レート制限や過負荷の応答はretry-afterを尊重したジッター付きバックオフで再試行します。
+    上限を指定しない場合は制限せずに送信し、レート制限の応答のヘッダーからアカウントの上限を学習します。
+    同時実行数はAIMD（加算的増加・乗算的減少）で調整します。
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = REQUESTS_PER_MINUTE,
+                 tokens_per_minute: Optional[int] = TOKENS_PER_MINUTE,
+                 initial_concurrency: int = INITIAL_CONCURRENCY, min_concurrency: int = MIN_CONCURRENCY,
+                 max_concurrency: int = MAX_CONCURRENCY, max_retries: int = MAX_RETRIES,
+                 base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY):
+        """
+        Args:
+            requests_per_minute: 1分あたりの最大リクエスト数（Noneの場合は応答のヘッダーで知らされるまで制限しない）
+            tokens_per_minute: 1分あたりの最大入力トークン数（Noneの場合は応答のヘッダーで知らされるまで制限しない）
+            initial_concurrency: 同時実行数の初期値
+            min_concurrency: 同時実行数の下限
+            max_concurrency: 同時実行数の上限
+            max_retries: 1リクエストあたりの最大再試行回数
+            base_delay: バックオフの基準秒数
+            max_delay: バックオフの最大秒数
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(max(min_concurrency, min(initial_concurrency, max_concurrency)))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._window: Deque[Tuple[float, int]] = deque()
+        self._in_flight = 0
+        self._waiting = 0
+        self._started_at = time.monotonic()
+        self._requests = 0
+        self._completed = 0
+        self._retries = 0
+        self._throttled = 0
+        self._last_throttled: Optional[float] = None
+        self._failures = 0
+        self._tokens = 0
+        self._queue_wait = 0.0
+        self._input_tokens = 0
+        self._output_tokens = 0
+        self._cache_read_tokens = 0
+        self._cache_write_tokens = 0
+
+    def _try_acquire(self, tokens: int) -> Optional[float]:
+        """
+        送信枠を確保します。
+
+        Returns:
+            確保できた場合はNone、できない場合は次に試すまでの待機秒数
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._window and now - self._window[0][0] >= 60:
+                self._window.popleft()
+
+            if self._in_flight >= int(self.concurrency_limit):
+                return POLL_INTERVAL
+
+            window_tokens = sum(t for _, t in self._window)
+            over_requests = self.requests_per_minute is not None and len(self._window) >= self.requests_per_minute
+            # 1リクエストだけで上限を超える場合は、ウィンドウが空になれば送信を許可する
+            over_tokens = (self.tokens_per_minute is not None and self._window
+                           and window_tokens + tokens > self.tokens_per_minute)
+            if over_requests or over_tokens:
+                return max(POLL_INTERVAL, 60 - (now - self._window[0][0]))
+
+            self._window.append((now, tokens))
+            self._in_flight += 1
+            self._requests += 1
+            self._tokens += tokens
+            return None
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _on_success(self) -> None:
+        with self._lock:
+            self._completed += 1
+            # 加算的増加: 現在の上限分のリクエストが成功するごとに1ずつ増やす
+            self.concurrency_limit = min(float(self.max_concurrency), self.concurrency_limit + 1.0 / self.concurrency_limit)
+
+    def seed_concurrency(self, concurrency: int) -> None:
+        """
+        同時実行数の上限を、指定した数まで引き上げます。
+        加算的増加だけでは上限が増えるまでに多くの呼び出しが必要なため、利用者が指定した並列数を最初から使えるようにします。
+        直近にスロットリングを受けた場合は、減らした上限を保つために引き上げません。
+
+        Args:
+            concurrency: 同時実行数（max_concurrency を超える分は切り捨てる）
+        """
+        with self._lock:
+            if self._last_throttled is not None and time.monotonic() - self._last_throttled < SEED_COOLDOWN:
+                return
+            target = float(max(self.min_concurrency, min(concurrency, self.max_concurrency)))
+            self.concurrency_limit = max(self.concurrency_limit, target)
+
+    def update_limits(self, headers: Mapping[str, str]) -> None:
+        """
+        応答のレート制限のヘッダーから、アカウントの1分あたりの上限を取り込みます。
+        上限は下げる方向にだけ更新します（環境変数で指定した値より厳しい場合も、ヘッダーの値に従います）。
+
+        Args:
+            headers: 応答のヘッダー
+        """
+        requests_limit, tokens_limit = get_rate_limits(headers)
+        with self._lock:
+            if requests_limit is not None and (self.requests_per_minute is None or requests_limit < self.requests_per_minute):
+                self.requests_per_minute = requests_limit
+            if tokens_limit is not None and (self.tokens_per_minute is None or tokens_limit < self.tokens_per_minute):
+                self.tokens_per_minute = tokens_limit
+
+    def _on_retry(self, throttled: bool) -> None:
+        with self._lock:
+            self._retries += 1
+            if throttled:
+                self._throttled += 1
+                self._last_throttled = time.monotonic()
+                # 乗算的減少: スロットリングされたら上限を半分にする
+                self.concurrency_limit = max(float(self.min_concurrency), self.concurrency_limit / 2)
+
+    def _on_throttle_or_retry(self, error: Exception) -> None:
+        throttled = is_throttle_error(error)
+        if throttled:
+            headers = getattr(getattr(error, "response", None), "headers", None)
+            if headers:
+                self.update_limits(headers)
+        self._on_retry(throttled)
+
+    def _on_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+
+    def record_usage(self, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> None:
+        """
+        モデルの応答で報告されたトークン使用量を集計に加えます。
+        
+        Args:
+            input_tokens: 入力トークン数（キャッシュの読み込み・書き込み分を含む）
+            output_tokens: 出力トークン数
+            cache_read_tokens: キャッシュから読み込まれた入力トークン数
+            cache_write_tokens: キャッシュに書き込まれた入力トークン数
+        """
+        with self._lock:
+            self._input_tokens += input_tokens
+            self._output_tokens += output_tokens
+            self._cache_read_tokens += cache_read_tokens
+            self._cache_write_tokens += cache_write_tokens
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        再試行するまでの待機秒数を求めます。
+
+        Returns:
+            再試行する場合は待機秒数、再試行しない場合はNone
+        """
+        if attempt >= self.max_retries or not is_retryable_error(error):
+            return None
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            # サーバーが指定した待機時間を守り、同時に再試行が集中しないよう少しずらす
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        return backoff
+
+    def call(self, func: Callable[[], T], estimated_tokens: int = 0, stats: Optional[Dict[str, Any]] = None) -> T:
+        """
+        レート制限に従ってfuncを実行し、一時的なエラーは再試行します。
+
+        Args:
+            func: モデルを呼び出す関数
+            estimated_tokens: このリクエストの推定入力トークン数
+            stats: このリクエストの待ち時間（queue_wait_seconds）と再試行回数（retries）を書き込む辞書（オプション）
+
+        Returns:
+            funcの戻り値
+        """
+        attempt = 0
+        while True:
+            self._track(stats, self._wait_for_slot(estimated_tokens), attempt)
+            try:
+                result = func()
+            except Exception as e:
+                self._release()
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self._on_failure()
+                    raise
+                self._on_throttle_or_retry(e)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._release()
+            self._on_success()
+            return result
+
+    async def acall(self, func: Callable[[], Awaitable[T]], estimated_tokens: int = 0,
+                    stats: Optional[Dict[str, Any]] = None) -> T:
+        """
+        レート制限に従って非同期関数funcを実行し、一時的なエラーは再試行します。
+
+        Args:
+            func: モデルを呼び出すコルーチンを返す関数
+            estimated_tokens: このリクエストの推定入力トークン数
+            stats: このリクエストの待ち時間（queue_wait_seconds）と再試行回数（retries）を書き込む辞書（オプション）
+
+        Returns:
+            funcの戻り値
+        """
+        attempt = 0
+        while True:
+            self._track(stats, await self._await_slot(estimated_tokens), attempt)
+            try:
+                result = await func()
+            except Exception as e:
+                self._release()
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self._on_failure()
+                    raise
+                self._on_throttle_or_retry(e)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._release()
+            self._on_success()
+            return result
+
+    def stream(self, func: Callable[[], Iterator[T]], estimated_tokens: int = 0,
+               stats: Optional[Dict[str, Any]] = None) -> Iterator[T]:
+        """
+        レート制限に従ってストリーミング呼び出しを実行し、受け取った要素を順に返します。
+        最初の要素を受け取る前に発生した一時的なエラーだけを再試行します。
+
+        Args:
+            func: ストリーミングのイテレータを返す関数
+            estimated_tokens: このリクエストの推定入力トークン数
+            stats: このリクエストの待ち時間（queue_wait_seconds）と再試行回数（retries）を書き込む辞書（オプション）
+
+        Yields:
+            funcのイテレータの要素
+        """
+        attempt = 0
+        while True:
+            self._track(stats, self._wait_for_slot(estimated_tokens), attempt)
+            started = False
+            try:
+                for item in func():
+                    started = True
+                    yield item
+            except Exception as e:
+                self._release()
+                delay = None if started else self._retry_delay(e, attempt)
+                if delay is None:
+                    self._on_failure()
+                    raise
+                self._on_throttle_or_retry(e)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # 呼び出し側がイテレータを途中で閉じた場合も枠を解放する
+                self._release()
+                raise
+            self._release()
+            self._on_success()
+            return
+
+    @staticmethod
+    def _track(stats: Optional[Dict[str, Any]], waited: float, attempt: int) -> None:
+        if stats is not None:
+            stats["queue_wait_seconds"] = stats.get("queue_wait_seconds", 0.0) + waited
+            stats["retries"] = attempt
+
+    def _wait_for_slot(self, tokens: int) -> float:
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait is None:
+                    break
+                time.sleep(min(wait, 1.0))
+        finally:
+            waited = time.monotonic() - started
+            with self._lock:
+                self._waiting -= 1
+                self._queue_wait += waited
+        return waited
+
+    async def _await_slot(self, tokens: int) -> float:
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait is None:
+                    break
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            waited = time.monotonic() - started
+            with self._lock:
+                self._waiting -= 1
+                self._queue_wait += waited
+        return waited
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        スケジューラの状態と実績を取得します。
+
+        Returns:
+            1分あたりの上限（制限しない場合はNone）、待機中のリクエスト数、実行中のリクエスト数、同時実行数の上限、再試行回数、
+            実効スループット（1分あたりの完了リクエスト数とトークン数）、
+            応答で報告されたトークン使用量（キャッシュの読み込み・書き込みを含む）などの辞書
+        """
+        with self._lock:
+            elapsed_minutes = max(time.monotonic() - self._started_at, 1e-9) / 60
+            return {
+                "requests_per_minute_limit": self.requests_per_minute,
+                "tokens_per_minute_limit": self.tokens_per_minute,
+                "queue_depth": self._waiting,
+                "in_flight": self._in_flight,
+                "concurrency_limit": round(self.concurrency_limit, 2),
+                "requests": self._requests,
+                "completed": self._completed,
+                "retries": self._retries,
+                "throttled": self._throttled,
+                "failures": self._failures,
+                "total_queue_wait_seconds": round(self._queue_wait, 3),
+                "requests_per_minute": round(self._completed / elapsed_minutes, 2),
+                "tokens_per_minute": round(self._tokens / elapsed_minutes, 2),
+                "input_tokens": self._input_tokens,
+                "output_tokens": self._output_tokens,
+                "cache_read_tokens": self._cache_read_tokens,
+                "cache_write_tokens": self._cache_write_tokens,
+            }
+
+def _status_code(error: Exception) -> Optional[int]:
+    # anthropic の読み込みには時間がかかるため、エラーを判定するときに読み込む
+    import anthropic
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code
+    return getattr(error, "status_code", None)
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    一時的なエラーで再試行すべきかどうかを判定します。
+
+    Args:
+        error: 発生した例外
+
+    Returns:
+        再試行すべき場合はTrue
+    """
+    import anthropic
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return _status_code(error) in RETRYABLE_STATUS_CODES
+
+def is_throttle_error(error: Exception) -> bool:
+    """
+    レート制限または過負荷によるエラーかどうかを判定します。
+
+    Args:
+        error: 発生した例外
+
+    Returns:
+        スロットリングによるエラーの場合はTrue
+    """
+    return _status_code(error) in THROTTLE_STATUS_CODES
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    エラー応答のretry-afterヘッダーから待機秒数を取得します。
+
+    Args:
+        error: 発生した例外
+
+    Returns:
+        待機秒数（ヘッダーがない場合はNone）
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+def get_rate_limits(headers: Mapping[str, str]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    応答のレート制限のヘッダーから、1分あたりのリクエスト数と入力トークン数の上限を取得します。
+
+    Args:
+        headers: 応答のヘッダー
+
+    Returns:
+        リクエスト数とトークン数の上限のタプル（ヘッダーがない場合はNone）
+    """
+    def read(name: str) -> Optional[int]:
+        value = headers.get(name)
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            return None
+
+    tokens_limit = None
+    for name in TOKENS_LIMIT_HEADERS:
+        tokens_limit = read(name)
+        if tokens_limit is not None:
+            break
+    return read(REQUESTS_LIMIT_HEADER), tokens_limit
+
+# APIキーの所有者の識別子とモデル名の組ごとのスケジューラ（最近使ったものほど後ろ）
+_schedulers: Dict[Tuple[Optional[str], str], RequestScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+def _scheduler_key(model_name: str, api_key: Optional[str]) -> Tuple[Optional[str], str]:
+    if api_key is None:
+        api_key = get_api_key()
+    return (owner_for_api_key(api_key) if api_key else None, model_name)
+
+def _evict_idle_schedulers() -> None:
+    # 処理中のリクエストがあるスケジューラは、同時実行数の管理が崩れないように残す
+    for key in list(_schedulers):
+        if len(_schedulers) <= MAX_SCHEDULERS:
+            break
+        scheduler = _schedulers[key]
+        if not scheduler._in_flight and not scheduler._waiting:
+            del _schedulers[key]
+
+def get_scheduler(model_name: str, api_key: Optional[str] = None) -> RequestScheduler:
+    """
+    APIキーとモデルの組ごとのスケジューラを取得します。
+    レート制限はAPIキーのアカウントごとに課されるため、同時実行数・学習した上限・使用量の集計は
+    ほかの利用者のキーと共有しません。
+
+    Args:
+        model_name: モデル名
+        api_key: APIキー（省略時は get_api_key で取得）
+
+    Returns:
+        RequestSchedulerインスタンス
+    """
+    key = _scheduler_key(model_name, api_key)
+    with _schedulers_lock:
+        scheduler = _schedulers.pop(key, None)
+        if scheduler is None:
+            scheduler = RequestScheduler()
+        _schedulers[key] = scheduler
+        _evict_idle_schedulers()
+        return scheduler
+
+def configure_scheduler(model_name: str, api_key: Optional[str] = None, **kwargs: Any) -> RequestScheduler:
+    """
+    APIキーとモデルの組のスケジューラを指定した設定で作り直します。
+
+    Args:
+        model_name: モデル名
+        api_key: APIキー（省略時は get_api_key で取得）
+        **kwargs: RequestSchedulerの引数
+
+    Returns:
+        新しいRequestSchedulerインスタンス
+    """
+    key = _scheduler_key(model_name, api_key)
+    with _schedulers_lock:
+        _schedulers.pop(key, None)
+        _schedulers[key] = RequestScheduler(**kwargs)
+        _evict_idle_schedulers()
+        return _schedulers[key]
\ No newline at end of file
@@ -0,0 +1,236 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+# キャッシュやジョブのデータを保存するディレクトリ
+DATA_DIR = os.environ.get("TALK_TO_ARTICLE_DATA_DIR", os.path.join(os.path.expanduser("~"), ".cache", "talk-to-article"))
+
+# キャッシュの容量と保持期間の既定値
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+MAX_CACHE_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# 書き込みこの回数ごとに古いエントリの削除を行う
+EVICTION_INTERVAL = 50
+
+# データディレクトリに作成するディレクトリとファイルの権限（文字起こしやAPIキーをほかのユーザーから読めないようにする）
+PRIVATE_DIR_MODE = 0o700
+PRIVATE_FILE_MODE = 0o600
+
+def make_private_dir(path: str) -> None:
+    """
+    ディレクトリがなければ、所有者だけがアクセスできる権限で作成します。
+    既存のディレクトリの権限は変えません（共有のディレクトリをデータディレクトリに指定された場合に備えるため）。
+
+    Args:
+        path: ディレクトリのパス
+    """
+    os.makedirs(path, mode=PRIVATE_DIR_MODE, exist_ok=True)
+
+def create_private_file(path: str) -> None:
+    """
+    ファイルを所有者だけが読み書きできる権限にします（なければ空のファイルを作成します）。
+    SQLiteのデータベースでは、WALと共有メモリのファイルも同じ権限にします（SQLiteは後からデータベースと同じ権限で作成します）。
+
+    Args:
+        path: ファイルのパス
+    """
+    make_private_dir(os.path.dirname(os.path.abspath(path)))
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT, PRIVATE_FILE_MODE))
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.chmod(path + suffix, PRIVATE_FILE_MODE)
+
+class ResultCache:
+    """
+    整文化結果をSQLiteに保存する、内容アドレス方式のキャッシュです。
+    キーはモデル名・プロンプトのバージョン・チャンク・背景情報・コンテキスト・所有者のハッシュです。
+    複数の利用者で共有する場合は所有者（owner_for_api_key の戻り値）を指定し、結果や統計、削除を所有者ごとに分けます。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = MAX_CACHE_BYTES, max_age_seconds: int = MAX_CACHE_AGE_SECONDS):
+        """
+        Args:
+            path: SQLiteファイルのパス（省略時はデータディレクトリ内）
+            max_bytes: キャッシュ全体の最大サイズ（バイト）
+            max_age_seconds: エントリを保持する最大秒数
+        """
+        self.path = path or os.path.join(DATA_DIR, "result_cache.sqlite3")
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        # 所有者ごとのヒット数とミス数
+        self._owner_counts: Dict[Optional[str], Dict[str, int]] = {}
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        create_private_file(self.path)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL, owner TEXT)"
+        )
+        # 所有者の列がない以前のキャッシュには列を追加する（既存のエントリはどの利用者にも使われず、期限切れで削除される）
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(results)")]
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE results ADD COLUMN owner TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_owner ON results (owner)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model_name: str, prompt_version: str, chunk: str, background: Optional[str] = None, context: Optional[str] = None,
+                 owner: Optional[str] = None) -> str:
+        """
+        キャッシュキーを作成します。
+
+        Args:
+            model_name: 使用するモデル名
+            prompt_version: プロンプトテンプレートのバージョン
+            chunk: 文字起こしチャンク
+            background: 背景情報（オプション）
+            context: コンテキスト（オプション）
+            owner: 結果の所有者の識別子（オプション）
+
+        Returns:
+            SHA-256のハッシュ文字列
+        """
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_version, chunk, background, context, owner):
+            # Noneと空文字列を区別し、区切りが曖昧にならないように長さを前置する
+            encoded = b"\x00" if part is None else part.encode("utf-8")
+            digest.update(str(len(encoded)).encode("ascii") + b":" + encoded)
+        return digest.hexdigest()
+
+    def _count(self, owner: Optional[str], name: str) -> None:
+        counts = self._owner_counts.setdefault(owner, {"hits": 0, "misses": 0})
+        counts[name] += 1
+
+    def get(self, key: str, owner: Optional[str] = None) -> Optional[str]:
+        """
+        キャッシュから結果を取得します。
+
+        Args:
+            key: キャッシュキー
+            owner: 結果の所有者の識別子（ヒット数とミス数を所有者ごとに数えるため）
+
+        Returns:
+            保存されている結果（存在しないか期限切れの場合はNone）
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM results WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                self._count(owner, "misses")
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            self._count(owner, "hits")
+            return row[0]
+
+    def set(self, key: str, value: str, owner: Optional[str] = None) -> None:
+        """
+        結果をキャッシュに保存します。
+
+        Args:
+            key: キャッシュキー
+            value: 保存する結果
+            owner: 結果の所有者の識別子（所有者ごとに削除できるように保存する）
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, created_at, accessed_at, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now, owner)
+            )
+            self._conn.commit()
+            self._writes += 1
+            should_evict = self._writes % EVICTION_INTERVAL == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        期限切れのエントリを削除し、容量を超えている場合は最近使われていないエントリから削除します。
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total > self.max_bytes:
+                stale_keys = []
+                for key, size in self._conn.execute("SELECT key, size FROM results ORDER BY accessed_at"):
+                    if total <= self.max_bytes:
+                        break
+                    stale_keys.append((key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM results WHERE key = ?", stale_keys)
+            self._conn.commit()
+
+    def clear(self, owner: Optional[str] = None) -> None:
+        """
+        キャッシュを空にし、ヒット数とミス数をリセットします。
+        所有者を指定した場合は、その所有者のエントリと統計だけを削除します。
+
+        Args:
+            owner: 削除する所有者の識別子（省略時はすべての所有者。運営者がCLIなどから使う）
+        """
+        with self._lock:
+            if owner is None:
+                self._conn.execute("DELETE FROM results")
+                self.hits = 0
+                self.misses = 0
+                self._owner_counts.clear()
+            else:
+                self._conn.execute("DELETE FROM results WHERE owner = ?", (owner,))
+                counts = self._owner_counts.pop(owner, {"hits": 0, "misses": 0})
+                self.hits -= counts["hits"]
+                self.misses -= counts["misses"]
+            self._conn.commit()
+
+    def stats(self, owner: Optional[str] = None) -> Dict[str, int]:
+        """
+        キャッシュの統計情報を取得します。
+
+        Args:
+            owner: 統計を取得する所有者の識別子（省略時はすべての所有者の合計）
+
+        Returns:
+            ヒット数、ミス数、エントリ数、合計サイズ（バイト）の辞書
+        """
+        with self._lock:
+            if owner is None:
+                entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+                counts = {"hits": self.hits, "misses": self.misses}
+            else:
+                entries, size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results WHERE owner = ?", (owner,)
+                ).fetchone()
+                counts = dict(self._owner_counts.get(owner, {"hits": 0, "misses": 0}))
+        return {**counts, "entries": entries, "size_bytes": size}
+
+_result_cache: Optional[ResultCache] = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache() -> ResultCache:
+    """
+    プロセス全体で共有する結果キャッシュを取得します。
+    複数のスレッドから同時に最初に呼ばれても、作成するのは1つだけです（ヒット数とミス数が分かれないようにするため）。
+
+    Returns:
+        ResultCacheインスタンス
+    """
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
\ No newline at end of file
@@ -0,0 +1,290 @@
+import contextvars
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+# 文字種ごとの1文字あたりの推定トークン数（日本語と英語の文字起こしで較正した値）
+HIRAGANA_WEIGHT = 0.75
+KATAKANA_WEIGHT = 0.9
+KANJI_WEIGHT = 1.25
+CJK_PUNCTUATION_WEIGHT = 1.0
+OTHER_WEIGHT = 1.0
+
+# 英単語と数字の並びの1トークンあたりの平均文字数
+CHARS_PER_WORD_TOKEN = 4.0
+CHARS_PER_DIGIT_TOKEN = 3.0
+
+HIRAGANA_PATTERN = re.compile(r'[ぁ-ゟ]')
+KATAKANA_PATTERN = re.compile(r'[゠-ヿｦ-ﾟ]')
+KANJI_PATTERN = re.compile(r'[㐀-䶿一-鿿豈-﫿]')
+CJK_PUNCTUATION_PATTERN = re.compile(r'[　-〿＀-･]')
+WORD_PATTERN = re.compile(r'[A-Za-z]+')
+DIGIT_PATTERN = re.compile(r'[0-9]+')
+WHITESPACE_PATTERN = re.compile(r'[ \t\r\f\v]')
+
+# モデルごとのコンテキストウィンドウと最大出力トークン数
+MODEL_LIMITS: Dict[str, Dict[str, int]] = {
+    "claude-3-7-sonnet-latest": {"context_window": 200000, "max_output_tokens": 8192},
+    "claude-3-5-sonnet-latest": {"context_window": 200000, "max_output_tokens": 8192},
+    "claude-3-5-haiku-latest": {"context_window": 200000, "max_output_tokens": 8192},
+    "claude-3-opus-latest": {"context_window": 200000, "max_output_tokens": 4096},
+    "claude-3-haiku-latest": {"context_window": 200000, "max_output_tokens": 4096},
+}
+DEFAULT_MODEL_LIMITS = {"context_window": 200000, "max_output_tokens": 4096}
+
+# 整文化の出力トークン数は入力チャンクのおよそこの倍率になる（話者ラベルやマークダウンの分だけ増える）
+OUTPUT_RATIO = 1.2
+
+# 実際の出力の倍率の指数移動平均で、新しい記録に掛ける重み
+OUTPUT_RATIO_SMOOTHING = 0.3
+
+# 記録した倍率として使う範囲（短すぎるチャンクや、途中で切れた出力による外れ値を除く）
+MIN_OUTPUT_RATIO = 0.5
+MAX_OUTPUT_RATIO = 3.0
+
+# 倍率を記録するチャンクの最小トークン数
+MIN_RATIO_SAMPLE_TOKENS = 200
+
+# 出力上限に対して確保しておく余裕の割合
+OUTPUT_SAFETY_MARGIN = 0.9
+
+# チャンクの最小トークン数
+MIN_CHUNK_TOKENS = 500
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算します。
+    ひらがな・カタカナ・漢字・英単語・数字などの文字種ごとに重みを付けて数えます。
+
+    Args:
+        text: トークン数を見積もるテキスト
+
+    Returns:
+        推定トークン数
+    """
+    if not text:
+        return 0
+
+    hiragana = len(HIRAGANA_PATTERN.findall(text))
+    katakana = len(KATAKANA_PATTERN.findall(text))
+    kanji = len(KANJI_PATTERN.findall(text))
+    punctuation = len(CJK_PUNCTUATION_PATTERN.findall(text))
+    words = WORD_PATTERN.findall(text)
+    digits = DIGIT_PATTERN.findall(text)
+    whitespace = len(WHITESPACE_PATTERN.findall(text))
+
+    word_chars = sum(len(word) for word in words)
+    digit_chars = sum(len(digit) for digit in digits)
+    other = len(text) - hiragana - katakana - kanji - punctuation - word_chars - digit_chars - whitespace
+
+    tokens = (hiragana * HIRAGANA_WEIGHT
+              + katakana * KATAKANA_WEIGHT
+              + kanji * KANJI_WEIGHT
+              + punctuation * CJK_PUNCTUATION_WEIGHT
+              + sum(max(1.0, len(word) / CHARS_PER_WORD_TOKEN) for word in words)
+              + sum(max(1.0, len(digit) / CHARS_PER_DIGIT_TOKEN) for digit in digits)
+              + other * OTHER_WEIGHT)
+    return int(tokens + 0.5)
+
+def _char_cost(char: str) -> float:
+    """
+    1文字あたりの推定トークン数を求めます。
+    """
+    if HIRAGANA_PATTERN.match(char):
+        return HIRAGANA_WEIGHT
+    if KATAKANA_PATTERN.match(char):
+        return KATAKANA_WEIGHT
+    if KANJI_PATTERN.match(char):
+        return KANJI_WEIGHT
+    if CJK_PUNCTUATION_PATTERN.match(char):
+        return CJK_PUNCTUATION_WEIGHT
+    if char.isascii() and char.isalpha():
+        return 1.0 / CHARS_PER_WORD_TOKEN
+    if char.isascii() and char.isdigit():
+        return 1.0 / CHARS_PER_DIGIT_TOKEN
+    if WHITESPACE_PATTERN.match(char):
+        return 0.0
+    return OTHER_WEIGHT
+
+def truncate_to_last_tokens(text: str, max_tokens: int) -> str:
+    """
+    テキストの末尾から、推定トークン数が上限に収まる部分だけを残します。
+
+    Args:
+        text: 切り詰めるテキスト
+        max_tokens: 残す部分の最大トークン数
+
+    Returns:
+        末尾側を残して切り詰めたテキスト
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    budget = float(max_tokens)
+    start = len(text)
+    while start > 0:
+        cost = _char_cost(text[start - 1])
+        if budget < cost:
+            break
+        budget -= cost
+        start -= 1
+    return text[start:]
+
+def truncate_to_first_tokens(text: str, max_tokens: int) -> str:
+    """
+    テキストの先頭から、推定トークン数が上限に収まる部分だけを残します。
+
+    Args:
+        text: 切り詰めるテキスト
+        max_tokens: 残す部分の最大トークン数
+
+    Returns:
+        先頭側を残して切り詰めたテキスト
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    budget = float(max_tokens)
+    end = 0
+    while end < len(text):
+        cost = _char_cost(text[end])
+        if budget < cost:
+            break
+        budget -= cost
+        end += 1
+    return text[:end]
+
+def get_model_limits(model_name: str) -> Dict[str, int]:
+    """
+    モデルのコンテキストウィンドウと最大出力トークン数を取得します。
+
+    Args:
+        model_name: モデル名
+
+    Returns:
+        "context_window" と "max_output_tokens" を含む辞書
+    """
+    return MODEL_LIMITS.get(model_name, DEFAULT_MODEL_LIMITS)
+
+def compute_chunk_tokens(model_name: str, prompt_tokens: int = 0, context_tokens: int = 0,
+                         output_ratio: float = OUTPUT_RATIO, reserved_output_tokens: int = 0) -> int:
+    """
+    モデルの入出力の上限から、1チャンクに割り当てられる最大トークン数を求めます。
+    整文化の出力はチャンクとほぼ同じ長さになるため、通常は出力の上限が制約になります。
+
+    Args:
+        model_name: モデル名
+        prompt_tokens: プロンプトテンプレートと背景情報の推定トークン数
+        context_tokens: コンテキストの推定トークン数
+        output_ratio: 入力チャンクに対する出力トークン数の倍率
+        reserved_output_tokens: 整文化結果のほかに出力させるトークン数（文書の状態など）
+
+    Returns:
+        1チャンクの最大トークン数
+    """
+    limits = get_model_limits(model_name)
+    max_output_tokens = limits["max_output_tokens"]
+    by_output = int((max_output_tokens * OUTPUT_SAFETY_MARGIN - reserved_output_tokens) / output_ratio)
+    by_input = limits["context_window"] - max_output_tokens - prompt_tokens - context_tokens
+    return max(MIN_CHUNK_TOKENS, min(by_output, by_input))
+
+class OutputRatioTracker:
+    """
+    整文化の出力トークン数と入力チャンクのトークン数の比を、チャンクごとに記録します。
+    記録した比の指数移動平均を、出力の上限の見積もりと、出力の上限を超えそうなチャンクの分割に使います。
+    ジョブごとの倍率は prior（モデル全体の倍率）を初期値にし、記録は prior にも伝えます。
+    複数のスレッドから呼び出せます。
+    """
+
+    def __init__(self, initial_ratio: float = OUTPUT_RATIO, smoothing: float = OUTPUT_RATIO_SMOOTHING,
+                 prior: Optional["OutputRatioTracker"] = None):
+        """
+        Args:
+            initial_ratio: 記録がない場合に使う倍率（priorを指定した場合はpriorの現在の倍率）
+            smoothing: 新しい記録に掛ける重み（0〜1）
+            prior: 記録を伝えるモデル全体の倍率（ジョブごとの倍率を作る場合に指定）
+        """
+        self.smoothing = smoothing
+        self.prior = prior
+        if prior is not None:
+            initial_ratio = prior.ratio
+        self.samples = 0
+        self._ratio = initial_ratio
+        self._lock = threading.Lock()
+
+    @property
+    def ratio(self) -> float:
+        """入力チャンクに対する出力トークン数の倍率の移動平均"""
+        with self._lock:
+            return self._ratio
+
+    def record(self, input_tokens: int, output_tokens: int) -> Optional[float]:
+        """
+        1つのチャンクの入力と出力のトークン数を記録します。
+
+        Args:
+            input_tokens: 入力チャンクの推定トークン数
+            output_tokens: 整文化されたテキストのトークン数
+
+        Returns:
+            このチャンクの倍率（短すぎて記録しない場合はNone）
+        """
+        if input_tokens < MIN_RATIO_SAMPLE_TOKENS:
+            return None
+        ratio = output_tokens / input_tokens
+        clamped = min(MAX_OUTPUT_RATIO, max(MIN_OUTPUT_RATIO, ratio))
+        with self._lock:
+            self._ratio += self.smoothing * (clamped - self._ratio)
+            self.samples += 1
+        if self.prior is not None:
+            self.prior.record(input_tokens, output_tokens)
+        return ratio
+
+_trackers: Dict[str, OutputRatioTracker] = {}
+_trackers_lock = threading.Lock()
+
+# output_ratio_scope の中で使う、ジョブごとのモデル名と OutputRatioTracker の辞書
+_job_trackers: "contextvars.ContextVar[Optional[Dict[str, OutputRatioTracker]]]" = contextvars.ContextVar(
+    "talk_to_article_job_trackers", default=None)
+
+def get_output_ratio_tracker(model_name: str) -> OutputRatioTracker:
+    """
+    OutputRatioTracker を取得します。
+    output_ratio_scope の中ではそのジョブの倍率を、外ではモデル全体の倍率を返します。
+
+    Args:
+        model_name: モデル名
+
+    Returns:
+        OutputRatioTrackerインスタンス
+    """
+    with _trackers_lock:
+        if model_name not in _trackers:
+            _trackers[model_name] = OutputRatioTracker()
+        job_trackers = _job_trackers.get()
+        if job_trackers is None:
+            return _trackers[model_name]
+        if model_name not in job_trackers:
+            job_trackers[model_name] = OutputRatioTracker(prior=_trackers[model_name])
+        return job_trackers[model_name]
+
+@contextmanager
+def output_ratio_scope() -> Iterator[Dict[str, OutputRatioTracker]]:
+    """
+    この中の整文化では、出力の倍率をジョブごとに記録して使います。
+    ほかのジョブや利用者の文字起こしの倍率は、モデル全体の倍率を通して初期値にだけ反映されます。
+    ワーカースレッドやタスクにコンテキストを複製すると、同じジョブの倍率を共有します。
+
+    Yields:
+        モデル名と、このジョブの OutputRatioTracker の辞書
+    """
+    token = _job_trackers.set({})
+    try:
+        yield _job_trackers.get()
+    finally:
+        _job_trackers.reset(token)
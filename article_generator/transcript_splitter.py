@@ -1,55 +1,422 @@
-from typing import List
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from typing import IO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+import hashlib
 import re
+from .token_estimator import estimate_tokens
 
-def split_transcript(text: str, max_tokens: int = 3000, overlap: int = 0) -> List[str]:
+# 話者ラベル（例：中村恒彦/ARS:）を行頭から抽出するパターン。先頭のタイムスタンプ（括弧で囲まれたものを含む）は読み飛ばす
+SPEAKER_PATTERN = re.compile(r'^[ \t]*(?:[\[(（]?\d{1,2}:\d{2}(?::\d{2})?[\])）]?[ \t]*)?([^:：\n\d\s\[(（][^:：\n]{0,29}?)[ \t]*[:：]',
+                             re.MULTILINE)
+
+# タイムスタンプ（例：00:00、01:02:03）
+TIMESTAMP_PATTERN = re.compile(r'\d{2}:\d{2}(?::\d{2})?')
+
+# セグメントの先頭のタイムスタンプ（括弧で囲まれたもの（例：[00:01:02]）を含む）
+LEADING_TIMESTAMP_PATTERN = re.compile(r'[\[(（]?\d{2}:\d{2}(?::\d{2})?[\])）]?')
+
+# セグメントの区切り（改行・タイムスタンプ・話者ラベル）。話者ラベルは長さを制限してバックトラックを防ぐ
+BOUNDARY_PATTERN = re.compile(
+    r'\n+'
+    r'|[\[(（]?\d{2}:\d{2}(?::\d{2})?[\])）]?'
+    r'|(?<![^\s。．！？!?])[^\s:：。、．，！？!?\d\[(（][^\s:：。、．，！？!?]{0,29}[:：](?!//)'
+)
+
+# セグメントがタイムスタンプだけかどうか（タイムスタンプは続く発言と同じセグメントにまとめる）
+TIMESTAMP_ONLY_PATTERN = re.compile(r'\s*(?:[\[(（]?\d{2}:\d{2}(?::\d{2})?[\])）]?\s*)*')
+
+# 大きすぎるセグメントを分割するときの区切り（優先度の高い順）
+SENTENCE_SEPARATORS = [re.compile(r'(?<=\n)'), re.compile(r'(?<=[。．！？!?])|(?<=\. )'), re.compile(r'(?<=、)'), re.compile(r'(?<= )')]
+
+# 入力を読み込む単位（文字数）と、区切りが見つからない場合にセグメントを確定させる長さ
+BLOCK_SIZE = 64 * 1024
+MAX_SEGMENT_CHARS = 64 * 1024
+
+# 区切りのない長い行を途中で処理するときに、次のブロックへ持ち越す末尾の文字数
+CARRY_CHARS = 64
+
+# 内容に基づいて分割する場合の、チャンクの最小トークン数の割合（max_tokensに対する）
+# 最小トークン数を超えた後は、セグメントの内容のハッシュで区切るかどうかを決めるため、
+# テキストの一部を編集しても、編集した位置から離れたチャンクの境界は変わらない
+CONTENT_DEFINED_MIN_RATIO = 0.6
+
+# 前処理（normalize_transcript）で、言いよどみや言い直しの直前にあってよい文字（行頭・空白・句読点・話者ラベルのコロン・括弧）
+_NORMALIZE_BOUNDARY = r'(?<![^\s、。，．！？!?:：「（(…])'
+
+# 言いよどみ（フィラー）。「あの人」「その件」のような指示語を消さないように、読点・三点リーダー・空白が続くものだけを取り除く
+# 「まあ、」「なんか、」は意味を持つ場合もあるため対象にしない
+FILLER_PATTERN = re.compile(
+    _NORMALIZE_BOUNDARY +
+    r'(?:え[えー]*っ?と|えー+|あのー*|そのー*|うー*ん|んー+)[ーっ〜~]*(?:[、，,…]+[ \t　]*|[ \t　]+)'
+)
+
+# どもり・言い直し（例：「これ、これは」→「これは」、「はい、はい、はい」→「はい」）
+# 「1、1、2」のような列挙を変えないように、かなだけの断片を対象にする
+STUTTER_PATTERN = re.compile(_NORMALIZE_BOUNDARY + r'([ぁ-ゖァ-ヺー]{1,8})(?:、\1)+')
+
+# 同じ文の繰り返し（例：「そうですね。そうですね。」→「そうですね。」）
+REPEATED_SENTENCE_PATTERN = re.compile(r'(?<![^\s。！？!?:：])([^。！？!?\n]{2,200}[。！？!?])\1+')
+
+# 1行の発言（タイムスタンプ、話者ラベル、本文）。タイムスタンプは括弧で囲まれていてもよい（例：[00:01:02]、(01:02)）
+UTTERANCE_PATTERN = re.compile(
+    r'[ \t　]*(?:[\[(（]?(\d{1,2}:\d{2}(?::\d{2})?)[\])）]?[ \t　]*)?'
+    r'(?:([^:：\n\d\s\[(（][^:：\n]{0,29}?)[ \t　]*[:：](?!//)[ \t　]*)?(.*)'
+)
+
+# 連続する空白
+SPACES_PATTERN = re.compile(r'[ \t　]+')
+
+# 同じ話者の連続する行をまとめるときの、1行の最大文字数（チャンクの区切りの候補を残すため）
+MAX_MERGED_CHARS = 2000
+
+class _Segment(NamedTuple):
+    text: str
+    tokens: int
+    timestamp_before: Optional[str]
+
+def timestamp_to_seconds(timestamp: str) -> int:
+    """
+    タイムスタンプ（例：01:02、01:02:03）を秒数に変換します。
+
+    Args:
+        timestamp: TIMESTAMP_PATTERN に一致するタイムスタンプ
+
+    Returns:
+        秒数
+    """
+    seconds = 0
+    for part in timestamp.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+class NormalizedTranscript(NamedTuple):
+    """
+    normalize_transcript の結果です。removed には処理ごとに取り除いた（まとめた）数を保持します。
+    """
+    text: str
+    original_chars: int
+    original_tokens: int
+    tokens: int
+    removed: Dict[str, int]
+
+    @property
+    def saved_chars(self) -> int:
+        """減った文字数"""
+        return self.original_chars - len(self.text)
+
+    @property
+    def saved_tokens(self) -> int:
+        """減った推定トークン数"""
+        return self.original_tokens - self.tokens
+
+    @property
+    def saved_ratio(self) -> float:
+        """推定トークン数の削減率"""
+        return self.saved_tokens / self.original_tokens if self.original_tokens else 0.0
+
+    @property
+    def filler_density(self) -> float:
+        """取り除いた言いよどみの数（元のテキストの1000トークンあたり）"""
+        return self.removed.get("fillers", 0) * 1000 / self.original_tokens if self.original_tokens else 0.0
+
+def _compact_timestamp(timestamp: str) -> str:
+    # 1時間未満の「00:MM:SS」は「MM:SS」にする
+    return timestamp[3:] if len(timestamp) == 8 and timestamp.startswith("00:") else timestamp
+
+def normalize_transcript(text: str) -> NormalizedTranscript:
+    """
+    チャンクに分割する前に、モデルに任せなくても決まった方法で整理できる部分を取り除き、入力トークン数を減らします。
+    言いよどみ（「えー、」「あの、」など）の削除、どもり・言い直しと同じ文の繰り返しの削除、
+    音声認識が同じ区間を重複して出力した行（同じ本文の行や、前の行を言い足しただけの行）の削除、
+    「00:MM:SS」のタイムスタンプの短縮（括弧で囲まれたものは括弧も外します）、同じ話者が続く行の結合、連続する空白と空行の削除を行います。
+    内容を変えないように、判断に迷うもの（句読点の続かない「あの」や、「まあ、」「なんか、」など）はそのまま残します。
+
+    Args:
+        text: 文字起こしテキスト
+
+    Returns:
+        前処理したテキストと、減った文字数・推定トークン数を含むNormalizedTranscript
+    """
+    removed = {"duplicate_lines": 0, "merged_lines": 0}
+    # どもりを先にまとめる（「え、えーと、」を「えーと、」にしてから言いよどみとして取り除く）
+    normalized, removed["stutters"] = STUTTER_PATTERN.subn(r"\1", text)
+    normalized, removed["fillers"] = FILLER_PATTERN.subn("", normalized)
+    normalized, removed["repeated_sentences"] = REPEATED_SENTENCE_PATTERN.subn(r"\1", normalized)
+    
+    lines: List[str] = []
+    # 出力中の最後の行の、タイムスタンプ・話者・本文と、最後に読んだ行の本文
+    current: Optional[List[str]] = None
+    last_body = ""
+    
+    def flush() -> None:
+        nonlocal current
+        if current is not None:
+            timestamp, speaker, body = current
+            prefix = (f"{timestamp} " if timestamp else "") + (f"{speaker}: " if speaker else "")
+            lines.append(prefix + body)
+            current = None
+    
+    for line in normalized.splitlines():
+        timestamp, speaker, body = UTTERANCE_PATTERN.match(line).groups()
+        body = SPACES_PATTERN.sub(" ", body).strip()
+        speaker = speaker.strip() if speaker else ""
+        if not body:
+            if timestamp or speaker:
+                # タイムスタンプや話者だけの行は、そのまま残す
+                flush()
+                lines.append(" ".join(part for part in (timestamp and _compact_timestamp(timestamp),
+                                                          speaker and f"{speaker}:") if part))
+            elif current is not None or (lines and lines[-1]):
+                # 空行は段落の区切りとして1つだけ残す
+                flush()
+                lines.append("")
+            continue
+        same_speaker = current is not None and current[1] == speaker
+        if body == last_body and (same_speaker or not speaker):
+            removed["duplicate_lines"] += 1
+            continue
+        if same_speaker and last_body and body.startswith(last_body) and current[2].endswith(last_body):
+            # 音声認識の途中結果の後に、言い足した結果が続いた場合は後のものだけを残す
+            removed["duplicate_lines"] += 1
+            current[2] = current[2][:len(current[2]) - len(last_body)] + body
+        elif same_speaker and speaker and len(current[2]) + len(body) <= MAX_MERGED_CHARS:
+            removed["merged_lines"] += 1
+            current[2] += ("" if current[2][-1] in "。、，．！？!?」）)" else " ") + body
+        else:
+            flush()
+            current = [_compact_timestamp(timestamp) if timestamp else "", speaker, body]
+        last_body = body
+    flush()
+    while lines and not lines[-1]:
+        lines.pop()
+    
+    result = "\n".join(lines)
+    return NormalizedTranscript(text=result, original_chars=len(text), original_tokens=estimate_tokens(text),
+                                tokens=estimate_tokens(result), removed=removed)
+
+def split_transcript(text: str, max_tokens: int = 3000, overlap: int = 0, content_defined: bool = False) -> List[str]:
     """
     文字起こしテキストを適切なサイズのチャンクに分割します。
     タイムスタンプや話者の切り替わりを優先して分割します。
-    
+    チャンクの大きさは文字数ではなく推定トークン数で測ります。
+
     Args:
         text: 分割する文字起こしテキスト
-        max_tokens: 各チャンクの最大トークン数
+        max_tokens: 各チャンクの最大トークン数（モデルに合わせた値は get_chunk_token_budget で求められます）
         overlap: チャンク間のオーバーラップトークン数
-    
+        content_defined: 内容に基づいて区切り、編集してもほかのチャンクの境界が変わらないようにするかどうか
+
     Returns:
         分割されたテキストチャンクのリスト
     """
-    # テキストを前処理して、タイムスタンプや話者の切り替わりを強調
-    # タイムスタンプのパターン（例：00:00）の前に改行を挿入
-    processed_text = re.sub(r'(\d{2}:\d{2})', r'\n\n\1', text)
-    
-    # 話者の切り替わりを示すパターン（例：中村恒彦/ARS:）の前に改行を挿入
-    processed_text = re.sub(r'([^:：\n]+[:：])', r'\n\n\1', processed_text)
-    
-    # 複数の連続した改行を2つの改行に統一
-    processed_text = re.sub(r'\n{3,}', r'\n\n', processed_text)
-    
-    # タイムスタンプ、話者の切り替わり、段落の区切りを優先して分割
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=max_tokens,
-        chunk_overlap=overlap,
-        length_function=len,
-        separators=[
-            "\n\n",    # 2つの改行（タイムスタンプや話者の切り替わり）
-            "\n",      # 1つの改行
-            ". ",      # 文の区切り
-            "。",      # 日本語の文の区切り
-            "、",      # 読点
-            " ",       # スペース
-            ""         # 文字単位
-        ]
-    )
-    
-    chunks = text_splitter.split_text(processed_text)
-    
-    # 各チャンクの先頭にタイムスタンプがない場合、前のチャンクから最後のタイムスタンプを取得して追加
-    for i in range(1, len(chunks)):
-        if not re.match(r'^\d{2}:\d{2}', chunks[i].strip()):
-            # 前のチャンクから最後のタイムスタンプを検索
-            last_timestamp = re.findall(r'(\d{2}:\d{2})', chunks[i-1])
-            if last_timestamp:
-                # 最後のタイムスタンプを現在のチャンクの先頭に追加
-                chunks[i] = f"{last_timestamp[-1]} (続き) " + chunks[i]
-    
-    return chunks 
\ No newline at end of file
+    return list(iter_transcript_chunks(text, max_tokens, overlap, content_defined))
+
+def iter_transcript_chunks(source: Union[str, IO[str], Iterable[str]], max_tokens: int = 3000, overlap: int = 0,
+                           content_defined: bool = False) -> Iterator[str]:
+    """
+    文字起こしテキストを1回の走査で分割し、チャンクが確定するたびに返します。
+    入力全体を保持しないため、入力の大きさにかかわらずメモリ使用量は一定です。
+    content_defined を指定した場合は、最大トークン数まで詰めるのではなく、最小トークン数を超えた後の
+    タイムスタンプや話者ラベルで始まるセグメントのうち、内容のハッシュが条件を満たすものの前で区切ります。
+    境界が前のチャンクの長さに依存しないため、一部を編集しても、変わるのは編集した位置の前後のチャンクだけです。
+
+    Args:
+        source: 文字起こしテキスト、読み込み用に開いたファイル、またはテキスト片のイテラブル
+        max_tokens: 各チャンクの最大トークン数
+        overlap: チャンク間のオーバーラップトークン数
+        content_defined: 内容に基づいて区切るかどうか
+
+    Yields:
+        分割されたテキストチャンク
+    """
+    chunk: List[_Segment] = []
+    chunk_tokens = 0
+    # 前のチャンクから引き継いだオーバーラップ分のトークン数（最小トークン数には含めない）
+    carried_tokens = 0
+    last_timestamp = None
+    is_first = True
+    min_tokens = int(max_tokens * CONTENT_DEFINED_MIN_RATIO)
+    # 区切りの候補になるセグメントの間隔の期待値（トークン数）
+    anchor_interval = max(1, (max_tokens - min_tokens) // 2)
+
+    for segment_text in _iter_segments(source):
+        for piece, tokens in _split_oversized(segment_text, max_tokens):
+            overflow = chunk_tokens + tokens > max_tokens
+            anchor = (content_defined and chunk_tokens - carried_tokens >= min_tokens
+                      and _is_anchor(piece, tokens, anchor_interval))
+            if chunk and (overflow or anchor):
+                yield _format_chunk(chunk, is_first)
+                is_first = False
+                chunk = _overlap_tail(chunk, overlap)
+                chunk_tokens = carried_tokens = sum(segment.tokens for segment in chunk)
+
+            chunk.append(_Segment(piece, tokens, last_timestamp))
+            chunk_tokens += tokens
+
+            # 最後のタイムスタンプを走査しながら追跡する
+            for match in TIMESTAMP_PATTERN.finditer(piece):
+                last_timestamp = match.group(0)
+
+    if chunk:
+        yield _format_chunk(chunk, is_first)
+
+def iter_transcript_file_chunks(path: str, max_tokens: int = 3000, overlap: int = 0, encoding: str = "utf-8") -> Iterator[str]:
+    """
+    文字起こしファイルを少しずつ読み込みながら分割します。
+
+    Args:
+        path: 文字起こしファイルのパス
+        max_tokens: 各チャンクの最大トークン数
+        overlap: チャンク間のオーバーラップトークン数
+        encoding: ファイルの文字コード
+
+    Yields:
+        分割されたテキストチャンク
+    """
+    with open(path, encoding=encoding) as f:
+        yield from iter_transcript_chunks(f, max_tokens, overlap)
+
+def _iter_blocks(source: Union[str, IO[str], Iterable[str]]) -> Iterator[str]:
+    """
+    入力を一定の大きさのテキスト片として順に返します。
+    """
+    if isinstance(source, str):
+        for start in range(0, len(source), BLOCK_SIZE):
+            yield source[start:start + BLOCK_SIZE]
+    elif hasattr(source, "read"):
+        yield from iter(lambda: source.read(BLOCK_SIZE), "")
+    else:
+        yield from source
+
+def _iter_safe_pieces(source: Union[str, IO[str], Iterable[str]]) -> Iterator[str]:
+    """
+    タイムスタンプや話者ラベルの途中で切れないように、入力を区切りのよい位置で切り出して返します。
+    """
+    pending = ""
+    for block in _iter_blocks(source):
+        pending += block
+        cut = pending.rfind("\n") + 1
+        if cut == 0 and len(pending) > CARRY_CHARS:
+            # 改行がない場合は、末尾の少しだけを持ち越して数字やコロンの途中で切らないようにする
+            cut = len(pending) - CARRY_CHARS
+            while cut > 0 and pending[cut - 1] in "0123456789:：":
+                cut -= 1
+        if cut > 0:
+            yield pending[:cut]
+            pending = pending[cut:]
+    if pending:
+        yield pending
+
+def _iter_segments(source: Union[str, IO[str], Iterable[str]]) -> Iterator[str]:
+    """
+    改行・タイムスタンプ・話者ラベルの位置でテキストをセグメントに分けて返します。
+    """
+    current: List[str] = []
+    current_chars = 0
+
+    for piece in _iter_safe_pieces(source):
+        position = 0
+        for match in BOUNDARY_PATTERN.finditer(piece):
+            current.append(piece[position:match.start()])
+            segment = "".join(current)
+            if not TIMESTAMP_ONLY_PATTERN.fullmatch(segment):
+                yield segment.strip()
+                current, current_chars = [], 0
+            else:
+                # タイムスタンプだけのセグメントは、続く発言とまとめる
+                current, current_chars = [segment], len(segment)
+            position = match.start()
+
+        rest = piece[position:]
+        current.append(rest)
+        current_chars += len(rest)
+        if current_chars > MAX_SEGMENT_CHARS:
+            # 区切りが長く現れない場合も、一定の長さでセグメントを確定させてメモリを抑える
+            segment = "".join(current)
+            cut = max(segment.rfind("。"), segment.rfind(". ")) + 1 or len(segment)
+            yield segment[:cut].strip()
+            current, current_chars = [segment[cut:]], len(segment) - cut
+
+    segment = "".join(current).strip()
+    if segment:
+        yield segment
+
+def _split_oversized(segment: str, max_tokens: int, level: int = 0) -> Iterator[Tuple[str, int]]:
+    """
+    最大トークン数を超えるセグメントを、文の区切りなどの位置でさらに分割します。
+    分割したテキストと、その推定トークン数の組を返します。
+    """
+    if not segment:
+        return
+    tokens = estimate_tokens(segment)
+    if tokens <= max_tokens:
+        yield segment, tokens
+        return
+    if level >= len(SENTENCE_SEPARATORS):
+        # 区切りが見つからない場合は、推定トークン数に合わせて文字単位で分割する
+        step = max(1, len(segment) * max_tokens // tokens)
+        for start in range(0, len(segment), step):
+            piece = segment[start:start + step]
+            yield piece, estimate_tokens(piece)
+        return
+
+    buffer: List[str] = []
+    buffer_tokens = 0
+    for part in SENTENCE_SEPARATORS[level].split(segment):
+        part_tokens = estimate_tokens(part)
+        if buffer and buffer_tokens + part_tokens > max_tokens:
+            yield from _split_oversized("".join(buffer).strip(), max_tokens, level + 1)
+            buffer, buffer_tokens = [], 0
+        buffer.append(part)
+        buffer_tokens += part_tokens
+    yield from _split_oversized("".join(buffer).strip(), max_tokens, level + 1)
+
+def _is_anchor(piece: str, tokens: int, anchor_interval: int) -> bool:
+    """
+    内容に基づいて分割する場合に、このセグメントの前で区切るかどうかを判定します。
+    タイムスタンプか話者ラベルで始まるセグメントだけを候補にし、内容のハッシュから
+    推定トークン数に比例した確率で区切るため、区切りの間隔の期待値は anchor_interval になります。
+    """
+    if not (LEADING_TIMESTAMP_PATTERN.match(piece) or SPEAKER_PATTERN.match(piece)):
+        return False
+    digest = int.from_bytes(hashlib.blake2b(piece.encode("utf-8"), digest_size=4).digest(), "big")
+    return digest / 2 ** 32 < min(1.0, tokens / anchor_interval)
+
+def _overlap_tail(chunk: List[_Segment], overlap: int) -> List[_Segment]:
+    """
+    次のチャンクに引き継ぐ、末尾のオーバーラップ分のセグメントを求めます。
+    """
+    tail: List[_Segment] = []
+    tokens = 0
+    for segment in reversed(chunk):
+        if tokens + segment.tokens > overlap:
+            break
+        tail.insert(0, segment)
+        tokens += segment.tokens
+    return tail
+
+def _format_chunk(chunk: List[_Segment], is_first: bool) -> str:
+    """
+    セグメントを連結してチャンクにします。
+    チャンクの先頭にタイムスタンプがない場合、直前のタイムスタンプを補います。
+    """
+    text = "\n\n".join(segment.text for segment in chunk)
+    timestamp = chunk[0].timestamp_before
+    if not is_first and timestamp and not LEADING_TIMESTAMP_PATTERN.match(text):
+        text = f"{timestamp} (続き) " + text
+    return text
+
+def extract_speakers(text: str) -> List[str]:
+    """
+    文字起こしテキストから話者ラベルを登場順に抽出します。
+
+    Args:
+        text: 話者を抽出する文字起こしテキスト
+
+    Returns:
+        重複を除いた話者ラベルのリスト
+    """
+    speakers = []
+    for match in SPEAKER_PATTERN.finditer(text):
+        speaker = match.group(1).strip()
+        if speaker and speaker not in speakers:
+            speakers.append(speaker)
+    return speakers
\ No newline at end of file
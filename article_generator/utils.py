@@ -1,7 +1,52 @@
+import contextvars
+import hashlib
+import json
 import os
-from typing import Optional
-import streamlit as st
-from streamlit_local_storage import LocalStorage
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+# APIキーなどを記述する設定ファイル（Streamlitの外で実行する場合に使う）
+CONFIG_PATH = os.environ.get("TALK_TO_ARTICLE_CONFIG",
+                             os.path.join(os.path.expanduser("~"), ".config", "talk-to-article", "config.json"))
+
+# ローカルストレージのコンポーネントのキーと、読み込んだLocalStorageを保持するセッションステートのキー
+LOCAL_STORAGE_COMPONENT_KEY = "storage_init"
+LOCAL_STORAGE_SESSION_KEY = "_local_storage"
+
+# ジョブごとに使うAPIキー（ワーカーが投入したユーザーのキーで処理するため。スレッドプールへは contextvars.copy_context で引き継ぐ）
+_api_key_override: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("talk_to_article_api_key", default=None)
+
+def get_script_run_ctx() -> Optional[Any]:
+    """
+    Streamlitのスクリプトの実行中であれば、その実行のコンテキストを取得します。
+    CLIやワーカーではStreamlitを読み込まないように、Streamlitが読み込まれていない場合は読み込まずにNoneを返します。
+    
+    Returns:
+        ScriptRunContext（Streamlitの外の場合はNone）
+    """
+    if "streamlit" not in sys.modules:
+        return None
+    from streamlit.runtime.scriptrunner import get_script_run_ctx as get_ctx
+    return get_ctx(suppress_warning=True)
+
+def create_thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    """
+    スレッドプールを作成します。Streamlitのスクリプトの実行中であれば、ワーカースレッドからも
+    セッションステートを参照できるようにコンテキストを引き継ぎます（Streamlitの外では引き継がないため、警告も出ません）。
+    
+    Args:
+        max_workers: スレッドの数
+    
+    Returns:
+        ThreadPoolExecutor
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    from streamlit.runtime.scriptrunner import add_script_run_ctx
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, ctx))
 
 def validate_api_key(api_key: Optional[str] = None) -> bool:
     """
@@ -37,16 +82,93 @@ def set_api_key(api_key: str) -> None:
     Args:
         api_key: 設定するAPIキー
     """
+    import streamlit as st
     st.session_state.anthropic_api_key = api_key
 
 def get_api_key() -> Optional[str]:
     """
-    セッションからAPIキーを取得します。
+    APIキーを取得します。
+    use_api_key で指定したキー、Streamlitのセッション、環境変数 ANTHROPIC_API_KEY、設定ファイルの順に探します。
+    Streamlitのアプリでは、運営者のキーを利用者に使わせないように、セッションまでしか探しません。
+    Streamlitの外（CLIやcronなど）ではセッションは参照しません。
     
     Returns:
         APIキー（存在する場合）
     """
-    return st.session_state.get("anthropic_api_key")
+    api_key = _api_key_override.get()
+    if api_key:
+        return api_key
+    
+    if get_script_run_ctx() is not None:
+        import streamlit as st
+        return st.session_state.get("anthropic_api_key") or None
+    
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if api_key:
+        return api_key
+    
+    return load_config().get("anthropic_api_key")
+
+def owner_for_api_key(api_key: str) -> str:
+    """
+    APIキーから、ジョブやスケジューラの所有者の識別子を作ります（キーそのものは含めません）。
+
+    Args:
+        api_key: APIキー
+
+    Returns:
+        所有者の識別子
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+@contextmanager
+def use_api_key(api_key: Optional[str]) -> Iterator[None]:
+    """
+    この中で行われるAPIの呼び出しに、指定したAPIキーを使います。
+
+    Args:
+        api_key: 使用するAPIキー（Noneの場合は通常どおり get_api_key で探す）
+    """
+    token = _api_key_override.set(api_key)
+    try:
+        yield
+    finally:
+        _api_key_override.reset(token)
+
+def load_config(path: Optional[str] = None) -> dict:
+    """
+    設定ファイル（JSON）を読み込みます。
+    
+    Args:
+        path: 設定ファイルのパス（省略時は環境変数 TALK_TO_ARTICLE_CONFIG、なければ ~/.config/talk-to-article/config.json）
+    
+    Returns:
+        設定の辞書（ファイルがない場合は空の辞書）
+    """
+    try:
+        with open(path or CONFIG_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _get_local_storage():
+    """
+    セッションのLocalStorageを取得します。
+    作成するたびにコンポーネントを描画し直すため、ブラウザから値を受け取った後はセッションに保持して
+    スクリプトの再実行をまたいで使い回します（ブラウザごとの値なので、セッション間では共有しません）。
+    """
+    import streamlit as st
+    local_storage = st.session_state.get(LOCAL_STORAGE_SESSION_KEY)
+    if local_storage is not None:
+        return local_storage
+    # コンポーネントの登録はStreamlitの外では不要なため、使うときに読み込む
+    from streamlit_local_storage import LocalStorage
+    # 最初の実行ではまだブラウザから値が届いていないため、届いてから保持する
+    loaded = LOCAL_STORAGE_COMPONENT_KEY in st.session_state
+    local_storage = LocalStorage(key=LOCAL_STORAGE_COMPONENT_KEY)
+    if loaded:
+        st.session_state[LOCAL_STORAGE_SESSION_KEY] = local_storage
+    return local_storage
 
 def get_api_key_from_local_storage() -> Optional[str]:
     """
@@ -56,9 +178,7 @@ def get_api_key_from_local_storage() -> Optional[str]:
         APIキー（存在する場合）
     """
     try:
-        local_storage = LocalStorage()
-        api_key = local_storage.getItem("anthropic_api_key")
-        return api_key
+        return _get_local_storage().getItem("anthropic_api_key")
     except Exception:
         return None
 
@@ -73,8 +193,7 @@ def save_api_key_to_local_storage(api_key: str) -> bool:
         保存が成功したかどうか
     """
     try:
-        local_storage = LocalStorage()
-        local_storage.setItem("anthropic_api_key", api_key)
+        _get_local_storage().setItem("anthropic_api_key", api_key)
         return True
     except Exception:
         return False
@@ -87,6 +206,7 @@ def get_api_key_from_session() -> Optional[str]:
     Returns:
         APIキー（存在する場合）
     """
+    import streamlit as st
     if "api_key" in st.session_state:
         return st.session_state.api_key
     return None
@@ -98,4 +218,5 @@ def save_api_key_to_session(api_key: str) -> None:
     Args:
         api_key: 保存するAPIキー
     """
+    import streamlit as st
     st.session_state.api_key = api_key 
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""
+キュー（job_queue）に投入された整文化ジョブを処理するワーカーです。
+Streamlitのスクリプトとは別のプロセスで処理するため、ブラウザを閉じたり画面を操作したりしても処理は止まりません。
+ワーカーの数を増やすと、同時に処理できるジョブの数が増えます（同じデータディレクトリを参照するプロセスであれば追加できます）。
+APIキーはジョブの投入時に指定されたもの、なければ環境変数 ANTHROPIC_API_KEY または設定ファイルのものを使います。
+
+    talk-to-article-worker --processes 4
+    python -m article_generator.worker --processes 4 --verbose
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import uuid
+from typing import List, Optional
+
+from .article_formalizer import run_job
+from .job_queue import CANCELLED, DONE, FAILED, HEARTBEAT_INTERVAL, JobQueue, QueueEntry, get_job_queue
+from .job_store import load_job, prune_completed_jobs
+from .utils import use_api_key
+
+# 待機中のジョブがない場合に、キューを確認する間隔（秒）
+POLL_INTERVAL = 2.0
+
+logger = logging.getLogger(__name__)
+
+class JobInterrupted(Exception):
+    """
+    ジョブの中止が要求されたか、ワーカーが停止するために処理を中断したことを表します。
+    """
+
+    def __init__(self, cancelled: bool):
+        super().__init__("cancelled" if cancelled else "worker stopping")
+        self.cancelled = cancelled
+
+def process_entry(queue: JobQueue, entry: QueueEntry, worker_id: str, stop_event: Optional[threading.Event] = None) -> str:
+    """
+    キューから取り出したジョブを処理し、結果をキューに記録します。
+    処理中は HEARTBEAT_INTERVAL ごとに生存を知らせ、チャンクが完了するたびに中止の要求を確認します。
+    ワーカーが停止する場合は、ジョブをキューに戻してほかのワーカーに続きを処理させます。
+
+    Args:
+        queue: ジョブのキュー
+        entry: claim で取り出したジョブ
+        worker_id: このワーカーのID
+        stop_event: ワーカーの停止を知らせるイベント（オプション）
+
+    Returns:
+        ジョブの終了後の状態（DONE、FAILED、CANCELLED、またはキューに戻した場合は QUEUED）
+    """
+    try:
+        job = load_job(entry.job_id)
+    except (OSError, ValueError, TypeError) as e:
+        queue.finish(entry.job_id, worker_id, FAILED, error=f"ジョブを読み込めません: {e}")
+        return FAILED
+    logger.info(f"ジョブ {job.job_id} を処理します（未処理: {len(job.missing_indices)}/{len(job.chunks)} チャンク、"
+                f"{entry.attempts} 回目）")
+
+    finished = threading.Event()
+    cancelled = threading.Event()
+
+    def keep_alive() -> None:
+        # 1つのチャンクの処理に時間がかかっても、ワーカーが停止したと判定されないようにする
+        while not finished.wait(HEARTBEAT_INTERVAL):
+            if not queue.heartbeat(job.job_id, worker_id, len(job.results)):
+                cancelled.set()
+
+    def report(done: int, total: int) -> None:
+        if cancelled.is_set() or not queue.heartbeat(job.job_id, worker_id, done):
+            raise JobInterrupted(cancelled=True)
+        if stop_event is not None and stop_event.is_set():
+            raise JobInterrupted(cancelled=False)
+
+    heartbeat_thread = threading.Thread(target=keep_alive, name=f"heartbeat-{job.job_id}", daemon=True)
+    heartbeat_thread.start()
+    try:
+        with use_api_key(entry.api_key):
+            results = run_job(job, report)
+    except JobInterrupted as e:
+        if e.cancelled:
+            logger.info(f"ジョブ {job.job_id} を中止しました（完了: {len(job.results)}/{len(job.chunks)} チャンク）")
+            queue.finish(job.job_id, worker_id, CANCELLED, completed=len(job.results))
+            return CANCELLED
+        logger.info(f"ワーカーを停止するため、ジョブ {job.job_id} をキューに戻します")
+        return queue.release(job.job_id, worker_id, completed=len(job.results))
+    except Exception as e:
+        # 完了したチャンクはジョブに保存されているため、投入し直すと続きから処理できる
+        logger.exception(f"ジョブ {job.job_id} の処理に失敗しました")
+        queue.finish(job.job_id, worker_id, FAILED, error=f"{type(e).__name__}: {e}", completed=len(job.results))
+        return FAILED
+    finally:
+        finished.set()
+        heartbeat_thread.join()
+
+    queue.finish(job.job_id, worker_id, DONE, result="\n".join(results), completed=len(job.results))
+    # 完了したジョブは、文字起こしを編集して再実行するときに結果を再利用するため、所有者ごとに新しいものだけを残す
+    prune_completed_jobs(owner=entry.owner)
+    logger.info(f"ジョブ {job.job_id} が完了しました")
+    return DONE
+
+def run_worker(queue: Optional[JobQueue] = None, worker_id: Optional[str] = None, poll_interval: float = POLL_INTERVAL,
+               stop_event: Optional[threading.Event] = None, max_jobs: Optional[int] = None) -> int:
+    """
+    キューからジョブを取り出して処理することを、停止するまで繰り返します。
+
+    Args:
+        queue: ジョブのキュー（省略時は get_job_queue で取得）
+        worker_id: このワーカーのID（省略時はホスト名とプロセスIDから作成）
+        poll_interval: 待機中のジョブがない場合に、キューを確認する間隔（秒）
+        stop_event: セットされると、処理中のジョブをキューに戻して停止するイベント（オプション）
+        max_jobs: この数のジョブを処理したら停止する（オプション）
+
+    Returns:
+        処理したジョブの数
+    """
+    queue = queue or get_job_queue()
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    stop_event = stop_event or threading.Event()
+    queue.register_worker(worker_id)
+    logger.info(f"ワーカー {worker_id} を開始しました")
+    processed = 0
+    try:
+        while not stop_event.is_set():
+            for job_id in queue.recover_stale():
+                logger.warning(f"応答がなくなったワーカーのジョブ {job_id} をキューに戻しました")
+            entry = queue.claim(worker_id)
+            if entry is None:
+                queue.worker_heartbeat(worker_id)
+                stop_event.wait(poll_interval)
+                continue
+            process_entry(queue, entry, worker_id, stop_event)
+            processed += 1
+            if max_jobs is not None and processed >= max_jobs:
+                break
+    finally:
+        queue.unregister_worker(worker_id)
+        logger.info(f"ワーカー {worker_id} を停止しました（処理したジョブ: {processed}）")
+    return processed
+
+def _configure_logging(verbose: bool) -> None:
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING, stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(process)d %(name)s: %(message)s")
+
+def _worker_process(poll_interval: float, max_jobs: Optional[int], verbose: bool) -> None:
+    """
+    ワーカーのプロセスで実行する関数です。SIGTERM と SIGINT を受け取ると、処理中のジョブをキューに戻して停止します。
+    """
+    _configure_logging(verbose)
+    stop_event = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop_event.set())
+    run_worker(poll_interval=poll_interval, stop_event=stop_event, max_jobs=max_jobs)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="talk-to-article-worker",
+                                     description="キューに投入された整文化ジョブを処理するワーカーを起動します")
+    parser.add_argument("--processes", type=int, default=2, help="起動するワーカーのプロセス数")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="待機中のジョブがない場合に、キューを確認する間隔（秒）")
+    parser.add_argument("--max-jobs", type=int, default=None, help="各プロセスがこの数のジョブを処理したら停止する")
+    parser.add_argument("-v", "--verbose", action="store_true", help="詳細なログを標準エラー出力に出力する")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    ワーカーのエントリーポイントです。指定した数のプロセスを起動し、すべて停止するまで待ちます。
+
+    Returns:
+        終了コード（すべてのプロセスが正常に停止した場合は0）
+    """
+    args = build_parser().parse_args(argv)
+    if args.processes == 1:
+        _worker_process(args.poll_interval, args.max_jobs, args.verbose)
+        return 0
+
+    _configure_logging(args.verbose)
+    processes = [multiprocessing.Process(target=_worker_process, args=(args.poll_interval, args.max_jobs, args.verbose),
+                                         name=f"talk-to-article-worker-{i}")
+                 for i in range(max(1, args.processes))]
+    for process in processes:
+        process.start()
+    # 親プロセスが SIGTERM を受け取った場合は、ワーカーのプロセスに伝える（Ctrl+C はプロセスグループ全体に届く）
+    signal.signal(signal.SIGTERM, lambda *_: [process.terminate() for process in processes])
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+    return 0 if all(process.exitcode == 0 for process in processes) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
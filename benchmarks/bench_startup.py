@@ -0,0 +1,123 @@
+"""
+Streamlitアプリの起動時間と、操作のたびに行われるスクリプトの再実行の時間を計測するベンチマークです。
+新しいPythonプロセスで app.py の読み込みにかかる時間を計測し、AppTest で最初の実行と再実行の時間を計測します。
+--baseline を指定すると、指定したコミットを一時的な作業ツリーに取り出して同じ計測を行い、比較します。
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --baseline HEAD~1
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, Optional
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# 新しいプロセスで app.py を読み込み、時間と読み込まれた重いライブラリを出力する
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed,
+                  "loaded": [name for name in ("langchain_anthropic", "langchain_core", "anthropic") if name in sys.modules]}))
+"""
+
+# AppTestで最初の実行と再実行の時間を計測する（再実行ではボタンを押さずにスクリプトだけを実行し直す）
+# AppTestにはブラウザがないため、ローカルストレージのコンポーネントはすぐに空の値を返すものに置き換え、
+# LocalStorage が作成された回数を数える
+RERUN_SCRIPT = """
+import json, statistics, sys, time
+import streamlit as st
+import streamlit_local_storage
+from streamlit.testing.v1 import AppTest
+def component(method, key, default=None, **kwargs):
+    if method == "getAll":
+        st.session_state[key] = default
+    return default
+streamlit_local_storage._st_local_storage = component
+created = []
+original_init = streamlit_local_storage.LocalStorage.__init__
+def counting_init(self, *args, **kwargs):
+    created.append(1)
+    original_init(self, *args, **kwargs)
+streamlit_local_storage.LocalStorage.__init__ = counting_init
+at = AppTest.from_file("app.py", default_timeout=120)
+started = time.perf_counter()
+at.run()
+first = time.perf_counter() - started
+# 操作を始めるまでに、バックグラウンドでのライブラリの読み込みが終わっている状態で計測する
+import langchain_anthropic
+first_created = len(created)
+reruns = []
+for _ in range(int(sys.argv[1])):
+    started = time.perf_counter()
+    at.run()
+    reruns.append(time.perf_counter() - started)
+print(json.dumps({"first_run_seconds": first, "rerun_median_seconds": statistics.median(reruns),
+                  "local_storage_created_per_rerun": (len(created) - first_created) / len(reruns),
+                  "exception": [str(e.value) for e in at.exception]}))
+"""
+
+def run_json(script: str, cwd: str, *args: str) -> Dict[str, Any]:
+    """新しいPythonプロセスでスクリプトを実行し、最後の行のJSONを返します。"""
+    env = dict(os.environ, PYTHONPATH=cwd)
+    completed = subprocess.run([sys.executable, "-c", script, *args], cwd=cwd, env=env,
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def measure(cwd: str, repeat: int, reruns: int) -> Dict[str, Any]:
+    """指定したディレクトリの app.py の読み込み時間と再実行の時間を計測します。"""
+    imports = [run_json(IMPORT_SCRIPT, cwd) for _ in range(repeat)]
+    result = run_json(RERUN_SCRIPT, cwd, str(reruns))
+    result.update({
+        "import_median_seconds": statistics.median(r["seconds"] for r in imports),
+        "loaded_on_import": imports[0]["loaded"],
+    })
+    return result
+
+def describe(label: str, result: Dict[str, Any]) -> None:
+    loaded = ", ".join(result["loaded_on_import"]) or "なし"
+    print(f"{label}")
+    print(f"  app.py の読み込み   {result['import_median_seconds']:.3f} 秒（読み込まれたライブラリ: {loaded}）")
+    print(f"  最初の実行         {result['first_run_seconds']:.3f} 秒")
+    print(f"  再実行（中央値）    {result['rerun_median_seconds']:.3f} 秒")
+    print(f"  再実行ごとの LocalStorage の作成  {result['local_storage_created_per_rerun']:.1f} 回")
+    if result["exception"]:
+        print(f"  例外: {result['exception']}")
+
+def measure_revision(revision: str, repeat: int, reruns: int) -> Dict[str, Any]:
+    """指定したコミットを一時的な作業ツリーに取り出して計測します。"""
+    with tempfile.TemporaryDirectory() as tmp:
+        worktree = os.path.join(tmp, "baseline")
+        subprocess.run(["git", "worktree", "add", "--detach", "--quiet", worktree, revision], cwd=ROOT, check=True)
+        try:
+            return measure(worktree, repeat, reruns)
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=ROOT, check=True)
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Streamlitアプリの起動時間と再実行の時間を計測します")
+    parser.add_argument("--baseline", help="比較するコミット（例: HEAD~1）")
+    parser.add_argument("--repeat", type=int, default=5, help="読み込み時間を計測する回数（中央値を使う）")
+    parser.add_argument("--reruns", type=int, default=10, help="再実行の時間を計測する回数（中央値を使う）")
+    args = parser.parse_args(argv)
+
+    # ジョブや結果キャッシュは一時ディレクトリに作成し、普段使うデータに影響させない
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ.setdefault("TALK_TO_ARTICLE_DATA_DIR", data_dir)
+        current = measure(os.path.abspath(ROOT), args.repeat, args.reruns)
+        describe("現在の作業ツリー", current)
+        if args.baseline:
+            baseline = measure_revision(args.baseline, args.repeat, args.reruns)
+            describe(f"\n{args.baseline}", baseline)
+            print("\n比較（基準 → 現在）")
+            for name in ("import_median_seconds", "first_run_seconds", "rerun_median_seconds"):
+                print(f"  {name:<24} {baseline[name]:.3f} → {current[name]:.3f}（{current[name] / baseline[name]:.2f} 倍）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+従来の split_transcript（正規表現による全文の置換と RecursiveCharacterTextSplitter）と、
+1回の走査で分割する iter_transcript_chunks を、10MB以上の合成文字起こしで比較するベンチマークです。
+
+    python benchmarks/bench_streaming_splitter.py --sizes 1MB 10MB 20MB
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_transcript import generate_transcript, parse_size
+
+from article_generator.token_estimator import estimate_tokens
+from article_generator.transcript_splitter import iter_transcript_file_chunks
+
+def legacy_split_transcript(text: str, max_tokens: int = 3000, overlap: int = 0) -> List[str]:
+    """変更前の split_transcript の実装（比較用）"""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    processed_text = re.sub(r'(\d{2}:\d{2})', r'\n\n\1', text)
+    processed_text = re.sub(r'([^:：\n]+[:：])', r'\n\n\1', processed_text)
+    processed_text = re.sub(r'\n{3,}', r'\n\n', processed_text)
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=max_tokens, chunk_overlap=overlap, length_function=estimate_tokens,
+        separators=["\n\n", "\n", ". ", "。", "、", " ", ""]
+    )
+    chunks = text_splitter.split_text(processed_text)
+    for i in range(1, len(chunks)):
+        if not re.match(r'^\d{2}:\d{2}', chunks[i].strip()):
+            last_timestamp = re.findall(r'(\d{2}:\d{2})', chunks[i-1])
+            if last_timestamp:
+                chunks[i] = f"{last_timestamp[-1]} (続き) " + chunks[i]
+    return chunks
+
+def measure(func: Callable[[], int]) -> Dict[str, float]:
+    # tracemallocは処理を大きく遅くするため、時間とメモリは別々に計測する
+    started = time.perf_counter()
+    chunks = func()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "peak_mb": peak / (1024 * 1024), "chunks": chunks}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ストリーミング分割のベンチマーク")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size("10MB")])
+    parser.add_argument("--max-tokens", type=int, default=3000)
+    parser.add_argument("--long-lines", action="store_true", help="コロンのない長い行（音声認識の生出力）で比較する")
+    parser.add_argument("--skip-legacy", action="store_true", help="従来の実装を計測しない")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        text = generate_transcript(size, long_lines=args.long_lines)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as f:
+            f.write(text)
+            path = f.name
+        try:
+            print(f"{size / (1024 * 1024):.1f} MB（{len(text)} 文字）")
+            if not args.skip_legacy:
+                # 従来の実装はファイル全体を文字列として読み込む
+                def run_legacy() -> int:
+                    with open(path, encoding="utf-8") as f:
+                        return len(legacy_split_transcript(f.read(), args.max_tokens))
+                result = measure(run_legacy)
+                print(f"  従来         {result['seconds']:>8.2f} 秒  ピークメモリ {result['peak_mb']:>8.1f} MB  チャンク数 {result['chunks']}")
+            del text
+            result = measure(lambda: sum(1 for _ in iter_transcript_file_chunks(path, args.max_tokens)))
+            print(f"  ストリーミング {result['seconds']:>8.2f} 秒  ピークメモリ {result['peak_mb']:>8.1f} MB  チャンク数 {result['chunks']}")
+        finally:
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""
+文字数で分割していた従来の方法と、推定トークン数とモデルの上限から分割する方法を比較するベンチマークです。
+
+    python benchmarks/bench_token_splitter.py transcripts/*.txt
+    python benchmarks/bench_token_splitter.py transcripts/*.txt --calibrate   # ANTHROPIC_API_KEY で推定誤差を確認
+"""
+import argparse
+import glob
+import os
+import re
+import statistics
+import sys
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from article_generator.article_formalizer import get_chunk_token_budget
+from article_generator.token_estimator import OUTPUT_RATIO, estimate_tokens, get_model_limits
+from article_generator.transcript_splitter import split_transcript
+
+DEFAULT_TRANSCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "article_generator", "test", "test_transcript.txt")
+MODELS = ["claude-3-7-sonnet-latest", "claude-3-5-sonnet-latest", "claude-3-opus-latest", "claude-3-haiku-latest"]
+
+# 従来の split_transcript の既定値（文字数）
+LEGACY_MAX_CHARS = 3000
+
+def split_by_characters(text: str, max_chars: int = LEGACY_MAX_CHARS) -> List[str]:
+    """従来の split_transcript と同じく、文字数でチャンクの大きさを測って分割します。"""
+    processed_text = re.sub(r'(\d{2}:\d{2})', r'\n\n\1', text)
+    processed_text = re.sub(r'([^:：\n]+[:：])', r'\n\n\1', processed_text)
+    processed_text = re.sub(r'\n{3,}', r'\n\n', processed_text)
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=max_chars, chunk_overlap=0, length_function=len,
+        separators=["\n\n", "\n", ". ", "。", "、", " ", ""]
+    )
+    return splitter.split_text(processed_text)
+
+def describe(label: str, chunks: List[str], model_name: str) -> int:
+    tokens = [estimate_tokens(chunk) for chunk in chunks]
+    max_output = get_model_limits(model_name)["max_output_tokens"]
+    at_risk = sum(1 for t in tokens if t * OUTPUT_RATIO > max_output)
+    print(f"  {label:<28} チャンク数 {len(chunks):>5}  平均 {statistics.mean(tokens) if tokens else 0:>8.0f}  "
+          f"最大 {max(tokens) if tokens else 0:>7} トークン  出力上限超過の恐れ {at_risk:>3}")
+    return len(chunks)
+
+def calibrate(texts: List[str], model_name: str, samples: int = 5) -> None:
+    """Anthropic APIのトークン数カウントと推定値を比較します。"""
+    import anthropic
+
+    client = anthropic.Anthropic()
+    print(f"\n推定誤差（{model_name}）")
+    for text in texts:
+        for chunk in split_transcript(text, 2000)[:samples]:
+            actual = client.messages.count_tokens(model=model_name, messages=[{"role": "user", "content": chunk}]).input_tokens
+            estimated = estimate_tokens(chunk)
+            print(f"  実測 {actual:>6}  推定 {estimated:>6}  誤差 {(estimated - actual) / actual:+.1%}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="トークン数に基づくチャンク分割のベンチマーク")
+    parser.add_argument("paths", nargs="*", default=[DEFAULT_TRANSCRIPT], help="文字起こしファイルのパスまたはglob")
+    parser.add_argument("--calibrate", action="store_true", help="APIで実際のトークン数を数えて推定誤差を表示する")
+    args = parser.parse_args()
+
+    files = sorted({path for pattern in args.paths for path in glob.glob(pattern)})
+    texts = []
+    total_legacy = 0
+    total_new = {model: 0 for model in MODELS}
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        texts.append(text)
+        print(f"{path}（{len(text)} 文字、推定 {estimate_tokens(text)} トークン）")
+        legacy_chunks = split_by_characters(text)
+        total_legacy += describe(f"従来（{LEGACY_MAX_CHARS}文字）", legacy_chunks, MODELS[0])
+        for model in MODELS:
+            budget = get_chunk_token_budget(model)
+            total_new[model] += describe(f"{model}（{budget}）", split_transcript(text, budget), model)
+
+    print("\n合計API呼び出し回数")
+    print(f"  従来: {total_legacy}")
+    for model, count in total_new.items():
+        print(f"  {model}: {count}（{total_legacy - count} 回削減）")
+
+    if args.calibrate:
+        calibrate(texts, MODELS[0])
+
+if __name__ == "__main__":
+    main()
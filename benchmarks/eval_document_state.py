@@ -0,0 +1,135 @@
+"""
+逐次処理で次のチャンクに渡すコンテキストとして、直前の処理結果そのもの（previous）と
+話者・用語・要約からなる文書の状態（state）を比較する評価スクリプトです。
+チャンクあたりのコンテキストと入力のトークン数、出力の話者ラベルの一貫性を表示します。
+
+    python benchmarks/eval_document_state.py --input transcripts/meeting.txt   # ANTHROPIC_API_KEY を使用
+    python benchmarks/eval_document_state.py --fake                            # ローカルの代替サーバーで動作確認
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import tempfile
+from collections import Counter
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# 前回の実行結果がキャッシュから返らないように、一時ディレクトリを使う
+os.environ.setdefault("TALK_TO_ARTICLE_DATA_DIR", tempfile.mkdtemp(prefix="eval-document-state-"))
+
+from article_generator.article_formalizer import (
+    DOCUMENT_STATE_TEMPLATE, PREVIOUS_CONTENT_TEMPLATE, build_context_window, formalize_chunks_with_context
+)
+from article_generator.document_state import DocumentState
+from article_generator.rate_limiter import configure_scheduler
+from article_generator.token_estimator import estimate_tokens
+from article_generator.transcript_splitter import extract_speakers, split_transcript
+from synthetic_transcript import generate_transcript
+
+# 整文化結果の行頭の話者ラベル（タイムスタンプや「**話者A**:」のような強調も含む）
+LABEL_PATTERN = re.compile(r'^\s*(?:[-*]\s+)?(?:\d{1,2}:\d{2}(?::\d{2})?\s+)?\**([^:：\n*\d][^:：\n*]{0,29}?)\**\s*[:：]',
+                           re.MULTILINE)
+
+CONTEXT_MODES = ["previous", "state"]
+
+def context_tokens(mode: str, results: List[str], states: List[DocumentState]) -> List[int]:
+    """各チャンクのプロンプトに含まれたコンテキストの推定トークン数を求めます。"""
+    tokens = []
+    for i in range(len(results)):
+        if mode == "state":
+            tokens.append(estimate_tokens(DOCUMENT_STATE_TEMPLATE.format(state=states[i].to_prompt())))
+        elif i > 0:
+            context = build_context_window(results[:i])[0]
+            tokens.append(estimate_tokens(PREVIOUS_CONTENT_TEMPLATE.format(previous_result=context)))
+        else:
+            tokens.append(0)
+    return tokens
+
+def label_consistency(results: List[str], input_speakers: List[str]) -> Dict[str, float]:
+    """
+    出力の話者ラベルの一貫性を求めます。
+    同じ話者に別のラベルが付くと、ラベルの種類が入力の話者数より多くなり、1つのチャンクにしか現れないラベルが増えます。
+    """
+    chunk_labels = [set(LABEL_PATTERN.findall(result)) for result in results]
+    appearances = Counter(label for labels in chunk_labels for label in labels)
+    return {
+        "labels": len(appearances),
+        "speakers": len(input_speakers),
+        "ratio": round(len(appearances) / max(1, len(input_speakers)), 2),
+        "one_off": sum(1 for count in appearances.values() if count == 1),
+    }
+
+def evaluate(mode: str, chunks: List[str], background: Optional[str], model_name: str) -> Dict[str, object]:
+    """1つのコンテキストの方法でチャンクを順に整文化し、トークン数とラベルの一貫性を集計します。"""
+    scheduler = configure_scheduler(model_name)
+    results: List[str] = []
+    # i番目のチャンクのプロンプトに渡した状態（処理前の状態）を記録する
+    states: List[DocumentState] = [DocumentState()]
+
+    formalize_chunks_with_context(chunks, background, model_name, context_mode=mode,
+                                  result_callback=lambda index, result: results.append(result),
+                                  state_callback=states.append)
+    tokens = context_tokens(mode, results, states)
+    metrics = scheduler.metrics()
+    return {
+        "results": results,
+        "context_tokens": tokens,
+        "input_tokens": metrics["input_tokens"],
+        "output_tokens": metrics["output_tokens"],
+        "final_state": states[-1],
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="逐次処理のコンテキスト（直前の結果と文書の状態）の比較")
+    parser.add_argument("--input", default=None, help="文字起こしファイル（省略時は合成テキスト）")
+    parser.add_argument("--size", type=int, default=60000, help="合成テキストのバイト数")
+    parser.add_argument("--background", default=None, help="背景情報")
+    parser.add_argument("--model", default="claude-3-7-sonnet-latest", help="使用するAnthropicモデル名")
+    parser.add_argument("--max-tokens", type=int, default=3000, help="各チャンクの最大トークン数")
+    parser.add_argument("--fake", action="store_true", help="ローカルの代替サーバー（fake_server）を使う")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, encoding="utf-8") as f:
+            transcript = f.read()
+    else:
+        transcript = generate_transcript(args.size)
+
+    server = None
+    if args.fake:
+        from fakes.fake_server import FakeAnthropicServer
+        server = FakeAnthropicServer().start()
+        os.environ["ANTHROPIC_BASE_URL"] = server.url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "sk-fake-key-for-local-evaluation")
+
+    chunks = split_transcript(transcript, args.max_tokens)
+    input_speakers = extract_speakers(transcript)
+    print(f"{len(chunks)} チャンク、推定 {estimate_tokens(transcript)} トークン、話者 {len(input_speakers)} 人")
+
+    try:
+        summaries = {mode: evaluate(mode, chunks, args.background, args.model) for mode in CONTEXT_MODES}
+    finally:
+        if server is not None:
+            server.stop()
+
+    for mode, summary in summaries.items():
+        tokens = summary["context_tokens"]
+        consistency = label_consistency(summary["results"], input_speakers)
+        print(f"\n[{mode}]")
+        print(f"  コンテキスト: 平均 {statistics.mean(tokens):.0f} / 最大 {max(tokens)} トークン/チャンク")
+        print(f"  入力: {summary['input_tokens'] / len(chunks):.0f} トークン/チャンク、出力: {summary['output_tokens'] / len(chunks):.0f} トークン/チャンク")
+        print(f"  話者ラベル: {consistency['labels']} 種類（入力の話者 {consistency['speakers']} 人、比 {consistency['ratio']}）、"
+              f"1チャンクだけのラベル {consistency['one_off']} 個")
+
+    previous = statistics.mean(summaries["previous"]["context_tokens"][1:] or [0])
+    state = statistics.mean(summaries["state"]["context_tokens"][1:] or [0])
+    if state:
+        print(f"\n2チャンク目以降のコンテキストは {previous / state:.1f} 分の1になりました")
+    print("\n最終的な文書の状態:")
+    print(summaries["state"]["final_state"].to_prompt())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+APIを呼び出さずに実行できるベンチマークスイートです。
+合成の文字起こしと、プロセス内で応答を返す決定的なモデル（fakes.fake_llm）を使い、
+分割・正規化・逐次処理・並列処理・非同期処理・結果キャッシュのヒット・エラー時の再試行の処理時間とメモリ使用量を計測します。
+結果はJSONに保存し、--compare で別のコミットの結果と比較できます。
+
+    python benchmarks/run_suite.py                                   # benchmarks/results/<コミット>.json に保存
+    python benchmarks/run_suite.py --sizes 10KB 1MB 50MB --cases splitter
+    python benchmarks/run_suite.py --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# 以前の実行の結果がキャッシュから返らないように、一時ディレクトリを使う
+os.environ.setdefault("TALK_TO_ARTICLE_DATA_DIR", tempfile.mkdtemp(prefix="benchmark-suite-"))
+
+from synthetic_transcript import generate_transcript, parse_size
+
+from article_generator.article_formalizer import (
+    aformalize_transcript, formalize_chunks_parallel, formalize_chunks_with_context, set_client_factory
+)
+from fakes.fake_llm import make_fake_client_factory
+from article_generator.instrumentation import PerformanceRecorder
+from article_generator.rate_limiter import configure_scheduler
+from article_generator.result_cache import get_result_cache
+from article_generator.transcript_splitter import iter_transcript_file_chunks, normalize_transcript, split_transcript
+
+MODEL = "claude-3-7-sonnet-latest"
+CASES = ["splitter", "normalize", "sequential", "parallel", "async", "cache", "errors"]
+
+# 比較するときに、小さいほど良いとみなす指標
+LOWER_IS_BETTER = ("seconds", "peak_mb")
+
+# 処理時間がこれより短い場合は、誤差が大きいため比較しない（秒）
+MIN_COMPARABLE_SECONDS = 0.05
+
+def git_commit() -> str:
+    """現在のコミットの短いハッシュ（取得できない場合は "unknown"）"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure(func: Callable[[], Any], trace_memory: bool = True) -> Dict[str, Any]:
+    """
+    funcの処理時間と、Pythonが確保したメモリのピークを計測します。
+
+    Returns:
+        seconds、peak_mb と、funcの戻り値（value）の辞書
+    """
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    if trace_memory:
+        tracemalloc.stop()
+    return {"seconds": round(elapsed, 3), "peak_mb": round(peak / (1024 * 1024), 2), "value": value}
+
+def bench_splitter(sizes: List[int], max_tokens: int, repeat: int) -> Dict[str, Any]:
+    """
+    サイズごとに、文字列全体の分割（split_transcript）とファイルからのストリーミング分割の時間とメモリを計測します。
+    tracemallocは処理を大きく遅くするため、時間とメモリは別々に計測し、時間は repeat 回のうち最短のものを使います。
+    """
+    results = {}
+    for size in sizes:
+        text = generate_transcript(size)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as f:
+            f.write(text)
+            path = f.name
+        try:
+            timed = min((measure(lambda: len(split_transcript(text, max_tokens)), trace_memory=False) for _ in range(repeat)),
+                        key=lambda result: result["seconds"])
+            in_memory = measure(lambda: len(split_transcript(text, max_tokens)))
+            streamed = measure(lambda: sum(1 for _ in iter_transcript_file_chunks(path, max_tokens)))
+        finally:
+            os.remove(path)
+        label = f"{size // 1024}KB"
+        results[label] = {
+            "bytes": size,
+            "chunks": timed["value"],
+            "seconds": timed["seconds"],
+            "mb_per_second": round(size / (1024 * 1024) / max(timed["seconds"], 1e-9), 2),
+            "peak_mb": in_memory["peak_mb"],
+            "streaming_peak_mb": streamed["peak_mb"],
+        }
+        print(f"  {label:>8}: {timed['seconds']:.2f} 秒、{timed['value']} チャンク、"
+              f"ピークメモリ {in_memory['peak_mb']:.1f} MB（ストリーミング {streamed['peak_mb']:.1f} MB）")
+    return results
+
+def bench_normalize(sizes: List[int], max_tokens: int, seed: int) -> Dict[str, Any]:
+    """
+    サイズごとに、送信前の正規化（normalize_transcript）の時間と、削減されたトークン数・チャンク数を計測します。
+    """
+    results = {}
+    for size in sizes:
+        text = generate_transcript(size, seed=seed)
+        timed = measure(lambda: normalize_transcript(text), trace_memory=False)
+        normalized = timed["value"]
+        label = f"{size // 1024}KB"
+        results[label] = {
+            "bytes": size,
+            "seconds": timed["seconds"],
+            "tokens": normalized.original_tokens,
+            "normalized_tokens": normalized.tokens,
+            "saved_ratio": round(normalized.saved_ratio, 4),
+            "chunks": len(split_transcript(text, max_tokens)),
+            "normalized_chunks": len(split_transcript(normalized.text, max_tokens)),
+            "removed": normalized.removed,
+        }
+        print(f"  {label:>8}: {timed['seconds']:.2f} 秒、{normalized.original_tokens} → {normalized.tokens} トークン"
+              f"（{normalized.saved_ratio:.1%} 削減）、{results[label]['chunks']} → {results[label]['normalized_chunks']} チャンク")
+    return results
+
+def run_pipeline(name: str, func: Callable[[], Any], chunks: int, clear_cache: bool = True) -> Dict[str, Any]:
+    """
+    整文化のパイプラインを1回実行し、処理時間・メモリ・モデルの呼び出しの集計をまとめます。
+    """
+    cache = get_result_cache()
+    if clear_cache:
+        cache.clear()
+    before = cache.stats()
+    recorder = PerformanceRecorder()
+
+    def run() -> Any:
+        with recorder.activate(name):
+            return func()
+
+    result = measure(run)
+    after = cache.stats()
+    summary = recorder.summary()
+    metrics = {
+        "chunks": chunks,
+        "seconds": result["seconds"],
+        "chunks_per_second": round(chunks / max(result["seconds"], 1e-9), 2),
+        "peak_mb": result["peak_mb"],
+        "calls": summary["calls"],
+        "retries": summary["retries"],
+        "cache_hits": after["hits"] - before["hits"],
+        "latency_p50_seconds": summary["latency_p50_seconds"],
+        "latency_p95_seconds": summary["latency_p95_seconds"],
+        "total_queue_wait_seconds": summary["total_queue_wait_seconds"],
+    }
+    print(f"  {name:>10}: {metrics['seconds']:.2f} 秒（{metrics['chunks_per_second']:.1f} チャンク/秒）、"
+          f"呼び出し {metrics['calls']} 回、再試行 {metrics['retries']} 回、キャッシュヒット {metrics['cache_hits']}、"
+          f"ピークメモリ {metrics['peak_mb']:.1f} MB")
+    return metrics
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    2つの結果の、小さいほど良い指標を比較します。
+
+    Returns:
+        threshold の割合を超えて悪化した指標の説明のリスト
+    """
+    regressions = []
+    for case, metrics in current["results"].items():
+        base_metrics = baseline.get("results", {}).get(case)
+        if not isinstance(base_metrics, dict):
+            continue
+        # 分割のようにサイズごとの結果を持つ場合は、1段下の辞書を比較する
+        pairs = ([(f"{case}/{key}", value, base_metrics.get(key)) for key, value in metrics.items() if isinstance(value, dict)]
+                 or [(case, metrics, base_metrics)])
+        for label, values, base_values in pairs:
+            if not isinstance(base_values, dict):
+                continue
+            for name in LOWER_IS_BETTER:
+                if name not in values or not base_values.get(name):
+                    continue
+                if name == "seconds" and max(values[name], base_values[name]) < MIN_COMPARABLE_SECONDS:
+                    continue
+                ratio = values[name] / base_values[name]
+                marker = "  ← 悪化" if ratio > 1 + threshold else ""
+                print(f"  {label:<24} {name:<8} {base_values[name]:>9.3f} → {values[name]:>9.3f}（{ratio:.2f} 倍）{marker}")
+                if marker:
+                    regressions.append(f"{label} {name}: {base_values[name]} → {values[name]}")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="APIを呼び出さずに実行できるベンチマークスイート")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES, help="実行するベンチマーク")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size(size) for size in ("10KB", "1MB", "10MB")],
+                        help="分割のベンチマークに使う合成テキストのサイズ（10KB〜50MB）")
+    parser.add_argument("--pipeline-size", type=parse_size, default=parse_size("200KB"),
+                        help="整文化のベンチマークに使う合成テキストのサイズ")
+    parser.add_argument("--max-tokens", type=int, default=3000, help="各チャンクの最大トークン数")
+    parser.add_argument("--repeat", type=int, default=3, help="分割のベンチマークを繰り返す回数（最短の時間を使う）")
+    parser.add_argument("--workers", type=int, default=8, help="並列処理の同時実行数")
+    parser.add_argument("--latency", type=float, default=0.05, help="模擬モデルが最初のトークンを返すまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=20000, help="模擬モデルの生成速度（トークン/秒）")
+    parser.add_argument("--fake-rpm", type=int, default=None, help="模擬モデルが429を返す1分あたりのリクエスト数")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="errors のベンチマークで模擬モデルが529を返す確率")
+    parser.add_argument("--seed", type=int, default=0, help="合成テキストと模擬モデルのシード")
+    parser.add_argument("--output", default=None, help="結果のJSONの保存先（省略時は benchmarks/results/<コミット>.json）")
+    parser.add_argument("--compare", default=None, help="比較する以前の結果のJSON")
+    parser.add_argument("--threshold", type=float, default=0.1, help="--compare で悪化とみなす割合")
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    settings = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    report: Dict[str, Any] = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+        "results": {},
+    }
+    results = report["results"]
+
+    if "splitter" in args.cases:
+        print("分割")
+        results["splitter"] = bench_splitter(args.sizes, args.max_tokens, max(1, args.repeat))
+
+    if "normalize" in args.cases:
+        print("正規化")
+        results["normalize"] = bench_normalize(args.sizes, args.max_tokens, args.seed)
+
+    pipeline_cases = [case for case in args.cases if case not in ("splitter", "normalize")]
+    if pipeline_cases:
+        transcript = generate_transcript(args.pipeline_size, seed=args.seed)
+        chunks = split_transcript(transcript, args.max_tokens)
+        # 模擬モデルの性能だけを計測するため、スケジューラのレート制限は十分に大きくする
+        configure_scheduler(MODEL, requests_per_minute=1_000_000, tokens_per_minute=1_000_000_000,
+                            initial_concurrency=args.workers, base_delay=0.05, max_delay=1.0)
+        fake_params = {"latency": args.latency, "tokens_per_second": args.tokens_per_second,
+                       "requests_per_minute": args.fake_rpm, "seed": args.seed}
+        set_client_factory(make_fake_client_factory(**fake_params))
+        print(f"整文化（{args.pipeline_size // 1024}KB、{len(chunks)} チャンク）")
+
+        try:
+            if "sequential" in args.cases:
+                results["sequential"] = run_pipeline(
+                    "sequential", lambda: formalize_chunks_with_context(chunks, model_name=MODEL), len(chunks))
+            if "parallel" in args.cases or "cache" in args.cases:
+                results["parallel"] = run_pipeline(
+                    "parallel", lambda: formalize_chunks_parallel(chunks, model_name=MODEL, max_workers=args.workers),
+                    len(chunks))
+            if "cache" in args.cases:
+                # 直前の並列処理と同じ入力で実行し、すべてのチャンクがキャッシュから返る場合を計測する
+                results["cache"] = run_pipeline(
+                    "cache", lambda: formalize_chunks_parallel(chunks, model_name=MODEL, max_workers=args.workers),
+                    len(chunks), clear_cache=False)
+            if "async" in args.cases:
+                results["async"] = run_pipeline(
+                    "async", lambda: asyncio.run(aformalize_transcript(transcript, model_name=MODEL, max_tokens=args.max_tokens,
+                                                                       overlap=0, max_concurrency=args.workers)),
+                    len(chunks))
+            if "errors" in args.cases:
+                configure_scheduler(MODEL, requests_per_minute=1_000_000, tokens_per_minute=1_000_000_000,
+                                    initial_concurrency=args.workers, base_delay=0.05, max_delay=1.0)
+                set_client_factory(make_fake_client_factory(**{**fake_params, "error_rate": args.error_rate}))
+                results["errors"] = run_pipeline(
+                    "errors", lambda: formalize_chunks_parallel(chunks, model_name=MODEL, max_workers=args.workers),
+                    len(chunks))
+        finally:
+            set_client_factory(None)
+
+    # ru_maxrss はLinuxではKB、macOSではバイト
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["max_rss_mb"] = round(max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を {output} に保存しました（最大RSS {report['max_rss_mb']} MB）")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n{baseline.get('commit', args.compare)} との比較")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} 件の指標が {args.threshold:.0%} を超えて悪化しました")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+ベンチマーク用に、日本語の会議の文字起こしを模した合成テキストを生成します。
+
+    python benchmarks/synthetic_transcript.py --size 10MB --output /tmp/meeting.txt
+"""
+import argparse
+import random
+import re
+from typing import Iterator, Optional
+
+SPEAKERS = ["中村恒彦/ARS", "山田花子", "佐藤", "鈴木部長", "田中（開発）", "Smith"]
+FILLERS = ["えー", "あの", "えっと", "まあ", "その", "なんか", "うーん"]
+SUBJECTS = ["今回のプロジェクト", "来期の予算", "新しいAPI", "リリース計画", "顧客からのフィードバック", "KPI", "採用", "インフラのコスト"]
+PREDICATES = [
+    "について確認したいと思います", "はまだ検討中です", "を来週までにまとめます", "の件で相談があります",
+    "は前回の会議で決まった通りです", "については追加の調査が必要だと思います", "がちょっと遅れています",
+    "を見直したほうがいいかもしれません",
+]
+ACKNOWLEDGEMENTS = ["はい", "そうですね", "なるほど", "了解です", "ええ、ええ", "はいはい"]
+
+def _utterance(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        sentence = rng.choice(SUBJECTS) + rng.choice(PREDICATES) + "。"
+        if rng.random() < 0.5:
+            sentence = rng.choice(FILLERS) + "、" + sentence
+        if rng.random() < 0.15:
+            # 言い直し・どもり
+            sentence = sentence[:2] + "、" + sentence
+        parts.append(sentence)
+    if rng.random() < 0.3:
+        parts.insert(0, rng.choice(ACKNOWLEDGEMENTS) + "。")
+    return "".join(parts)
+
+def iter_synthetic_lines(seed: int = 0, long_lines: bool = False) -> Iterator[str]:
+    """
+    合成の文字起こしを1行ずつ生成します。
+
+    Args:
+        seed: 乱数のシード
+        long_lines: Trueの場合、話者ラベルやコロンのない長い行（音声認識の生出力）を生成する
+
+    Yields:
+        改行付きの1行
+    """
+    rng = random.Random(seed)
+    seconds = 0
+    while True:
+        if long_lines:
+            yield "".join(_utterance(rng) for _ in range(rng.randint(200, 400))) + "\n"
+            continue
+        seconds += rng.randint(2, 40)
+        timestamp = f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+        yield f"{timestamp} {rng.choice(SPEAKERS)}: {_utterance(rng)}\n"
+        if rng.random() < 0.05:
+            # 音声認識で同じ区間が重複して出力されることがある
+            yield f"{timestamp} {rng.choice(SPEAKERS)}: {_utterance(rng)}\n"
+
+def generate_transcript(size_bytes: int, seed: int = 0, long_lines: bool = False) -> str:
+    """
+    指定したおおよそのサイズ（UTF-8のバイト数）の合成文字起こしを生成します。
+
+    Args:
+        size_bytes: 生成するテキストのバイト数
+        seed: 乱数のシード
+        long_lines: Trueの場合、話者ラベルやコロンのない長い行を生成する
+
+    Returns:
+        合成した文字起こしテキスト
+    """
+    lines = []
+    total = 0
+    for line in iter_synthetic_lines(seed, long_lines):
+        lines.append(line)
+        total += len(line.encode("utf-8"))
+        if total >= size_bytes:
+            break
+    return "".join(lines)
+
+def parse_size(value: str) -> int:
+    """「10MB」「500KB」のようなサイズ表記をバイト数に変換します。"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*(B|KB|MB|GB)?', value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"サイズの形式が正しくありません: {value}")
+    units = {None: 1, "B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+    return int(float(match.group(1)) * units[match.group(2)])
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="合成の文字起こしテキストを生成します")
+    parser.add_argument("--size", type=parse_size, default=parse_size("1MB"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--long-lines", action="store_true", help="話者ラベルのない長い行を生成する")
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args(argv)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(generate_transcript(args.size, args.seed, args.long_lines))
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
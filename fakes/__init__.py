@@ -0,0 +1,7 @@
+"""
+実際のAPIを呼び出さずに整文化の処理を動かすための、開発用の代替実装です。
+テストとベンチマーク、ローカルでの動作確認に使います。配布する article_generator パッケージには含めません。
+
+    fake_server: Anthropic Messages API（Message Batches API を含む）を模倣するHTTPサーバー
+    fake_llm: HTTPを経由せずにプロセス内で応答を返すチャットモデル
+"""
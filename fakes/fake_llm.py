@@ -0,0 +1,177 @@
+"""
+APIを呼び出さずに、プロセス内で応答を返す決定的なチャットモデルです。
+fake_server と同じく入力の文字起こしをそのまま返し、最初のトークンまでの時間・生成速度（トークン/秒）・
+レート制限（429）・過負荷（529）を設定に応じて模倣します。出力の上限（max_tokens）と、アシスタントの書き出しの続きの生成も模倣します。
+HTTPを経由しないため、ベンチマークで処理そのものの性能を計測するときに使います。
+
+    from article_generator.article_formalizer import set_client_factory
+    from fakes.fake_llm import make_fake_client_factory
+
+    set_client_factory(make_fake_client_factory(latency=0.5, tokens_per_second=80))
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from .fake_server import STREAM_DELTA_CHARS, fake_completion
+from article_generator.token_estimator import estimate_tokens
+
+class FakeAPIError(Exception):
+    """
+    FakeChatModelが返すAPIエラーです。
+    RequestSchedulerが再試行を判定できるように、status_code と retry-after ヘッダーを持ちます。
+    """
+
+    def __init__(self, status_code: int, error_type: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status_code} {error_type}")
+        self.status_code = status_code
+        self.response = _FakeResponse({"retry-after": str(retry_after)} if retry_after is not None else {})
+
+class _FakeResponse:
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = headers
+
+class FakeChatModel(BaseChatModel):
+    """
+    入力の文字起こしをそのまま返すチャットモデルです。
+    エラーを返すかどうかはプロンプトと試行回数から決めるため、スレッドの実行順に関係なく同じ結果になります。
+    """
+
+    model: str = "fake"
+    latency: float = 0.0                          # 最初のトークンを返すまでの秒数
+    tokens_per_second: Optional[float] = None     # 出力の生成速度（Noneの場合は待たずに返す）
+    requests_per_minute: Optional[int] = None     # これを超えると429を返す1分あたりのリクエスト数（Noneの場合は無制限）
+    error_rate: float = 0.0                       # 529（過負荷）を返す確率
+    retry_after: float = 0.0                      # 429と529のエラーに付けるretry-afterの秒数
+    seed: int = 0
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _window: Deque[float] = PrivateAttr(default_factory=deque)
+    _attempts: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _stats: Dict[str, int] = PrivateAttr(default_factory=lambda: {"requests": 0, "rate_limited": 0, "overloaded": 0})
+
+    @property
+    def _llm_type(self) -> str:
+        return "talk-to-article-fake"
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """リクエスト数と、レート制限・過負荷のエラーを返した回数"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _admit(self, prompt: str) -> None:
+        """
+        リクエストを受け付けるかどうかを判定し、受け付けない場合は FakeAPIError を送出します。
+        """
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            self._stats["requests"] += 1
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            if self.requests_per_minute is not None and len(self._window) >= self.requests_per_minute:
+                self._stats["rate_limited"] += 1
+                raise FakeAPIError(429, "rate_limit_error", self.retry_after)
+            draw = int(hashlib.sha256(f"{self.seed}:{key}:{attempt}".encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+            if draw < self.error_rate:
+                self._stats["overloaded"] += 1
+                raise FakeAPIError(529, "overloaded_error", self.retry_after)
+            self._window.append(now)
+
+    def _respond(self, messages: List[BaseMessage], max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        prompt = "\n".join(_message_text(message.content) for message in messages)
+        self._admit(prompt)
+        if messages and isinstance(messages[-1], AIMessage):
+            text, stop_reason = fake_completion("\n".join(_message_text(message.content) for message in messages[:-1]),
+                                                max_tokens, _message_text(messages[-1].content))
+        else:
+            text, stop_reason = fake_completion(prompt, max_tokens)
+        output_tokens = estimate_tokens(text)
+        input_tokens = estimate_tokens(prompt)
+        return {
+            "text": text,
+            "stop_reason": stop_reason,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                      "total_tokens": input_tokens + output_tokens},
+            "generation_seconds": output_tokens / self.tokens_per_second if self.tokens_per_second else 0.0,
+        }
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        response = self._respond(messages, kwargs.get("max_tokens"))
+        time.sleep(self.latency + response["generation_seconds"])
+        message = AIMessage(content=response["text"], usage_metadata=response["usage"],
+                            response_metadata={"stop_reason": response["stop_reason"]})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        response = self._respond(messages, kwargs.get("max_tokens"))
+        await asyncio.sleep(self.latency + response["generation_seconds"])
+        message = AIMessage(content=response["text"], usage_metadata=response["usage"],
+                            response_metadata={"stop_reason": response["stop_reason"]})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        response = self._respond(messages, kwargs.get("max_tokens"))
+        time.sleep(self.latency)
+        pieces = _split_text(response["text"])
+        for piece in pieces:
+            time.sleep(response["generation_seconds"] / len(pieces))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=response["usage"],
+                                                         response_metadata={"stop_reason": response["stop_reason"]}))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        response = self._respond(messages, kwargs.get("max_tokens"))
+        await asyncio.sleep(self.latency)
+        pieces = _split_text(response["text"])
+        for piece in pieces:
+            await asyncio.sleep(response["generation_seconds"] / len(pieces))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=response["usage"],
+                                                         response_metadata={"stop_reason": response["stop_reason"]}))
+
+def _message_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return "\n".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+def _split_text(text: str) -> List[str]:
+    return [text[i:i + STREAM_DELTA_CHARS] for i in range(0, len(text), STREAM_DELTA_CHARS)] or [""]
+
+def make_fake_client_factory(**params: Any) -> Callable[[str, Optional[str]], FakeChatModel]:
+    """
+    set_client_factory に渡す、FakeChatModelを作成する関数を作ります。
+    レート制限の状態を共有するため、モデル名ごとに同じインスタンスを返します。
+
+    Args:
+        **params: FakeChatModelの設定（latency、tokens_per_second、requests_per_minute、error_rate など）
+
+    Returns:
+        モデル名とAPIキーを受け取ってFakeChatModelを返す関数
+    """
+    clients: Dict[str, FakeChatModel] = {}
+    lock = threading.Lock()
+
+    def factory(model_name: str, api_key: Optional[str] = None) -> FakeChatModel:
+        with lock:
+            if model_name not in clients:
+                clients[model_name] = FakeChatModel(model=model_name, **params)
+            return clients[model_name]
+
+    factory.clients = clients
+    return factory
@@ -0,0 +1,477 @@
+"""
+ローカルで動作するAnthropic Messages APIの代替サーバーです。
+実際のAPIを呼び出さずに、レート制限（429）や過負荷（529）の応答を含めて
+スケジューラや整文化の処理を検証するために使います。
+ストリーミング（stream: true）の応答と、cache_controlを指定したプロンプトキャッシュの使用量の報告にも対応します。
+文書の状態の出力を指示された場合は、入力の話者を並べた状態のブロックを末尾に付けます。
+max_tokens を超える応答は途中で切って stop_reason を max_tokens にし、アシスタントの書き出しを渡すとその続きを返します。
+Message Batches API（/v1/messages/batches）も模倣するため、バッチ処理もオフラインで実行できます。
+
+    python -m fakes.fake_server --port 8765 --rpm 20 --overload-rate 0.1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from article_generator.token_estimator import estimate_tokens, truncate_to_first_tokens
+from article_generator.transcript_splitter import extract_speakers
+
+INPUT_TRANSCRIPT_PATTERN = re.compile(r'<input_transcript>\s*(.*?)\s*</input_transcript>', re.DOTALL)
+
+# プロンプトキャッシュの対象になる最小のトークン数
+MIN_CACHEABLE_TOKENS = 1024
+
+# ストリーミングで1回に送るテキストの文字数
+STREAM_DELTA_CHARS = 20
+
+BATCH_PATH_PATTERN = re.compile(r'^/v1/messages/batches/([\w-]+)(/results|/cancel)?$')
+
+class FakeAnthropicServer:
+    """
+    Messages APIの応答を模倣するHTTPサーバーです。
+    入力の<input_transcript>の内容をそのまま返し、設定に応じてレート制限や過負荷のエラーを返します。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, requests_per_minute: Optional[int] = None,
+                 overload_rate: float = 0.0, latency: float = 0.0, retry_after: float = 1.0, seed: Optional[int] = None,
+                 batch_latency: float = 0.0, batch_error_rate: float = 0.0):
+        """
+        Args:
+            host: 待ち受けるホスト
+            port: 待ち受けるポート（0の場合は空いているポート）
+            requests_per_minute: これを超えると429を返す1分あたりのリクエスト数（Noneの場合は無制限）
+            overload_rate: 529（過負荷）を返す確率
+            latency: 応答までの秒数
+            retry_after: 429と529の応答に付けるretry-afterの秒数
+            seed: 乱数のシード
+            batch_latency: メッセージバッチの処理が終了するまでの秒数
+            batch_error_rate: メッセージバッチの各リクエストが失敗（api_error）する確率
+        """
+        self.requests_per_minute = requests_per_minute
+        self.overload_rate = overload_rate
+        self.latency = latency
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.batch_latency = batch_latency
+        self.batch_error_rate = batch_error_rate
+        self.stats = {"requests": 0, "rate_limited": 0, "overloaded": 0, "succeeded": 0, "batches": 0, "batch_requests": 0}
+        self._window: Deque[float] = deque()
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._prompt_cache: Set[str] = set()
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._batch_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+
+    @property
+    def url(self) -> str:
+        """クライアントのbase_urlに指定するURL"""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeAnthropicServer":
+        """バックグラウンドのスレッドでサーバーを起動します。"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """サーバーを停止します。"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeAnthropicServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def _admit(self) -> Optional[Tuple[int, str]]:
+        """
+        リクエストを受け付けるかどうかを判定します。
+
+        Returns:
+            エラーを返す場合はステータスコードとエラー種別、受け付ける場合はNone
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            if self.requests_per_minute is not None and len(self._window) >= self.requests_per_minute:
+                self.stats["rate_limited"] += 1
+                return 429, "rate_limit_error"
+            if self.random.random() < self.overload_rate:
+                self.stats["overloaded"] += 1
+                return 529, "overloaded_error"
+            self._window.append(now)
+            self.stats["succeeded"] += 1
+            self._message_id += 1
+            return None
+
+    def create_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Messages APIのリクエストに対する応答を作成します。
+
+        Args:
+            params: リクエストの本文
+
+        Returns:
+            Messages APIと同じ形式の応答
+        """
+        prompt = _message_text(params)
+        messages = params.get("messages", [])
+        if messages and messages[-1].get("role") == "assistant":
+            prefill = _message_text({"messages": messages[-1:]})
+            text, stop_reason = fake_completion(_message_text(dict(params, messages=messages[:-1])), params.get("max_tokens"), prefill)
+        else:
+            text, stop_reason = fake_completion(prompt, params.get("max_tokens"))
+        with self._lock:
+            message_id = self._message_id
+        usage = {"input_tokens": estimate_tokens(prompt), "output_tokens": estimate_tokens(text)}
+        usage.update(self._cache_usage(params))
+        usage["input_tokens"] -= usage["cache_read_input_tokens"] + usage["cache_creation_input_tokens"]
+        return {
+            "id": f"msg_fake_{message_id:06d}",
+            "type": "message",
+            "role": "assistant",
+            "model": params.get("model", "fake"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": usage,
+        }
+
+    def create_batch(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        メッセージバッチを受け付けます。各リクエストは batch_latency 秒後に処理されたものとして扱います。
+
+        Args:
+            params: バッチ作成のリクエストの本文
+
+        Returns:
+            Message Batches APIと同じ形式のバッチ
+        """
+        batch_id = f"msgbatch_fake_{uuid.uuid4().hex[:16]}"
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["batch_requests"] += len(params.get("requests", []))
+            self._batches[batch_id] = {"requests": params.get("requests", []), "created_at": datetime.now(timezone.utc),
+                                       "results": None, "ended_at": None, "canceled": False}
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """
+        バッチの処理状況を取得します。処理が終了していれば結果を作成します。
+
+        Args:
+            batch_id: バッチのID
+
+        Returns:
+            Message Batches APIと同じ形式のバッチ（存在しない場合はNone）
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+
+        created_at = batch["created_at"]
+        with self._batch_lock:
+            ended = batch["canceled"] or datetime.now(timezone.utc) - created_at >= timedelta(seconds=self.batch_latency)
+            if ended and batch["results"] is None:
+                batch["results"] = [self._batch_result(request, batch["canceled"]) for request in batch["requests"]]
+                batch["ended_at"] = datetime.now(timezone.utc)
+
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        if batch["results"] is None:
+            counts["processing"] = len(batch["requests"])
+        else:
+            for result in batch["results"]:
+                counts[result["result"]["type"]] += 1
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": created_at.isoformat(),
+            "expires_at": (created_at + timedelta(hours=24)).isoformat(),
+            "ended_at": batch["ended_at"].isoformat() if ended else None,
+            "cancel_initiated_at": batch["ended_at"].isoformat() if batch["canceled"] else None,
+            "archived_at": None,
+            "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def cancel_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """
+        バッチを取り消します。処理が終了していないリクエストは canceled になります。
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            batch["canceled"] = True
+        return self.get_batch(batch_id)
+
+    def batch_results(self, batch_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        終了したバッチの結果を取得します（終了していない場合はNone）。
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        return batch["results"] if batch is not None else None
+
+    def _batch_result(self, request: Dict[str, Any], canceled: bool) -> Dict[str, Any]:
+        if canceled:
+            return {"custom_id": request["custom_id"], "result": {"type": "canceled"}}
+        with self._lock:
+            failed = self.random.random() < self.batch_error_rate
+            self._message_id += 1
+        if failed:
+            error = _error_body("api_error", "Simulated batch request error from fake server")
+            return {"custom_id": request["custom_id"], "result": {"type": "errored", "error": error}}
+        return {"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": self.create_message(request["params"])}}
+
+    def _cache_usage(self, params: Dict[str, Any]) -> Dict[str, int]:
+        """
+        cache_controlを指定したブロックまでのプレフィックスについて、キャッシュの読み込みと書き込みのトークン数を求めます。
+        一度書き込んだプレフィックスは以降のリクエストで読み込まれたものとして扱います（有効期限は考えません）。
+        """
+        read_tokens = 0
+        write_tokens = 0
+        prefix = hashlib.sha256()
+        prefix_tokens = 0
+        for block in _content_blocks(params):
+            prefix.update(json.dumps(block.get("text", ""), ensure_ascii=False).encode("utf-8"))
+            prefix_tokens += estimate_tokens(block.get("text", ""))
+            if "cache_control" not in block or prefix_tokens < MIN_CACHEABLE_TOKENS:
+                continue
+            key = prefix.hexdigest()
+            with self._lock:
+                if key in self._prompt_cache:
+                    read_tokens = prefix_tokens
+                    write_tokens = 0
+                else:
+                    self._prompt_cache.add(key)
+                    write_tokens = prefix_tokens - read_tokens
+        return {"cache_read_input_tokens": read_tokens, "cache_creation_input_tokens": write_tokens}
+
+    def stream_events(self, message: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        応答をストリーミングのイベントの並びに変換します。
+
+        Args:
+            message: create_message の戻り値
+
+        Yields:
+            イベント名とデータの組
+        """
+        text = message["content"][0]["text"]
+        start_usage = dict(message["usage"], output_tokens=1)
+        yield "message_start", {"type": "message_start",
+                                "message": dict(message, content=[], stop_reason=None, usage=start_usage)}
+        yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+        for start in range(0, len(text), STREAM_DELTA_CHARS):
+            yield "content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": text[start:start + STREAM_DELTA_CHARS]}}
+        yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+        yield "message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+                                "usage": {"output_tokens": message["usage"]["output_tokens"]}}
+        yield "message_stop", {"type": "message_stop"}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_events(self, events: Iterator[Tuple[str, Dict[str, Any]]]) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for event, data in events:
+                    self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.close_connection = True
+
+            def do_GET(self) -> None:
+                match = BATCH_PATH_PATTERN.match(self.path.split("?")[0])
+                if not match or match.group(2) == "/cancel":
+                    self._send_json(404, _error_body("not_found_error", f"Unknown path: {self.path}"))
+                    return
+                batch_id, suffix = match.groups()
+                if suffix != "/results":
+                    batch = server.get_batch(batch_id)
+                    if batch is None:
+                        self._send_json(404, _error_body("not_found_error", f"Unknown batch: {batch_id}"))
+                        return
+                    self._send_json(200, batch)
+                    return
+
+                results = server.batch_results(batch_id)
+                if results is None:
+                    self._send_json(404, _error_body("not_found_error", f"No results for batch: {batch_id}"))
+                    return
+                data = "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/binary")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/v1/messages/batches":
+                    self._send_json(200, server.create_batch(params))
+                    return
+                match = BATCH_PATH_PATTERN.match(path)
+                if match and match.group(2) == "/cancel":
+                    batch = server.cancel_batch(match.group(1))
+                    if batch is None:
+                        self._send_json(404, _error_body("not_found_error", f"Unknown batch: {match.group(1)}"))
+                        return
+                    self._send_json(200, batch)
+                    return
+                if path != "/v1/messages":
+                    self._send_json(404, _error_body("not_found_error", f"Unknown path: {self.path}"))
+                    return
+
+                if server.latency:
+                    time.sleep(server.latency)
+                rejection = server._admit()
+                if rejection is not None:
+                    status, error_type = rejection
+                    headers = {"retry-after": str(server.retry_after)}
+                    if status == 429:
+                        # 実際のAPIと同じく、アカウントの上限をヘッダーで知らせる
+                        headers["anthropic-ratelimit-requests-limit"] = str(server.requests_per_minute)
+                    self._send_json(status, _error_body(error_type, "Simulated error from fake server"), headers)
+                    return
+                message = server.create_message(params)
+                if params.get("stream"):
+                    self._send_events(server.stream_events(message))
+                else:
+                    self._send_json(200, message)
+
+        return Handler
+
+def _content_blocks(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    リクエストのsystemとmessagesを、プロンプトの先頭から順にコンテンツブロックの並びにします。
+    """
+    blocks = []
+    system = params.get("system")
+    messages = [{"content": system}] if system else []
+    messages += params.get("messages", [])
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            blocks.append({"type": "text", "text": content})
+        elif isinstance(content, list):
+            blocks.extend(block for block in content if isinstance(block, dict))
+    return blocks
+
+def _message_text(params: Dict[str, Any]) -> str:
+    """
+    リクエストのsystemとmessagesに含まれるテキストを連結します。
+    """
+    return "\n".join(block.get("text", "") for block in _content_blocks(params))
+
+def fake_response_text(prompt: str) -> str:
+    """
+    プロンプトに対する代替の応答テキストを作成します。
+    入力の<input_transcript>の内容をそのまま返し、文書の状態の出力を指示された場合は状態のブロックを付けます。
+
+    Args:
+        prompt: systemとmessagesを連結したプロンプト
+
+    Returns:
+        応答テキスト
+    """
+    match = INPUT_TRANSCRIPT_PATTERN.search(prompt)
+    text = match.group(1) if match else prompt[-200:]
+    if "<updated_document_state>" in prompt:
+        text += _document_state_block(text)
+    return text
+
+def fake_completion(prompt: str, max_tokens: Optional[int] = None, prefill: str = "") -> Tuple[str, str]:
+    """
+    fake_response_text の応答を、アシスタントの書き出しの続きと出力の上限に合わせて作成します。
+
+    Args:
+        prompt: systemとmessagesを連結したプロンプト（アシスタントの書き出しを除く）
+        max_tokens: 出力の最大トークン数（Noneの場合は上限なし）
+        prefill: アシスタントの応答の書き出し
+
+    Returns:
+        生成したテキストと stop_reason（上限で切った場合は "max_tokens"、そうでなければ "end_turn"）の組
+    """
+    text = fake_response_text(prompt)
+    if prefill and text.startswith(prefill):
+        text = text[len(prefill):]
+    if max_tokens is None or estimate_tokens(text) <= max_tokens:
+        return text, "end_turn"
+    return truncate_to_first_tokens(text, max_tokens), "max_tokens"
+
+def _document_state_block(text: str) -> str:
+    """
+    入力の話者と先頭の一文から、更新後の文書の状態のブロックを作成します。
+    """
+    speakers = "\n".join(f"{speaker}: 発言者" for speaker in extract_speakers(text))
+    summary = text.strip().split("\n", 1)[0][:100]
+    return (f"\n\n<updated_document_state>\n<speakers>\n{speakers}\n</speakers>\n<glossary>\n</glossary>\n"
+            f"<summary>\n{summary}\n</summary>\n</updated_document_state>")
+
+def _error_body(error_type: str, message: str) -> Dict[str, Any]:
+    return {"type": "error", "error": {"type": error_type, "message": message}}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ローカルで動作するAnthropic Messages APIの代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rpm", type=int, default=None, help="これを超えると429を返す1分あたりのリクエスト数")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="529（過負荷）を返す確率")
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの秒数")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="エラー応答に付けるretry-afterの秒数")
+    parser.add_argument("--batch-latency", type=float, default=0.0, help="メッセージバッチの処理が終了するまでの秒数")
+    parser.add_argument("--batch-error-rate", type=float, default=0.0, help="メッセージバッチの各リクエストが失敗する確率")
+    args = parser.parse_args()
+
+    server = FakeAnthropicServer(args.host, args.port, args.rpm, args.overload_rate, args.latency, args.retry_after,
+                                 batch_latency=args.batch_latency, batch_error_rate=args.batch_error_rate)
+    print(f"Fake Anthropic API: {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
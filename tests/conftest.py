@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+import pytest
+
+# 結果キャッシュやジョブがホームディレクトリに保存されないように、パッケージを読み込む前にデータディレクトリを変える
+os.environ["TALK_TO_ARTICLE_DATA_DIR"] = tempfile.mkdtemp(prefix="talk-to-article-test-")
+
+from fakes.fake_server import FakeAnthropicServer
+
+@pytest.fixture(scope="session")
+def fake_api():
+    """ローカルの代替サーバーを起動し、APIの呼び出しをそこへ向ける"""
+    server = FakeAnthropicServer().start()
+    saved = {name: os.environ.get(name) for name in ("ANTHROPIC_BASE_URL", "ANTHROPIC_API_KEY")}
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+    os.environ["ANTHROPIC_API_KEY"] = "sk-test-" + "0" * 24
+    yield server
+    server.stop()
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
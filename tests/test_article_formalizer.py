@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import pytest
+
+from article_generator import article_formalizer
+
+MODEL = "claude-3-7-sonnet-latest"
+
+class TruncatingClient:
+    """最初の応答を末尾の空白の後で出力の上限により打ち切り、続きを生成する偽のクライアント"""
+
+    def __init__(self):
+        self.prefills = []
+
+    def _parts(self, request):
+        if request[-1].type != "ai":
+            return ["前半の", "文章です。\n", "\n"], "max_tokens"
+        self.prefills.append(request[-1].content)
+        return ["\n続き", "です。", "  "], "end_turn"
+
+    def stream(self, request, max_tokens):
+        parts, stop_reason = self._parts(request)
+        for i, part in enumerate(parts):
+            metadata = {"stop_reason": stop_reason} if i == len(parts) - 1 else {}
+            yield SimpleNamespace(content=part, usage_metadata=None, response_metadata=metadata)
+
+    def invoke(self, request, max_tokens):
+        parts, stop_reason = self._parts(request)
+        return SimpleNamespace(content="".join(parts), usage_metadata=None, response_metadata={"stop_reason": stop_reason})
+
+@pytest.fixture
+def client():
+    client = TruncatingClient()
+    article_formalizer.set_client_factory(lambda model_name, api_key: client)
+    yield client
+    article_formalizer.set_client_factory(None)
+
+def test_stream_matches_invoke_after_continuation(client):
+    """途中で切れて続きを生成した場合も、ストリーミングと同期の呼び出しで同じテキストになる"""
+    inputs = {"transcript": "x"}
+    streamed = "".join(article_formalizer._stream("questions", inputs, MODEL, "sk-test"))
+    invoked = article_formalizer._invoke("questions", inputs, MODEL, "sk-test").content
+    assert streamed == invoked == "前半の文章です。\n続きです。  "
+    # 書き出しとして渡す出力は末尾の空白を取り除く
+    assert client.prefills == ["前半の文章です。", "前半の文章です。"]
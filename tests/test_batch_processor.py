@@ -0,0 +1,16 @@
+from article_generator.batch_processor import formalize_transcripts_batch
+from article_generator.token_estimator import MIN_CHUNK_TOKENS
+
+def _transcript(topic, lines=120):
+    return "\n".join(f"話者{i % 2}: {topic}についての{i}番目の発言です。" for i in range(lines))
+
+def test_formalize_transcripts_batch(fake_api):
+    """複数の文字起こしを1つのバッチで整文化し、文字起こしごとに結果を返す"""
+    transcripts = [_transcript("予算"), _transcript("採用")]
+    batches = fake_api.stats["batches"]
+    results = formalize_transcripts_batch(transcripts, model_name="claude-3-7-sonnet-latest",
+                                          max_tokens=MIN_CHUNK_TOKENS, overlap=0, poll_interval=0.05)
+    # 代替サーバーは入力の文字起こしをそのまま返すため、チャンクの結果を連結すると元の文字起こしになる
+    assert [result.replace("\n", "") for result in results] == [t.replace("\n", "") for t in transcripts]
+    # 最初のチャンクを1つのバッチにまとめ、続くチャンクは直前の結果を使って順にバッチで処理する
+    assert fake_api.stats["batches"] - batches > 1
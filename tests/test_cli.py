@@ -0,0 +1,32 @@
+import json
+import os
+
+from article_generator.cli import main
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+def test_cli_mirrors_input_directories(fake_api, tmp_path, capfd):
+    """別のディレクトリにある同じ名前のファイルを、出力先でも別々のファイルに書き出す"""
+    _write(str(tmp_path / "in" / "a" / "x.txt"), "00:00:01 田中: 今日は天気の話をします。\n00:00:05 佐藤: お願いします。\n")
+    _write(str(tmp_path / "in" / "b" / "x.txt"), "00:00:01 A: 会議を始めます。\n00:00:04 B: よろしくお願いします。\n")
+    out = tmp_path / "out"
+    assert main([str(tmp_path / "in" / "**" / "*.txt"), "--output-dir", str(out)]) == 0
+
+    with open(out / "a" / "x.md", encoding="utf-8") as f:
+        assert "天気" in f.read()
+    with open(out / "b" / "x.md", encoding="utf-8") as f:
+        assert "会議" in f.read()
+    events = [json.loads(line) for line in capfd.readouterr().out.splitlines()]
+    assert events[-1]["event"] == "run_completed" and events[-1]["succeeded"] == 2
+
+def test_cli_rejects_output_collisions(tmp_path, capsys):
+    """出力先が重なる場合は、何も書き出さずに終了する"""
+    _write(str(tmp_path / "a" / "x.txt"), "A: はい。\n")
+    _write(str(tmp_path / "b" / "x.txt"), "B: いいえ。\n")
+    out = tmp_path / "out"
+    assert main([str(tmp_path / "a" / "x.txt"), str(tmp_path / "b" / "x.txt"), "--output-dir", str(out)]) == 2
+    assert "重なっています" in capsys.readouterr().err
+    assert not out.exists()
@@ -0,0 +1,17 @@
+from article_generator.document_state import DocumentState
+
+def test_has_same_entries_ignores_descriptions():
+    """説明の言い回しが変わっても、話者ラベルと用語が同じなら同じ状態とみなす"""
+    before = DocumentState(speakers={"A": "田中（司会）"}, glossary={"LLM": "大規模言語モデル"}, summary="導入")
+    after = DocumentState(speakers={"A": "司会の田中さん"}, glossary={"LLM": "大規模な言語モデルのこと"}, summary="別の要約")
+    assert before.has_same_entries(after)
+
+def test_has_same_entries_normalizes_keys():
+    before = DocumentState(speakers={"Ａ": "田中"}, glossary={"Large Language Model": "LLM"})
+    after = DocumentState(speakers={"a": "田中"}, glossary={"large  language model": "LLM"})
+    assert before.has_same_entries(after)
+
+def test_has_same_entries_detects_new_terms():
+    before = DocumentState(speakers={"A": "田中"}, glossary={"LLM": "大規模言語モデル"})
+    assert not before.has_same_entries(DocumentState(speakers={"A": "田中", "B": "佐藤"}, glossary=before.glossary))
+    assert not before.has_same_entries(DocumentState(speakers=before.speakers, glossary={"RAG": "検索拡張生成"}))
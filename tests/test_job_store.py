@@ -0,0 +1,56 @@
+import json
+import os
+
+from article_generator.job_store import (
+    create_job, delete_job, find_previous_job, list_jobs, load_job, record_result
+)
+
+def test_record_result_appends_and_reloads(tmp_path):
+    jobs_dir = str(tmp_path)
+    job = create_job(["a", "b", "c"], {"owner": "o1", "model_name": "m"}, jobs_dir)
+    record_result(job, 0, "A", jobs_dir, document_state={"summary": "s0"})
+    record_result(job, 1, "B", jobs_dir)
+
+    loaded = load_job(job.job_id, jobs_dir)
+    assert loaded.results == {0: "A", 1: "B"}
+    assert loaded.document_state == {"summary": "s0"}
+    assert loaded.chunk_states == {0: {"summary": "s0"}}
+    # チャンクごとの記録ではジョブ全体のファイルを書き直さない
+    with open(os.path.join(jobs_dir, f"{job.job_id}.json"), encoding="utf-8") as f:
+        assert json.load(f)["results"] == {}
+
+def test_load_job_ignores_truncated_line(tmp_path):
+    jobs_dir = str(tmp_path)
+    job = create_job(["a", "b"], {}, jobs_dir)
+    record_result(job, 0, "A", jobs_dir)
+    with open(os.path.join(jobs_dir, f"{job.job_id}.results.jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "resu')
+    assert load_job(job.job_id, jobs_dir).results == {0: "A"}
+
+def test_list_jobs_uses_summaries(tmp_path):
+    jobs_dir = str(tmp_path)
+    done = create_job(["a"], {"owner": "o1", "model_name": "m"}, jobs_dir)
+    record_result(done, 0, "A", jobs_dir)
+    pending = create_job(["a", "b"], {"owner": "o1", "model_name": "m"}, jobs_dir)
+    create_job(["a"], {"owner": "o2"}, jobs_dir)
+
+    summaries = list_jobs(jobs_dir=jobs_dir, owner="o1")
+    assert [(s.job_id, s.completed_chunks, s.total_chunks) for s in summaries] == [(pending.job_id, 0, 2)]
+    assert {s.job_id for s in list_jobs(include_complete=True, jobs_dir=jobs_dir, owner="o1")} == {done.job_id, pending.job_id}
+    previous = find_previous_job({"owner": "o1", "model_name": "m"}, ("model_name",), jobs_dir)
+    assert previous.job_id == done.job_id and previous.results == {0: "A"}
+
+def test_list_jobs_reads_jobs_without_summary(tmp_path):
+    """概要のない以前の形式のジョブも一覧に含める"""
+    jobs_dir = str(tmp_path)
+    job = create_job(["a", "b"], {"owner": "o1"}, jobs_dir)
+    record_result(job, 0, "A", jobs_dir)
+    os.remove(os.path.join(jobs_dir, f"{job.job_id}.summary.json"))
+    assert [(s.job_id, s.completed_chunks) for s in list_jobs(jobs_dir=jobs_dir)] == [(job.job_id, 1)]
+
+def test_delete_job_removes_all_files(tmp_path):
+    jobs_dir = str(tmp_path)
+    job = create_job(["a"], {}, jobs_dir)
+    record_result(job, 0, "A", jobs_dir)
+    delete_job(job.job_id, jobs_dir)
+    assert os.listdir(jobs_dir) == []
@@ -0,0 +1,10 @@
+from article_generator.model_router import removed_fillers_scope, score_chunk
+from article_generator.transcript_splitter import normalize_transcript
+
+def test_score_counts_fillers_removed_by_normalization():
+    """正規化で取り除いたフィラーも難易度に数え、正規化しない場合と同じスコアにする"""
+    text = "\n".join(f"00:00:{i:02d} 話者{i % 2}: えー、あの、今日は、えっと、その件について、うーん、話します。" for i in range(20))
+    normalized = normalize_transcript(text)
+    assert score_chunk(normalized.text) < score_chunk(text)
+    with removed_fillers_scope(normalized.filler_density):
+        assert score_chunk(normalized.text) == score_chunk(text)
@@ -0,0 +1,50 @@
+from article_generator.transcript_splitter import extract_speakers, normalize_transcript, split_transcript
+
+def test_normalize_bracketed_timestamps():
+    """括弧で囲まれたタイムスタンプを話者ラベルと誤認せず、話者ごとの行を保つ"""
+    text = "[00:01:02] 田中: はい。\n[00:01:05] 佐藤: いいえ。"
+    assert normalize_transcript(text).text == "01:02 田中: はい。\n01:05 佐藤: いいえ。"
+
+def test_normalize_parenthesized_timestamps():
+    text = "(00:01:02) 田中: はい。\n（01:05） 佐藤: いいえ。"
+    assert normalize_transcript(text).text == "01:02 田中: はい。\n01:05 佐藤: いいえ。"
+
+def test_normalize_alternating_speakers():
+    """話者が交互に替わる場合は結合せず、同じ話者が続く場合だけ結合する"""
+    text = ("[00:00:01] A: 一つ目。\n[00:00:03] B: 二つ目。\n[00:00:05] A: 三つ目。\n"
+            "[00:00:07] A: 四つ目。\n[00:00:09] B: 五つ目。")
+    result = normalize_transcript(text)
+    assert result.text == "00:01 A: 一つ目。\n00:03 B: 二つ目。\n00:05 A: 三つ目。四つ目。\n00:09 B: 五つ目。"
+    assert result.removed["merged_lines"] == 1
+
+def test_normalize_bare_timestamps():
+    text = "00:00:01 A: こんにちは。\n00:00:02 B: こんばんは。"
+    assert normalize_transcript(text).text == "00:01 A: こんにちは。\n00:02 B: こんばんは。"
+
+def test_extract_speakers_bracketed_timestamps():
+    text = "[00:01:02] 田中: はい。\n(00:01:05) 佐藤: いいえ。\n00:01:07 田中: そうですか。"
+    assert extract_speakers(text) == ["田中", "佐藤"]
+
+def test_split_bracketed_timestamps_like_bare():
+    """括弧で囲まれたタイムスタンプも、括弧のないものと同じ位置で区切る"""
+    bare = "00:00:01 A: " + "あ" * 50 + "。\n00:00:05 B: " + "い" * 50 + "。"
+    bracketed = "[00:00:01] A: " + "あ" * 50 + "。\n[00:00:05] B: " + "い" * 50 + "。"
+    chunks = split_transcript(bracketed, max_tokens=40)
+    assert [chunk.replace("[", "").replace("]", "") for chunk in chunks] == split_transcript(bare, max_tokens=40)
+
+def test_normalize_keeps_repeated_numbers():
+    """数字や英字の繰り返しは言い直しとして扱わない"""
+    assert normalize_transcript("A: 1、1、2と続く").text == "A: 1、1、2と続く"
+    assert normalize_transcript("A: ABC、ABC、です").text == "A: ABC、ABC、です"
+
+def test_normalize_removes_kana_stutters_and_fillers():
+    assert normalize_transcript("A: え、えーと、これ、これは、はい、はい、はい。").text == "A: これは、はい。"
+
+def test_normalize_keeps_ambiguous_fillers():
+    assert normalize_transcript("A: まあ、なんか、いいです。").text == "A: まあ、なんか、いいです。"
+
+def test_normalize_reports_removed_fillers():
+    result = normalize_transcript("A: えーと、今日は、あのー、晴れです。\nA: 明日も晴れです。")
+    assert result.text == "A: 今日は、晴れです。明日も晴れです。"
+    assert result.removed["fillers"] == 2
+    assert result.filler_density > 0